@@ -1,4 +1,5 @@
 """TODO: PLACE INTO THE NEUROSYNTH APP"""
+import sqlalchemy as sa
 from sqlalchemy.orm import relationship, backref
 from sqlalchemy.sql import func
 import shortuuid
@@ -7,6 +8,22 @@ import secrets
 from ..database import db
 
 
+def trgm_index(table, column):
+    return sa.Index(
+        f"ix_{table}_{column}_trgm",
+        column,
+        postgresql_using="gin",
+        postgresql_ops={column: "gin_trgm_ops"},
+    )
+
+
+sa.event.listen(
+    db.Model.metadata,
+    "before_create",
+    sa.DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm"),
+)
+
+
 def generate_id():
     return shortuuid.ShortUUID().random(length=12)
 
@@ -107,6 +124,11 @@ class MetaAnalysis(BaseMixin, db.Model):
     project = relationship("Project", backref=backref("meta_analyses"))
     user = relationship("User", backref=backref("meta_analyses"))
 
+    __table_args__ = (
+        trgm_index("meta_analyses", "name"),
+        trgm_index("meta_analyses", "description"),
+    )
+
 
 class MetaAnalysisResult(BaseMixin, db.Model):
     __tablename__ = "meta_analysis_results"
@@ -206,6 +228,11 @@ class Project(BaseMixin, db.Model):
 
     user = relationship("User", backref=backref("projects"))
 
+    __table_args__ = (
+        trgm_index("projects", "name"),
+        trgm_index("projects", "description"),
+    )
+
 
 # class MetaAnalysisImage(db.Model):
 #     __tablename__ = "metaanalysis_images"
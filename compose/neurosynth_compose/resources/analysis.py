@@ -1,13 +1,14 @@
 import pathlib
 
 import connexion
-from flask import abort, request, jsonify, current_app
+from flask import abort, request, jsonify, current_app, g
 from flask.views import MethodView
 
 # from sqlalchemy.ext.associationproxy import ColumnAssociationProxyInstance
 from marshmallow.exceptions import ValidationError
 import sqlalchemy.sql.expression as sae
 from sqlalchemy import func
+from sqlalchemy.orm import object_session
 from webargs.flaskparser import parser
 from webargs import fields
 
@@ -45,10 +46,24 @@ from .singular import singularize
 
 
 def get_current_user():
-    user = connexion.context.get("user")
-    if user:
-        return User.query.filter_by(external_id=connexion.context["user"]).first()
-    return None
+    """return the user making the request, looked up at most once per request"""
+    external_id = connexion.context.get("user")
+    if not external_id:
+        return None
+
+    memo = g.get("current_user")
+    if (
+        memo is not None
+        and memo[0] == external_id
+        and object_session(memo[1]) is db.session()
+    ):
+        return memo[1]
+
+    user = User.query.filter_by(external_id=external_id).first()
+    if user is not None:
+        # users that do not exist yet are created later in the request
+        g.current_user = (external_id, user)
+    return user
 
 
 def view_maker(cls):
@@ -262,13 +277,27 @@ class ListView(BaseView):
 
         # Sort
         sort_col = args["sort"]
+        search = args["search"]
+        if sort_col == "relevance" and not (search and self._fulltext_fields):
+            # nothing to rank without a search
+            sort_col = "created_at"
         desc = False if sort_col != "created_at" else args["desc"]
         desc = {False: "asc", True: "desc"}[desc]
 
-        attr = getattr(m, sort_col)
+        if sort_col == "relevance":
+            # closest trigram match of the search in any of the fields first
+            attr = func.greatest(
+                *[
+                    func.word_similarity(search, getattr(m, f))
+                    for f in self._fulltext_fields
+                ]
+            )
+            desc = "desc"
+        else:
+            attr = getattr(m, sort_col)
 
         # Case-insensitive sorting
-        if sort_col != "created_at":
+        if sort_col not in ("created_at", "relevance"):
             attr = func.lower(attr)
 
         # TODO: if the sort field is proxied, bad stuff happens. In theory
@@ -278,16 +307,17 @@ class ListView(BaseView):
         #     q = q.join(*attr.attr)
         q = q.order_by(getattr(attr, desc)())
 
-        records = q.paginate(
+        pagination = q.paginate(
             page=args["page"], per_page=args["page_size"], error_out=False
-        ).items
+        )
+        records = pagination.items
         # check if results should be nested
         nested = True if args.get("nested") else False
         content = self.__class__._schema(
             only=self._only, many=True, context={"nested": nested}
         ).dump(records)
         response = {
-            "metadata": {},
+            "metadata": {"total_count": pagination.total},
             "results": content,
         }
         return jsonify(response), 200
@@ -446,7 +476,9 @@ class MetaAnalysisResultsView(ObjectView, ListView):
             access_token = request.headers.get("Authorization")
             neurostore_analysis_upload = create_or_update_neurostore_analysis.si(
                 ns_analysis_id=ns_analysis.id,
-                cluster_table=str(cluster_table_fnames[0]) if cluster_table_fnames else None,
+                cluster_table=str(cluster_table_fnames[0])
+                if cluster_table_fnames
+                else None,
                 nv_collection_id=result.neurovault_collection.id,
                 access_token=access_token,
             )
@@ -474,6 +506,7 @@ class NeurostoreStudiesView(ObjectView, ListView):
 
 @view_maker
 class ProjectsView(ObjectView, ListView):
+    _search_fields = ("name", "description")
     _nested = {
         "meta_analyses": "MetaAnalysesView",
     }
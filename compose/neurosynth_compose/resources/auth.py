@@ -1,4 +1,8 @@
+import hashlib
 import json
+import threading
+import time
+from collections import OrderedDict
 from urllib.request import urlopen
 
 from flask import jsonify, request
@@ -60,9 +64,98 @@ def get_token_auth_header():
     return token
 
 
-def decode_token(token):
+# seconds the signing keys are trusted before fetching them again
+JWKS_TTL = 60 * 60
+# minimum seconds between refreshes triggered by an unknown key id
+JWKS_MIN_REFRESH = 60
+# number of verified tokens remembered until they expire
+VERIFIED_TOKENS_SIZE = 1024
+
+# replaced as a whole on every fetch, so it is read without the lock
+_jwks = {"keys": {}, "fetched_at": float("-inf"), "attempted_at": float("-inf")}
+# held by the one thread fetching the key set
+_jwks_lock = threading.Lock()
+_verified_tokens = OrderedDict()
+_verified_tokens_lock = threading.Lock()
+
+
+def fetch_jwks():
     jsonurl = urlopen(app.config["AUTH0_BASE_URL"] + "/.well-known/jwks.json")
-    jwks = json.loads(jsonurl.read())
+    return json.loads(jsonurl.read())
+
+
+def get_signing_key(kid):
+    """return the JSON web key ``kid`` from the cached key set
+
+    The key set is fetched again once it is older than ``JWKS_TTL``, or when
+    it does not know ``kid`` (keys were rotated), at most every
+    ``JWKS_MIN_REFRESH`` seconds. A single thread fetches it; the others keep
+    using the known key, or wait for the fetch when they have none. When the
+    fetch fails the cached keys are kept, it only raises without any.
+    """
+    global _jwks
+
+    def outdated(jwks):
+        now = time.monotonic()
+        stale = now - jwks["fetched_at"] > JWKS_TTL or kid not in jwks["keys"]
+        return stale and now - jwks["attempted_at"] > JWKS_MIN_REFRESH
+
+    key = _jwks["keys"].get(kid)
+    if outdated(_jwks) and _jwks_lock.acquire(blocking=key is None):
+        try:
+            # another thread may have fetched it while this one waited
+            if outdated(_jwks):
+                now = time.monotonic()
+                try:
+                    keys = {k["kid"]: k for k in fetch_jwks()["keys"]}
+                except Exception:
+                    if not _jwks["keys"]:
+                        raise
+                    app.logger.warning(
+                        "fetching the signing keys failed, using the cached ones",
+                        exc_info=True,
+                    )
+                    _jwks = {**_jwks, "attempted_at": now}
+                else:
+                    _jwks = {"keys": keys, "fetched_at": now, "attempted_at": now}
+        finally:
+            _jwks_lock.release()
+        key = _jwks["keys"].get(kid)
+    return key
+
+
+def _token_digest(token):
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+def _get_verified_token(digest):
+    with _verified_tokens_lock:
+        payload = _verified_tokens.get(digest)
+        if payload is None:
+            return None
+        if payload["exp"] <= time.time():
+            del _verified_tokens[digest]
+            return None
+        _verified_tokens.move_to_end(digest)
+        return payload
+
+
+def _set_verified_token(digest, payload):
+    if "exp" not in payload:
+        return
+    with _verified_tokens_lock:
+        _verified_tokens[digest] = payload
+        _verified_tokens.move_to_end(digest)
+        while len(_verified_tokens) > VERIFIED_TOKENS_SIZE:
+            _verified_tokens.popitem(last=False)
+
+
+def decode_token(token):
+    digest = _token_digest(token)
+    payload = _get_verified_token(digest)
+    if payload is not None:
+        return payload
+
     try:
         unverified_header = jwt.get_unverified_header(token)
     except jwt.JWTError:
@@ -75,15 +168,15 @@ def decode_token(token):
         )
 
     rsa_key = {}
-    for key in jwks["keys"]:
-        if key["kid"] == unverified_header["kid"]:
-            rsa_key = {
-                "kty": key["kty"],
-                "kid": key["kid"],
-                "use": key["use"],
-                "n": key["n"],
-                "e": key["e"],
-            }
+    key = get_signing_key(unverified_header.get("kid"))
+    if key is not None:
+        rsa_key = {
+            "kty": key["kty"],
+            "kid": key["kid"],
+            "use": key["use"],
+            "n": key["n"],
+            "e": key["e"],
+        }
     if rsa_key:
         try:
             payload = jwt.decode(
@@ -116,6 +209,7 @@ def decode_token(token):
                 401,
             )
 
+        _set_verified_token(digest, payload)
         return payload
 
     raise AuthError(
@@ -1,3 +1,8 @@
+from sqlalchemy import func
+
+from ...models import MetaAnalysis
+
+
 def test_get_meta_analyses(app, auth_client, user_data):
     get_all = auth_client.get("/api/meta-analyses")
     assert get_all.status_code == 200
@@ -17,3 +22,38 @@ def test_get_meta_analyses(app, auth_client, user_data):
 
 def test_ingest_neurostore(neurostore_data):
     pass
+
+
+def test_search_meta_analyses(app, db, auth_client, user_data):
+    user = MetaAnalysis.query.first().user
+    # the search only matches inside a longer word here, so it ranks lower
+    db.session.add_all(
+        [
+            MetaAnalysis(name="metameta analysis", user=user),
+            MetaAnalysis(name="meta analysis", user=user),
+        ]
+    )
+    db.session.commit()
+
+    resp = auth_client.get(
+        "/api/meta-analyses?search=meta%20analysis&sort=relevance&page_size=99"
+    )
+    assert resp.status_code == 200
+    results = resp.json["results"]
+    assert results
+    assert resp.json["metadata"]["total_count"] == len(results)
+    assert all("meta analysis" in r["name"] for r in results)
+
+    similarity = dict(
+        db.session.query(
+            MetaAnalysis.id,
+            func.greatest(
+                func.word_similarity("meta analysis", MetaAnalysis.name),
+                func.word_similarity("meta analysis", MetaAnalysis.description),
+            ),
+        )
+    )
+    scores = [similarity[r["id"]] for r in results]
+    assert scores == sorted(scores, reverse=True)
+    names = [r["name"] for r in results]
+    assert names.index("meta analysis") < names.index("metameta analysis")
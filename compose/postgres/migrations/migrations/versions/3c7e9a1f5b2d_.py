@@ -0,0 +1,33 @@
+"""trigram indexes for meta-analysis and project search
+
+Revision ID: 3c7e9a1f5b2d
+Revises: 99078464479b
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "3c7e9a1f5b2d"
+down_revision = "99078464479b"
+branch_labels = None
+depends_on = None
+
+TRIGRAM_TABLES = ("meta_analyses", "projects")
+TRIGRAM_COLUMNS = ("name", "description")
+
+
+def upgrade():
+    op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    for table in TRIGRAM_TABLES:
+        for column in TRIGRAM_COLUMNS:
+            op.execute(
+                f"CREATE INDEX IF NOT EXISTS ix_{table}_{column}_trgm "
+                f"ON {table} USING gin ({column} gin_trgm_ops)"
+            )
+
+
+def downgrade():
+    for table in TRIGRAM_TABLES:
+        for column in TRIGRAM_COLUMNS:
+            op.execute(f"DROP INDEX IF EXISTS ix_{table}_{column}_trgm")
@@ -27,10 +27,11 @@ def make_shell_context():
 
 @app.cli.command()
 @click.option("--max-rows", default=None, help="ingest neurosynth")
-def ingest_neurosynth(max_rows):
+@click.option("--workers", default=1, help="processes building rows (0: every core)")
+def ingest_neurosynth(max_rows, workers):
     if max_rows is not None:
         max_rows = int(max_rows)
-    ingest.ingest_neurosynth(max_rows=max_rows)
+    ingest.ingest_neurosynth(max_rows=max_rows, workers=workers or os.cpu_count())
 
 
 @app.cli.command()
@@ -40,15 +41,58 @@ def ingest_neurosynth(max_rows):
 @click.option(
     "--limit/-l", default=None, help="number of neurovault studies to download"
 )
-def ingest_neurovault(verbose, limit):
+@click.option("--workers", default=8, help="concurrent requests to neurovault")
+@click.option(
+    "--checkpoint", default=None, help="file recording progress to resume from"
+)
+def ingest_neurovault(verbose, limit, workers, checkpoint):
     if limit is not None:
         limit = int(limit)
-    ingest.ingest_neurovault(verbose=verbose, limit=limit)
+    ingest.ingest_neurovault(
+        verbose=verbose, limit=limit, workers=workers, checkpoint=checkpoint
+    )
 
 
 @app.cli.command()
 @click.option("--max-rows", default=None, help="ingest neurosynth")
-def ingest_neuroquery(max_rows):
+@click.option("--workers", default=1, help="processes building rows (0: every core)")
+def ingest_neuroquery(max_rows, workers):
     if max_rows is not None:
         max_rows = int(max_rows)
-    ingest.ingest_neuroquery(max_rows=max_rows)
+    ingest.ingest_neuroquery(max_rows=max_rows, workers=workers or os.cpu_count())
+
+
+@app.cli.command()
+@click.option("--top", default=100, help="number of popular responses to warm")
+@click.option(
+    "--watch/--no-watch",
+    default=False,
+    help="keep warming the popular responses after they are invalidated",
+)
+def warm_cache(top, watch):
+    from neurostore.resources.caching import warm_cache, watch_invalidations
+
+    warmed = warm_cache(app, top)
+    click.echo(f"warmed {len(warmed)} responses")
+    if watch:
+        watch_invalidations(app, top)
+
+
+@app.cli.command()
+@click.option(
+    "--watch/--no-watch",
+    default=False,
+    help="keep storing the snapshots queued by the writes",
+)
+def refresh_snapshots(watch):
+    """store the nested studyset snapshots that are stale or missing"""
+    from neurostore.resources.snapshots import (
+        refresh_snapshots,
+        watch_stale_snapshots,
+    )
+
+    refreshed = refresh_snapshots()
+    db.session.commit()
+    click.echo(f"refreshed {refreshed} studyset snapshots")
+    if watch:
+        watch_stale_snapshots()
@@ -1,158 +1,391 @@
 """
 Ingest and sync data from various sources (Neurosynth, NeuroVault, etc.).
 """
-import os.path as op
-import re
+import hashlib
+from collections import namedtuple
 from pathlib import Path
 
 import numpy as np
 import pandas as pd
-import requests
 from scipy import sparse
-from dateutil.parser import parse as parse_date
-from sqlalchemy import or_
+from sqlalchemy import bindparam, delete, func, or_, select, update
 
 from neurostore.database import db
 from neurostore.models import (
     Analysis,
     AnalysisConditions,
-    AnnotationAnalysis,
     Annotation,
-    Condition,
-    Image,
+    AnnotationAnalysis,
+    Entity,
     Point,
     Study,
     BaseStudy,
     Studyset,
-    Entity,
 )
-from neurostore.models.data import StudysetStudy, _check_type
-
-
-def ingest_neurovault(verbose=False, limit=20, overwrite=False):
-    # Store existing studies for quick lookup
-    all_studies = {s.doi: s for s in Study.query.filter_by(source="neurovault").all()}
-
-    def add_collection(data):
-        if data["DOI"] in all_studies and not overwrite:
-            print("Skipping {} (already exists)...".format(data["DOI"]))
-            return
-        collection_id = data.pop("id")
-        doi = data.pop("DOI", None)
-        base_study = None
-        if doi:
-            base_study = BaseStudy.query.filter_by(doi=doi).one_or_none()
-
-        if base_study is None:
-            base_study = BaseStudy(
-                name=data.pop("name", None),
-                description=data.pop("description", None),
-                doi=data.pop("DOI", None),
-                authors=data.pop("authors", None),
-                publication=data.pop("journal_name", None),
-                metadata_=data,
-                level="group",
+from neurostore.models.data import _check_type, generate_id
+from neurostore.models.event_listeners import (
+    insert_blank_notes_of,
+    invalidate_snapshots_of,
+)
+from neurostore.ingest.bulk import (
+    COPY_CHUNK_SIZE,
+    STUDY_TABLES,
+    copy_frame,
+    copy_study_frames,
+    generate_ids,
+    study_frames,
+    to_json_column,
+)
+from neurostore.ingest.neurovault import ingest_neurovault  # noqa: F401
+from neurostore.ingest.sync import dataset_version, get_sync_state, invalidate_studies
+
+
+BASE_STUDY_FIELDS = ("name", "doi", "pmid", "authors", "publication", "year", "level")
+
+
+def _merge_base_studies(base_studies):
+    """fold duplicate base studies into the first one"""
+    source_base_study, *duplicates = base_studies
+    # do not overwrite the versions or bookkeeping columns,
+    # we want to append to the versions
+    columns = [
+        c.key
+        for c in BaseStudy.__mapper__.column_attrs
+        if c.key not in ("id", "created_at", "updated_at", "__ts_vector__")
+    ]
+    for ab in duplicates:
+        for col in columns:
+            source_attr = getattr(source_base_study, col)
+            setattr(source_base_study, col, source_attr or getattr(ab, col))
+        source_base_study.versions.extend(ab.versions)
+        # delete the extraneous record
+        db.session.delete(ab)
+    return source_base_study
+
+
+def _resolve_base_studies(records, update=True):
+    """find the base study of every record with a single query
+
+    Each record is a dict of base study attributes which must include
+    ``doi`` and ``pmid``. Records with a doi match on doi or pmid, the others
+    on pmid only. Existing base studies missing information are filled in
+    from the record (when ``update`` is set), records without a base study
+    get a new one.
+
+    Returns the attributes (``BASE_STUDY_FIELDS``) of the base study of each
+    record and a DataFrame of the base studies to create.
+    """
+    dois = {r["doi"] for r in records if r["doi"] is not None}
+    pmids = {r["pmid"] for r in records if r["pmid"] is not None}
+    by_doi, by_pmid = {}, {}
+    with db.session.no_autoflush:
+        for bs in BaseStudy.query.filter(
+            or_(BaseStudy.doi.in_(dois), BaseStudy.pmid.in_(pmids))
+        ):
+            by_doi.setdefault(bs.doi, []).append(bs)
+            by_pmid.setdefault(bs.pmid, []).append(bs)
+
+        resolved = []
+        new_base_studies = []
+        for record in records:
+            matches = list(by_pmid.get(record["pmid"], []))
+            if record["doi"] is not None:
+                matches += [
+                    bs for bs in by_doi.get(record["doi"], []) if bs not in matches
+                ]
+            matches = [bs for bs in matches if bs not in db.session.deleted]
+
+            if not matches:
+                base_study = {
+                    "id": generate_id(),
+                    **{col: record.get(col) for col in BASE_STUDY_FIELDS},
+                }
+                new_base_studies.append(base_study)
+                resolved.append(base_study)
+                continue
+
+            base_study = _merge_base_studies(matches)
+            if update:
+                # try to update the base study if information is missing
+                for col, value in record.items():
+                    setattr(base_study, col, getattr(base_study, col) or value)
+            resolved.append(
+                {
+                    "id": base_study.id,
+                    **{col: getattr(base_study, col) for col in BASE_STUDY_FIELDS},
+                }
             )
-        s = Study(
-            name=data.pop("name", None) or base_study.name,
-            description=data.pop("description", None) or base_study.description,
-            doi=doi,
-            pmid=base_study.pmid,
-            authors=data.pop("authors", None) or base_study.authors,
-            publication=data.pop("journal_name", None) or base_study.publication,
-            source_id=collection_id,
-            metadata_=data,
-            source="neurovault",
-            level="group",
-            base_study=base_study,
+
+    new_base_studies = pd.DataFrame(
+        new_base_studies, columns=["id", *BASE_STUDY_FIELDS]
+    ).assign(public=True)
+    return pd.DataFrame(resolved, columns=["id", *BASE_STUDY_FIELDS]), new_base_studies
+
+
+# study columns compared to tell the studies that changed upstream
+STUDY_FIELDS = ("name", "authors", "year", "publication", "pmid", "doi")
+
+
+def _python(value):
+    """a pandas/numpy scalar as a python value (None when missing)"""
+    if value is None or (not isinstance(value, str) and pd.isna(value)):
+        return None
+    return value.item() if hasattr(value, "item") else value
+
+
+def _copy_studies(base_studies, studies, coord_data, space, workers=1):
+    """COPY new base studies, studies and their coordinates
+
+    The coordinates are built by ``workers`` processes (see
+    :func:`copy_study_frames`). Returns the analyses that were created.
+    """
+    # apply pending changes to existing base studies first
+    db.session.flush()
+    copy_frame(
+        "base_studies", base_studies.assign(year=base_studies["year"].astype("Int64"))
+    )
+    copy_frame(
+        "studies",
+        studies.drop(columns=[space], errors="ignore").assign(
+            year=studies["year"].astype("Int64"), public=True
+        ),
+    )
+    return copy_study_frames(studies, coord_data, space, workers=workers)
+
+
+def _coordinate_digests(coords):
+    """a digest of the peaks of every study, independent of the row order
+
+    ``coords`` holds the ``study_id``, ``table_id`` (analysis name),
+    ``order``, ``x``, ``y``, ``z`` and ``space`` of every peak.
+    """
+    coords = coords.assign(
+        table_id=coords["table_id"].astype(str),
+        x=coords["x"].astype(float).round(3),
+        y=coords["y"].astype(float).round(3),
+        z=coords["z"].astype(float).round(3),
+        space=coords["space"].fillna("").astype(str),
+    )
+    hashes = pd.util.hash_pandas_object(
+        coords[["table_id", "order", "x", "y", "z", "space"]], index=False
+    ).to_numpy()
+    return {
+        study_id: hashlib.sha1(np.sort(hashes[rows]).tobytes()).hexdigest()
+        for study_id, rows in coords.groupby("study_id").indices.items()
+    }
+
+
+def _source_coordinates(studies, coord_data, space):
+    """the peaks of ``coord_data`` as the rows of :func:`_coordinate_digests`"""
+    coords = coord_data.loc[coord_data.index.isin(studies["source_id"])]
+    coords = coords.rename_axis("source_id").reset_index()
+    coords["study_id"] = coords["source_id"].map(
+        dict(zip(studies["source_id"], studies["id"]))
+    )
+    # the order of the peaks within their table, as in study_frames
+    coords["order"] = coords.groupby(["study_id", "table_id"]).cumcount()
+    if space in studies.columns:
+        coords["space"] = coords["study_id"].map(
+            dict(zip(studies["id"], studies[space]))
         )
+    else:
+        coords["space"] = space
+    return coords
+
+
+def _stored_coordinates(source):
+    """the stored peaks of the studies of ``source``"""
+    rows = db.session.execute(
+        select(
+            Analysis.study_id,
+            Analysis.name,
+            Point.order,
+            Point.x,
+            Point.y,
+            Point.z,
+            Point.space,
+        )
+        .join(Point, Point.analysis_id == Analysis.id)
+        .join(Study, Study.id == Analysis.study_id)
+        .where(Study.source == source)
+    ).all()
+    return pd.DataFrame(
+        rows, columns=["study_id", "table_id", "order", "x", "y", "z", "space"]
+    )
 
-        space = data.get("coordinate_space", None)
-        # Process images
-        url = "https://neurovault.org/api/collections/{}/images/?format=json"
-        image_url = url.format(collection_id)
-        data = requests.get(image_url).json()
-        analyses = {}
-        images = []
-        conditions = set()
-        for img in data["results"]:
-            aname = img["name"]
-            if aname not in analyses:
-                condition = img.get("cognitive_paradigm_cogatlas")
-                analysis_kwargs = {
-                    "name": aname,
-                    "description": img["description"],
-                    "study": s,
-                }
 
-                analysis = Analysis(**analysis_kwargs)
-                if condition:
-                    cond = next(
-                        (
-                            cond
-                            for cond in list(conditions) + Condition.query.all()
-                            if cond.name == condition
-                        ),
-                        Condition(name=condition),
-                    )
-                    conditions.add(cond)
-
-                    analysis.analysis_conditions.append(
-                        AnalysisConditions(weight=1, condition=cond)
-                    )
-
-                analyses[aname] = analysis
-            else:
-                analysis = analyses[aname]
-            space = space or "Unknown" if img.get("not_mni", False) else "MNI"
-            type_ = img.get("map_type", "Unknown")
-            if re.match(r"\w\smap.*", type_):
-                type_ = type_[0]
-            image = Image(
-                url=img["file"],
-                space=space,
-                value_type=type_,
-                analysis=analysis,
-                data=img,
-                filename=op.basename(img["file"]),
-                add_date=parse_date(img["add_date"]),
-                entities=[
-                    Entity(level="group", label=analysis.name, analysis=analysis)
-                ],
+def _replace_coordinates(studies, coord_data, space):
+    """load the peaks of existing studies again
+
+    Analyses are matched by name (the table id) and keep their id, so the
+    notes taken on them survive; only their peaks are replaced. Analyses of
+    tables that are gone are deleted along with their notes.
+    Returns the analyses that were created and the ids of the deleted ones.
+    """
+    analyses, points, entities, point_entities = study_frames(
+        studies, coord_data, space
+    )
+    existing = {
+        (study_id, name): analysis_id
+        for analysis_id, study_id, name in db.session.execute(
+            select(Analysis.id, Analysis.study_id, Analysis.name).where(
+                Analysis.study_id.in_(list(studies["id"]))
             )
-            images.append(image)
+        )
+    }
+    kept = {
+        new_id: existing[key]
+        for new_id, key in zip(
+            analyses["id"], zip(analyses["study_id"], analyses["name"])
+        )
+        if key in existing
+    }
+    new_analyses = analyses[~analyses["id"].isin(list(kept))]
+    points["analysis_id"] = points["analysis_id"].replace(kept)
+    entities["analysis_id"] = entities["analysis_id"].replace(kept)
+    dropped = list(set(existing.values()) - set(kept.values()))
+
+    # the point entities go with their points and entities
+    kept_ids = list(kept.values())
+    for model in (Entity, Point):
+        table = model.__table__
+        db.session.execute(delete(table).where(table.c.analysis_id.in_(kept_ids)))
+    if dropped:
+        for model in (AnnotationAnalysis, AnalysisConditions):
+            table = model.__table__
+            db.session.execute(delete(table).where(table.c.analysis_id.in_(dropped)))
+        table = Analysis.__table__
+        db.session.execute(delete(table).where(table.c.id.in_(dropped)))
+    for table, df in zip(
+        STUDY_TABLES, (new_analyses, points, entities, point_entities)
+    ):
+        copy_frame(table, df)
+    return new_analyses, dropped
+
+
+# what a sync wrote: the ids of the studies of the dataset (in its order),
+# of the new and of the changed studies, the analyses created, the ids of the
+# analyses deleted and of the existing base studies the studies matched
+SyncedStudies = namedtuple(
+    "SyncedStudies", ["ids", "new", "changed", "analyses", "dropped", "base_ids"]
+)
 
-        db.session.add_all(
-            [base_study] + [s] + list(analyses.values()) + images + list(conditions)
+
+def _sync_studies(source, studies, base_studies, coord_data, space, workers=1):
+    """insert the new studies of ``source`` and update the changed ones
+
+    ``studies`` holds a row (with a pre-generated ``id``) per study of the
+    dataset, identified by its ``source_id``, and ``base_studies`` their
+    resolved base studies (see :func:`_resolve_base_studies`). Studies
+    already stored keep their id; those whose fields or base study changed
+    are updated, those whose peaks changed get them again. Studies no longer
+    in the dataset are left alone.
+
+    Returns the :data:`SyncedStudies`.
+    """
+    base_studies, new_base_studies = base_studies
+    stored = {
+        row.source_id: row
+        for row in db.session.execute(
+            select(
+                Study.source_id,
+                Study.id,
+                Study.base_study_id,
+                *(getattr(Study, f) for f in STUDY_FIELDS),
+            ).where(Study.source == source)
         )
-        db.session.commit()
-        all_studies[s.name] = s
-        return s
-
-    url = "https://neurovault.org/api/collections.json"
-    count = 0
-
-    while True:
-        data = requests.get(url).json()
-        url = data["next"]
-        studies = list(
-            filter(
-                None,
-                [
-                    add_collection(c)
-                    for c in data["results"]
-                    if c["DOI"] is not None and c["number_of_images"]
-                ],
-            )
+    }
+    studies = studies.assign(base_study_id=base_studies["id"].values)
+    known = studies["source_id"].isin(list(stored)).to_numpy()
+    studies.loc[known, "id"] = [stored[s].id for s in studies["source_id"][known]]
+    new_studies, old_studies = studies[~known], studies[known]
+
+    # studies whose fields (or base study) changed upstream
+    fields = ["base_study_id", *STUDY_FIELDS]
+    updates = []
+    for row in old_studies.itertuples(index=False):
+        values = {f: _python(getattr(row, f)) for f in fields}
+        previous = stored[row.source_id]
+        if any(values[f] != _python(getattr(previous, f)) for f in fields):
+            updates.append({"id": row.id, **values})
+
+    # and the ones whose peaks changed
+    stored_digests = _coordinate_digests(_stored_coordinates(source))
+    source_digests = _coordinate_digests(
+        _source_coordinates(old_studies, coord_data, space)
+    )
+    moved = [
+        study_id
+        for study_id in old_studies["id"]
+        if source_digests.get(study_id) != stored_digests.get(study_id)
+    ]
+
+    analyses = _copy_studies(
+        new_base_studies, new_studies, coord_data, space, workers=workers
+    )
+    # past the ORM listeners, see _finish_sync
+    db.session.bulk_update_mappings(Study, updates)
+    dropped = []
+    if moved:
+        moved_analyses, dropped = _replace_coordinates(
+            old_studies[old_studies["id"].isin(moved)], coord_data, space
         )
-        db.session.add_all(studies)
-        db.session.commit()
-        count += len(studies)
-        if (limit is not None and count >= int(limit)) or not url:
-            break
+        analyses = pd.concat([analyses, moved_analyses], ignore_index=True)
+
+    return SyncedStudies(
+        ids=list(studies["id"]),
+        new=list(new_studies["id"]),
+        changed=sorted({u["id"] for u in updates} | set(moved)),
+        analyses=analyses,
+        dropped=dropped,
+        base_ids=set(base_studies["id"]) - set(new_base_studies["id"]),
+    )
+
+
+def _source_studyset(name, **attrs):
+    """the studyset gathering the studies of a source (created on the first sync)"""
+    studyset = Studyset.query.filter_by(name=name, user_id=None).first()
+    if studyset is None:
+        studyset = Studyset(name=name, public=True, **attrs)
+        db.session.add(studyset)
+        db.session.flush()
+    return studyset
 
 
-def ingest_neurosynth(max_rows=None):
+def _finish_sync(state, version, studyset, synced, tags=()):
+    """commit a sync and invalidate what it changed
+
+    The studies were written past the ORM listeners, so the blank notes of
+    the other annotations of the studyset and the snapshots are handled here.
+    """
+    annotation_ids = insert_blank_notes_of(
+        db.session, study_ids=[*synced.new, *synced.changed]
+    )
+    invalidate_snapshots_of(
+        db.session, study_ids=synced.changed, studyset_ids=[studyset.id]
+    )
+    state.version = version
+    db.session.commit()
+    invalidate_studies(
+        synced.changed,
+        synced.dropped,
+        new=bool(synced.new),
+        tags=[
+            "/api/studysets/",
+            f"/api/studysets/{studyset.id}",
+            *(f"/api/base-studies/{id_}" for id_ in synced.base_ids),
+            *(f"/api/annotations/{id_}" for id_ in annotation_ids),
+            *tags,
+        ],
+    )
+
+
+def ingest_neurosynth(max_rows=None, workers=1):
+    """sync the studies, peaks and term features of Neurosynth
+
+    New studies are appended to the ``neurosynth`` studyset and their notes
+    to its annotation; the studies and notes that changed are updated.
+    """
     coords_file = (
         Path(__file__).parent.parent
         / "data"
@@ -176,10 +409,17 @@ def ingest_neurosynth(max_rows=None):
         / "data-neurosynth_version-7_vocab-terms_vocabulary.txt"
     )
 
+    # nothing changed since the last sync of the same files
+    state = get_sync_state("neurosynth")
+    version = dataset_version(
+        coords_file, metadata_file, feature_file, vocab_file, max_rows=max_rows
+    )
+    if state.version == version:
+        return
+
     coord_data = pd.read_table(coords_file, dtype={"id": str})
     coord_data = coord_data.set_index("id")
     metadata = pd.read_table(metadata_file, dtype={"id": str, "doi": str})
-    metadata = metadata.set_index("id")
     # load annotations
     features = sparse.load_npz(feature_file).todense()
     vocabulary = np.loadtxt(vocab_file, dtype=str, delimiter="\t")
@@ -188,172 +428,157 @@ def ingest_neurosynth(max_rows=None):
     if max_rows is not None:
         metadata = metadata.iloc[:max_rows]
         annotations = annotations.iloc[:max_rows]
+    metadata["doi"] = [
+        None if isinstance(doi, float) else doi for doi in metadata["doi"]
+    ]
+
+    records = [
+        {
+            "name": row.title,
+            "doi": row.doi,
+            "pmid": row.id,
+            "authors": row.authors,
+            "publication": row.journal,
+            "year": int(row.year),
+            "level": "group",
+        }
+        for row in metadata.itertuples()
+    ]
+    studies = pd.DataFrame(
+        {
+            "id": generate_ids(len(metadata)),
+            "name": metadata["title"],
+            "authors": metadata["authors"],
+            "year": metadata["year"],
+            "publication": metadata["journal"],
+            "pmid": metadata["id"],
+            "doi": metadata["doi"],
+            "source": "neurosynth",
+            "source_id": metadata["id"],
+            "level": "group",
+            "space": metadata["space"],
+        }
+    )
+    synced = _sync_studies(
+        "neurosynth",
+        studies,
+        _resolve_base_studies(records),
+        coord_data,
+        "space",
+        workers=workers,
+    )
 
-    # create studyset object
-    d = Studyset(
-        name="neurosynth",
+    studyset = _source_studyset(
+        "neurosynth",
         description="TODO",
         publication="Nature Methods",
         pmid="21706013",
         doi="10.1038/nmeth.1635",
         authors="Yarkoni T, Poldrack RA, Nichols TE, Van Essen DC, Wager TD",
-        public=True,
+    )
+    copy_frame(
+        "studyset_studies",
+        pd.DataFrame({"study_id": synced.new, "studyset_id": studyset.id}),
     )
 
-    studies = []
-    to_commit = []
-    all_studies = {s.doi: s for s in Study.query.filter_by(source="neurosynth").all()}
-    with db.session.no_autoflush:
-        for metadata_row, annotation_row in zip(
-            metadata.itertuples(), annotations.itertuples(index=False)
-        ):
-            base_study = None
-            doi = None if isinstance(metadata_row.doi, float) else metadata_row.doi
-            id_ = pmid = metadata_row.Index
-
-            # find an base_study based on available information
-            if doi is not None:
-                base_studies = BaseStudy.query.filter(
-                    or_(BaseStudy.doi == doi, BaseStudy.pmid == pmid)
-                ).all()
-
-                if len(base_studies) == 1:
-                    base_study = base_studies[0]
-                elif len(base_studies) > 1:
-                    source_base_study = base_studies[0]
-                    # do not overwrite the verions column
-                    # we want to append to this column
-                    columns = [
-                        c
-                        for c in source_base_study.__table__.columns
-                        if c != "versions"
-                    ]
-                    for ab in base_studies[1:]:
-                        for col in columns:
-                            source_attr = getattr(source_base_study, col)
-                            new_attr = getattr(ab, col)
-                            setattr(source_base_study, col, source_attr or new_attr)
-                        source_base_study.versions.extend(ab.versions)
-                        # delete the extraneous record
-                        db.session.delete(ab)
-
-            if doi is None:
-                base_study = BaseStudy.query.filter_by(pmid=pmid).one_or_none()
-
-            if base_study is None:
-                base_study = BaseStudy(
-                    name=metadata_row.title,
-                    doi=doi,
-                    pmid=pmid,
-                    authors=metadata_row.authors,
-                    publication=metadata_row.journal,
-                    year=metadata_row.year,
-                    level="group",
-                )
-            else:
-                # try to update the abstract study if information is missing
-                study_info = {
-                    "name": metadata_row.title,
-                    "doi": doi,
-                    "pmid": pmid,
-                    "authors": metadata_row.authors,
-                    "publication": metadata_row.journal,
-                    "year": metadata_row.year,
-                    "level": "group",
-                }
-                for col, value in study_info.items():
-                    source_attr = getattr(base_study, col)
-                    setattr(base_study, col, source_attr or value)
-            study_coord_data = coord_data.loc[[id_]]
-            md = {
-                "year": int(metadata_row.year),
-            }
-            if metadata_row.doi in all_studies:
-                continue
-            s = Study(
-                name=metadata_row.title,
-                authors=metadata_row.authors,
-                year=metadata_row.year,
-                publication=metadata_row.journal,
-                metadata=md,
-                pmid=id_,
-                doi=doi,
-                source="neurosynth",
-                source_id=id_,
-                level="group",
-                base_study=base_study,
-            )
-            analyses = []
-            points = []
-
-            for t_id, df in study_coord_data.groupby("table_id"):
-                a = Analysis(name=str(t_id), study=s)
-                analyses.append(a)
-                point_idx = 0
-                for _, p in df.iterrows():
-                    point = Point(
-                        x=p["x"],
-                        y=p["y"],
-                        z=p["z"],
-                        space=metadata_row.space,
-                        kind="unknown",
-                        analysis=a,
-                        entities=[Entity(label=a.name, level="group", analysis=a)],
-                        order=point_idx,
-                    )
-                    points.append(point)
-                    point_idx += 1
-            to_commit.extend(points)
-            to_commit.extend(analyses)
-            studies.append(s)
-
-        # add studies to studyset
-        d.studies = studies
-        db.session.add(d)
-        db.session.commit()
-
-        # create annotation object
+    # the same keys itertuples(...)._asdict() produces
+    note_keys = namedtuple("Pandas", list(annotations.columns), rename=True)._fields
+    note_types = (
+        {k: _check_type(v) for k, v in zip(note_keys, annotations.iloc[-1].tolist())}
+        if len(annotations)
+        else {}
+    )
+    annot = Annotation.query.filter_by(
+        name="neurosynth", studyset_id=studyset.id
+    ).first()
+    if annot is None:
         annot = Annotation(
             name="neurosynth",
             source="neurostore",
             source_id=None,
             description="TODO",
-            studyset=d,
+            studyset_id=studyset.id,
+            note_keys=note_types,
         )
-
-        # collect notes (single annotations) for each analysis
-        notes = []
-        for metadata_row, annotation_row in zip(
-            metadata.itertuples(), annotations.itertuples(index=False)
-        ):
-            id_ = metadata_row.Index
-            study_coord_data = coord_data.loc[[id_]]
-            study = Study.query.filter_by(pmid=id_).one()
-            studyset_study = StudysetStudy.query.filter_by(
-                study_id=study.id, studyset_id=d.id
-            ).one()
-
-            for analysis in study.analyses:
-                # add annotation
-                notes.append(
-                    AnnotationAnalysis(
-                        note=annotation_row._asdict(),
-                        analysis=analysis,
-                        annotation=annot,
-                        studyset_study=studyset_study,
-                    )
-                )
-
-        # add notes to annotation
-        annot.note_keys = {
-            k: _check_type(v) for k, v in annotation_row._asdict().items()
-        }
-        annot.annotation_analyses = notes
         db.session.add(annot)
-        db.session.commit()
+    else:
+        annot.note_keys = note_types
+    db.session.flush()
+
+    # the note of a study is its row of features, on each of its analyses
+    notes = annotations.to_numpy()
+    position = dict(zip(synced.ids, range(len(synced.ids))))
+
+    def note_of(study_id):
+        return dict(zip(note_keys, notes[position[study_id]].tolist()))
+
+    # notes of the analyses that were created
+    analyses = synced.analyses
+    for start in range(0, len(analyses), COPY_CHUNK_SIZE):
+        chunk = analyses.iloc[start : start + COPY_CHUNK_SIZE]  # noqa E203
+        copy_frame(
+            "annotation_analyses",
+            pd.DataFrame(
+                {
+                    "study_id": chunk["study_id"].values,
+                    "studyset_id": studyset.id,
+                    "annotation_id": annot.id,
+                    "analysis_id": chunk["id"].values,
+                    "note": to_json_column(note_of(s) for s in chunk["study_id"]),
+                }
+            ),
+        )
+
+    # and of the existing analyses whose features changed
+    new_ids = set(synced.new)
+    stored_notes = db.session.execute(
+        select(
+            AnnotationAnalysis.analysis_id,
+            AnnotationAnalysis.study_id,
+            AnnotationAnalysis.note,
+        ).where(AnnotationAnalysis.annotation_id == annot.id)
+    ).all()
+    changed_notes = [
+        {"a_id": annot.id, "an_id": analysis_id, "new_note": note_of(study_id)}
+        for analysis_id, study_id, note in stored_notes
+        if study_id in position
+        and study_id not in new_ids
+        and note != note_of(study_id)
+    ]
+    aa_table = AnnotationAnalysis.__table__
+    if changed_notes:
+        db.session.execute(
+            aa_table.update()
+            .where(
+                aa_table.c.annotation_id == bindparam("a_id"),
+                aa_table.c.analysis_id == bindparam("an_id"),
+            )
+            .values(note=bindparam("new_note")),
+            changed_notes,
+        )
+    if len(analyses) or changed_notes:
+        # versions the exports of the annotation
+        db.session.execute(
+            update(Annotation.__table__)
+            .where(Annotation.__table__.c.id == annot.id)
+            .values(updated_at=func.clock_timestamp())
+        )
+
+    _finish_sync(
+        state,
+        version,
+        studyset,
+        synced,
+        tags=["/api/annotations/", f"/api/annotations/{annot.id}"],
+    )
+
 
+def ingest_neuroquery(max_rows=None, workers=1):
+    """sync the studies and peaks of NeuroQuery
 
-def ingest_neuroquery(max_rows=None):
+    New studies are appended to the ``neuroquery`` studyset, the studies
+    that changed are updated.
+    """
     coords_file = (
         Path(__file__).parent.parent
         / "data"
@@ -365,66 +590,54 @@ def ingest_neuroquery(max_rows=None):
         / "data-neuroquery_version-1_metadata.tsv.gz"
     )
 
+    state = get_sync_state("neuroquery")
+    version = dataset_version(coords_file, metadata_file, max_rows=max_rows)
+    if state.version == version:
+        return
+
     coord_data = pd.read_table(coords_file, dtype={"id": str})
     coord_data = coord_data.set_index("id")
     metadata = pd.read_table(metadata_file, dtype={"id": str})
-    metadata = metadata.set_index("id")
 
     if max_rows is not None:
         metadata = metadata.iloc[:max_rows]
 
-    # all_studies = {s.pmid: s for s in Study.query.filter(source="neuroquery").all()}
-    for id_, metadata_row in metadata.iterrows():
-        base_study = BaseStudy.query.filter_by(pmid=id_).one_or_none()
-
-        if base_study is None:
-            base_study = BaseStudy(name=metadata_row["title"], level="group", pmid=id_)
-        study_coord_data = coord_data.loc[[id_]]
-        s = Study(
-            name=metadata_row["title"] or base_study.name,
-            source="neuroquery",
-            pmid=id_,
-            doi=base_study.doi,
-            year=base_study.year,
-            publication=base_study.publication,
-            authors=base_study.authors,
-            source_id=id_,
-            level="group",
-            base_study=base_study,
-        )
-        analyses = []
-        points = []
-
-        for t_id, df in study_coord_data.groupby("table_id"):
-            a = Analysis(name=str(t_id), study=s)
-            analyses.append(a)
-            point_idx = 0
-            for _, p in df.iterrows():
-                point = Point(
-                    x=p["x"],
-                    y=p["y"],
-                    z=p["z"],
-                    space="MNI",
-                    kind="unknown",
-                    analysis=a,
-                    entities=[Entity(label=a.name, level="group", analysis=a)],
-                    order=point_idx,
-                )
-                points.append(point)
-                point_idx += 1
-
-        db.session.add_all([s] + analyses + points)
-        db.session.commit()
-
-    # make a neuroquery studyset
-    d = Studyset(
-        name="neuroquery",
+    records = [
+        {"name": row.title, "doi": None, "pmid": row.id, "level": "group"}
+        for row in metadata.itertuples()
+    ]
+    # the study takes what neuroquery lacks from its base study
+    resolved = _resolve_base_studies(records, update=False)
+    base_studies = resolved[0]
+    studies = pd.DataFrame(
+        {
+            "id": generate_ids(len(metadata)),
+            "name": metadata["title"].where(
+                metadata["title"].notna(), base_studies["name"]
+            ),
+            "source": "neuroquery",
+            "pmid": metadata["id"],
+            "doi": base_studies["doi"],
+            "year": base_studies["year"],
+            "publication": base_studies["publication"],
+            "authors": base_studies["authors"],
+            "source_id": metadata["id"],
+            "level": "group",
+        }
+    )
+    synced = _sync_studies(
+        "neuroquery", studies, resolved, coord_data, "MNI", workers=workers
+    )
+
+    studyset = _source_studyset(
+        "neuroquery",
         description="TODO",
         publication="eLife",
         pmid="32129761",
         doi="10.7554/eLife.53385",
-        public=True,
-        studies=Study.query.filter_by(source="neuroquery").all(),
     )
-    db.session.add(d)
-    db.session.commit()
+    copy_frame(
+        "studyset_studies",
+        pd.DataFrame({"study_id": synced.new, "studyset_id": studyset.id}),
+    )
+    _finish_sync(state, version, studyset, synced)
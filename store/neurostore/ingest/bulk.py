@@ -0,0 +1,197 @@
+"""
+Bulk loading of ingested studies through PostgreSQL ``COPY``.
+
+Rows are assembled as pandas DataFrames with pre-generated primary keys and
+streamed into the database without building ORM objects.
+
+Building and rendering the rows of large datasets can be spread over worker
+processes: the studies are sharded by source id (PMID), every worker builds
+the rows of a shard and renders them to CSV, and the calling process, the
+only one talking to the database, streams the finished shards into COPY.
+"""
+import io
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import orjson
+import pandas as pd
+
+from neurostore.database import db
+from neurostore.models.data import generate_id
+
+# rows sent to the database per COPY statement
+COPY_CHUNK_SIZE = 50000
+# shards per worker, smaller shards keep the writer busy while workers build
+SHARDS_PER_WORKER = 4
+# the tables filled from the frames of study_frames, in insertion order
+STUDY_TABLES = ("analyses", "points", "entities", "point_entities")
+
+
+def generate_ids(n):
+    """pre-generate primary keys for ``n`` new records"""
+    return [generate_id() for _ in range(n)]
+
+
+def to_json_column(values):
+    """serialize python objects for a JSON(B) column"""
+    return [
+        None
+        if v is None
+        else orjson.dumps(v, option=orjson.OPT_SERIALIZE_NUMPY).decode("utf-8")
+        for v in values
+    ]
+
+
+def copy_frame(table, df, chunk_size=COPY_CHUNK_SIZE):
+    """load the rows of ``df`` into ``table`` with ``COPY ... FROM STDIN``
+
+    The columns of ``df`` must be named after columns of ``table``.
+    Missing values are loaded as NULL, so columns relying on a server side
+    default must be left out of ``df``.
+    """
+    if df.empty:
+        return
+
+    for start in range(0, len(df), chunk_size):
+        copy_csv(
+            table,
+            df.columns,
+            frame_csv(df.iloc[start : start + chunk_size]),  # noqa E203
+        )
+
+
+def frame_csv(df):
+    """render the rows of ``df`` as the CSV expected by :func:`copy_csv`"""
+    buf = io.StringIO()
+    df.to_csv(buf, index=False, header=False)
+    return buf.getvalue()
+
+
+def copy_csv(table, columns, data):
+    """load CSV rows (see :func:`frame_csv`) into ``columns`` of ``table``"""
+    if not data:
+        return
+    columns = ", ".join(f'"{c}"' for c in columns)
+    sql = f"COPY {table} ({columns}) FROM STDIN WITH (FORMAT csv)"
+    cursor = db.session.connection().connection.cursor()
+    cursor.copy_expert(sql, io.StringIO(data))
+
+
+def study_frames(studies, coordinates, space):
+    """build the analysis, point and entity rows of new studies
+
+    Parameters
+    ----------
+    studies : DataFrame
+        one row per study with the new study ``id`` and the ``source_id``
+        used to index ``coordinates``
+    coordinates : DataFrame
+        coordinate table indexed by source id, with ``table_id``, ``x``,
+        ``y`` and ``z`` columns
+    space : str
+        template space of the coordinates, or the name of a column of
+        ``studies`` holding the space of each study
+
+    Returns
+    -------
+    analyses, points, entities, point_entities : DataFrame
+        rows ready to be passed to :func:`copy_frame`
+    """
+    coords = coordinates.loc[coordinates.index.isin(studies["source_id"])]
+    coords = coords.rename_axis("source_id").reset_index()
+    coords["study_id"] = coords["source_id"].map(
+        dict(zip(studies["source_id"], studies["id"]))
+    )
+
+    # one analysis per table of each study
+    analyses = coords[["study_id", "table_id"]].drop_duplicates()
+    analyses = analyses.sort_values(["study_id", "table_id"])
+    analyses["id"] = generate_ids(len(analyses))
+    analyses["name"] = analyses["table_id"].astype(str)
+
+    coords = coords.merge(
+        analyses.rename(columns={"id": "analysis_id"}),
+        on=["study_id", "table_id"],
+        how="left",
+    )
+
+    if space in studies.columns:
+        coords["space"] = coords["study_id"].map(
+            dict(zip(studies["id"], studies[space]))
+        )
+    else:
+        coords["space"] = space
+
+    points = coords[["x", "y", "z", "space", "analysis_id"]].copy()
+    points["id"] = generate_ids(len(points))
+    points["kind"] = "unknown"
+    # keep the peaks in the order of the source table
+    points["order"] = coords.groupby("analysis_id").cumcount()
+
+    # every point gets its own group level entity
+    entities = coords[["analysis_id", "name"]].rename(columns={"name": "label"})
+    entities["id"] = generate_ids(len(entities))
+    entities["level"] = "group"
+
+    point_entities = points[["id"]].rename(columns={"id": "point"})
+    point_entities["entity"] = entities["id"].values
+
+    return (
+        analyses[["id", "name", "study_id"]],
+        points,
+        entities,
+        point_entities,
+    )
+
+
+def shard_of(source_ids, shards):
+    """the shard (from 0 to ``shards - 1``) of each source id"""
+    hashes = pd.util.hash_array(np.asarray(source_ids, dtype=object))
+    return (hashes % shards).astype(np.int64)
+
+
+def _render_shard(task):
+    """build the rows of a shard of studies and render them to CSV"""
+    studies, coordinates, space = task
+    frames = study_frames(studies, coordinates, space)
+    return frames[0], [(list(df.columns), frame_csv(df)) for df in frames]
+
+
+def copy_study_frames(studies, coordinates, space, workers=1):
+    """build the analysis, point and entity rows of new studies and COPY them
+
+    Takes the arguments of :func:`study_frames`. With more than one worker
+    the rows are built by a pool of ``workers`` processes, one shard of the
+    studies at a time.
+
+    Returns the analyses that were created.
+    """
+    if workers <= 1:
+        frames = study_frames(studies, coordinates, space)
+        for table, df in zip(STUDY_TABLES, frames):
+            copy_frame(table, df)
+        return frames[0]
+
+    shards = shard_of(studies["source_id"], workers * SHARDS_PER_WORKER)
+    # only send every worker the coordinates of its own shard
+    coordinates = coordinates.loc[coordinates.index.isin(studies["source_id"])]
+    tasks = []
+    for shard in np.unique(shards):
+        shard_studies = studies[shards == shard]
+        tasks.append(
+            (
+                shard_studies,
+                coordinates.loc[coordinates.index.isin(shard_studies["source_id"])],
+                space,
+            )
+        )
+
+    analyses = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for shard_analyses, rendered in pool.map(_render_shard, tasks):
+            for table, (columns, data) in zip(STUDY_TABLES, rendered):
+                copy_csv(table, columns, data)
+            analyses.append(shard_analyses)
+    if not analyses:
+        return study_frames(studies, coordinates, space)[0]
+    return pd.concat(analyses, ignore_index=True)
@@ -0,0 +1,316 @@
+"""
+Concurrent ingestion of NeuroVault collections.
+
+Collection pages are walked in order while the images of the collections
+are fetched by a pool of threads sharing one pooled, retrying HTTP session
+with a global rate limit. The records are built and committed in batches on
+the calling thread. After each batch the next page to process is written to
+an optional checkpoint file. Collections that are already stored are
+skipped, so a crashed run started again with the same checkpoint resumes
+where it stopped.
+
+Syncs are incremental: a complete pass records the latest modification date
+of the collections as the watermark of the source, the next sync skips the
+collections not modified since and updates the studies of those that were.
+"""
+import json
+import os
+import os.path as op
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from dateutil.parser import parse as parse_date
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from neurostore.database import db
+from neurostore.models import (
+    Analysis,
+    AnalysisConditions,
+    BaseStudy,
+    Condition,
+    Entity,
+    Image,
+    Study,
+)
+from neurostore.ingest.sync import get_sync_state, invalidate_studies
+
+NEUROVAULT_URL = "https://neurovault.org/api"
+# concurrent requests to neurovault
+WORKERS = 8
+# requests per second, shared by all the workers
+RATE_LIMIT = 10
+# collections committed at once
+BATCH_SIZE = 20
+
+
+class RateLimiter:
+    """space out calls so at most ``rate`` happen per second across threads"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_call = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class NeuroVaultClient:
+    """fetch NeuroVault API pages through a pooled session"""
+
+    def __init__(self, base_url=NEUROVAULT_URL, workers=WORKERS, rate=RATE_LIMIT):
+        self.base_url = base_url.rstrip("/")
+        self.limiter = RateLimiter(rate)
+        retry = Retry(
+            total=5,
+            backoff_factor=0.5,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=("GET",),
+        )
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=workers, max_retries=retry
+        )
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def get_json(self, url):
+        self.limiter.wait()
+        response = self.session.get(url, timeout=60)
+        response.raise_for_status()
+        return response.json()
+
+    def collections_url(self):
+        return f"{self.base_url}/collections.json"
+
+    def images(self, collection_id):
+        """every image of a collection (following the pagination)"""
+        url = f"{self.base_url}/collections/{collection_id}/images/?format=json"
+        images = []
+        while url:
+            data = self.get_json(url)
+            images.extend(data["results"])
+            url = data.get("next")
+        return images
+
+
+def _read_checkpoint(checkpoint):
+    if checkpoint is None or not op.exists(checkpoint):
+        return None
+    with open(checkpoint) as f:
+        return json.load(f)["next"]
+
+
+def _write_checkpoint(checkpoint, url):
+    if checkpoint is None:
+        return
+    tmp = checkpoint + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump({"next": url}, f)
+    os.replace(tmp, checkpoint)
+
+
+def modified_date(collection):
+    """when a collection last changed upstream (None when unknown)"""
+    value = collection.get("modify_date") or collection.get("add_date")
+    return parse_date(value) if value else None
+
+
+def build_study(collection, images, conditions, base_study=None, study=None):
+    """the study (and base study) records of a collection and its images
+
+    An existing ``study`` is updated in place, its analyses are replaced.
+    ``conditions`` indexes the known conditions by name, new conditions are
+    added to it.
+    """
+    data = dict(collection)
+    collection_id = data.pop("id")
+    doi = data.pop("DOI", None)
+    if base_study is None:
+        base_study = BaseStudy(
+            name=data.pop("name", None),
+            description=data.pop("description", None),
+            doi=doi,
+            authors=data.pop("authors", None),
+            publication=data.pop("journal_name", None),
+            metadata_=data,
+            level="group",
+        )
+    fields = dict(
+        name=data.pop("name", None) or base_study.name,
+        description=data.pop("description", None) or base_study.description,
+        doi=doi,
+        pmid=base_study.pmid,
+        authors=data.pop("authors", None) or base_study.authors,
+        publication=data.pop("journal_name", None) or base_study.publication,
+        source_id=str(collection_id),
+        source_updated_at=modified_date(collection),
+        metadata_=data,
+    )
+    if study is None:
+        study = Study(
+            source="neurovault", level="group", base_study=base_study, **fields
+        )
+    else:
+        for key, value in fields.items():
+            setattr(study, key, value)
+        for analysis in study.analyses:
+            for entity in analysis.entities:
+                db.session.delete(entity)
+        study.analyses = []
+
+    space = data.get("coordinate_space", None)
+    analyses = {}
+    for img in images:
+        aname = img["name"]
+        analysis = analyses.get(aname)
+        if analysis is None:
+            analysis = Analysis(name=aname, description=img["description"], study=study)
+            condition = img.get("cognitive_paradigm_cogatlas")
+            if condition:
+                if condition not in conditions:
+                    conditions[condition] = Condition(name=condition)
+                analysis.analysis_conditions.append(
+                    AnalysisConditions(weight=1, condition=conditions[condition])
+                )
+            analyses[aname] = analysis
+
+        space = space or "Unknown" if img.get("not_mni", False) else "MNI"
+        type_ = img.get("map_type", "Unknown")
+        if re.match(r"\w\smap.*", type_):
+            type_ = type_[0]
+        Image(
+            url=img["file"],
+            space=space,
+            value_type=type_,
+            analysis=analysis,
+            data=img,
+            filename=op.basename(img["file"]),
+            add_date=parse_date(img["add_date"]),
+            entities=[Entity(level="group", label=analysis.name, analysis=analysis)],
+        )
+    return study
+
+
+def ingest_neurovault(
+    verbose=False,
+    limit=20,
+    overwrite=False,
+    base_url=NEUROVAULT_URL,
+    workers=WORKERS,
+    rate=RATE_LIMIT,
+    batch_size=BATCH_SIZE,
+    checkpoint=None,
+):
+    """sync (at most ``limit``) NeuroVault collections with a DOI and images
+
+    Only collections modified upstream since the last complete sync (the
+    watermark) are fetched. New collections are ingested, modified ones
+    update their study, ``overwrite`` re-syncs every collection.
+    Returns the number of ingested or updated collections.
+    """
+    client = NeuroVaultClient(base_url, workers=workers, rate=rate)
+    state = get_sync_state("neurovault")
+    watermark = None if overwrite else state.watermark
+    latest = state.watermark
+    existing = {
+        source_id: (study_id, synced_at)
+        for study_id, source_id, synced_at in db.session.query(
+            Study.id, Study.source_id, Study.source_updated_at
+        ).filter_by(source="neurovault")
+    }
+    existing_dois = {
+        doi for (doi,) in db.session.query(Study.doi).filter_by(source="neurovault")
+    }
+    conditions = {c.name: c for c in Condition.query}
+    created, updated, replaced_analyses = False, [], []
+
+    def commit():
+        nonlocal created
+        db.session.commit()
+        if created or updated:
+            invalidate_studies(updated, replaced_analyses, new=created)
+        created = False
+        updated.clear()
+        replaced_analyses.clear()
+
+    def changed(collection):
+        """the id of the study to update, "" for a new collection, None to skip"""
+        modified = modified_date(collection)
+        if watermark and modified and modified <= watermark:
+            return None
+        study_id, synced_at = existing.get(str(collection["id"]), (None, None))
+        if study_id is not None:
+            unchanged = modified is None or (synced_at and modified <= synced_at)
+            return study_id if overwrite or not unchanged else None
+        if collection["DOI"] in existing_dois and not overwrite:
+            return None
+        return ""
+
+    url = _read_checkpoint(checkpoint) or client.collections_url()
+    count = 0
+    truncated = False
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while url and (limit is None or count < limit):
+            page = client.get_json(url)
+            collections = []
+            for c in page["results"]:
+                if not (c.get("DOI") and c.get("number_of_images")):
+                    continue
+                modified = modified_date(c)
+                if modified and (latest is None or modified > latest):
+                    latest = modified
+                study_id = changed(c)
+                if study_id is not None:
+                    collections.append((c, study_id))
+            if limit is not None and len(collections) > limit - count:
+                collections = collections[: limit - count]
+                truncated = True
+
+            image_lists = pool.map(client.images, [c["id"] for c, _ in collections])
+            pending = 0
+            for (collection, study_id), images in zip(collections, image_lists):
+                if study_id:
+                    study = db.session.get(Study, study_id)
+                    base_study = study.base_study
+                    updated.append(study_id)
+                    replaced_analyses.extend(a.id for a in study.analyses)
+                else:
+                    study = None
+                    base_study = BaseStudy.query.filter_by(
+                        doi=collection["DOI"]
+                    ).first()
+                    created = True
+                study = build_study(collection, images, conditions, base_study, study)
+                db.session.add(study)
+                existing_dois.add(collection["DOI"])
+                count += 1
+                pending += 1
+                if verbose:
+                    action = "Updated" if study_id else "Ingested"
+                    print(f"{action} collection {collection['id']} ({study.name})")
+                if pending >= batch_size:
+                    commit()
+                    pending = 0
+
+            commit()
+            # a page cut short by the limit is resumed from its start
+            _write_checkpoint(checkpoint, url if truncated else page.get("next"))
+            url = page.get("next")
+
+    if url is None and not truncated:
+        # only a complete pass has seen every change up to the watermark
+        state.watermark = latest
+        db.session.commit()
+        if checkpoint is not None and op.exists(checkpoint):
+            os.remove(checkpoint)
+    return count
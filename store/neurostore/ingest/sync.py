@@ -0,0 +1,74 @@
+"""
+Bookkeeping for the incremental sync of external sources.
+
+Every source keeps a ``SyncState`` row: a watermark (the latest upstream
+modification date ingested, for NeuroVault) and a version (a hash of the
+dataset files ingested, for Neurosynth and NeuroQuery). A sync only fetches
+and writes what changed since, and invalidates the cached responses of the
+records it wrote. Neurosynth and NeuroQuery studies are matched on their
+source id and compared field by field (and peak by peak) with the dataset.
+The studyset snapshots are versioned by the model event listeners as the
+records change, or explicitly for the rows written with ``COPY``.
+"""
+import hashlib
+
+import sqlalchemy as sa
+
+from neurostore.database import db
+from neurostore.models import Analysis, Study, StudysetStudy, SyncState
+
+
+def get_sync_state(source):
+    """the sync state of ``source`` (added to the session on the first sync)"""
+    state = db.session.get(SyncState, source)
+    if state is None:
+        state = SyncState(source=source)
+        db.session.add(state)
+    return state
+
+
+def dataset_version(*paths, **params):
+    """hash of the dataset files (and ingestion parameters) of a sync"""
+    digest = hashlib.sha256()
+    for path in paths:
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+    for key, value in sorted(params.items()):
+        digest.update(f"{key}={value}".encode("utf8"))
+    return digest.hexdigest()
+
+
+def invalidate_studies(study_ids, analysis_ids=(), new=False, tags=()):
+    """drop the cached responses of the synced studies and what contains them
+
+    ``new`` studies can only show up in the list responses, changed ones are
+    invalidated along with their base studies, analyses and studysets.
+    ``tags`` are invalidated as well.
+    """
+    # the cache lives on the app, which importing the ingestion must not create
+    from neurostore.resources.caching import invalidate_cache_tags
+
+    tags = list(tags)
+    if new:
+        tags.extend(["/api/studies/", "/api/base-studies/"])
+    study_ids = list(study_ids)
+    if study_ids:
+        base_study_ids = db.session.execute(
+            sa.select(Study.base_study_id).where(Study.id.in_(study_ids))
+        ).scalars()
+        studyset_ids = db.session.execute(
+            sa.select(StudysetStudy.studyset_id).where(
+                StudysetStudy.study_id.in_(study_ids)
+            )
+        ).scalars()
+        analysis_ids = set(analysis_ids) | set(
+            db.session.execute(
+                sa.select(Analysis.id).where(Analysis.study_id.in_(study_ids))
+            ).scalars()
+        )
+        tags.extend(f"/api/studies/{id_}" for id_ in study_ids)
+        tags.extend(f"/api/base-studies/{id_}" for id_ in base_study_ids if id_)
+        tags.extend(f"/api/studysets/{id_}" for id_ in studyset_ids)
+        tags.extend(f"/api/analyses/{id_}" for id_ in analysis_ids)
+    invalidate_cache_tags(*tags)
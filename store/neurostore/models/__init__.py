@@ -12,6 +12,9 @@ from .data import (
     AnnotationAnalysis,
     PointValue,
     AnalysisConditions,
+    StudySnapshotBlob,
+    StudysetSnapshotBlob,
+    SyncState,
 )
 from .auth import User, Role
 
@@ -29,6 +32,9 @@ __all__ = [
     "AnnotationAnalysis",
     "PointValue",
     "AnalysisConditions",
+    "StudySnapshotBlob",
+    "StudysetSnapshotBlob",
+    "SyncState",
     "User",
     "Role",
 ]
@@ -1,3 +1,5 @@
+import math
+
 import sqlalchemy as sa
 from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy import ForeignKeyConstraint
@@ -12,6 +14,38 @@ from .migration_types import TSVector
 from ..database import db
 
 
+# weighted search document: title (A), abstract (B), authors and journal (C)
+SEARCH_VECTOR = (
+    "setweight(to_tsvector('english', coalesce(name, '')), 'A') || "
+    "setweight(to_tsvector('english', coalesce(description, '')), 'B') || "
+    "setweight(to_tsvector('english', "
+    "coalesce(authors, '') || ' ' || coalesce(publication, '')), 'C')"
+)
+# columns searched with ilike '%...%' that get a trigram index
+TRIGRAM_COLUMNS = ("name", "authors", "publication")
+
+
+def trigram_indexes(table):
+    """GIN trigram indexes serving substring searches on ``TRIGRAM_COLUMNS``"""
+    return tuple(
+        sa.Index(
+            f"ix_{table}_{column}_trgm",
+            column,
+            postgresql_using="gin",
+            postgresql_ops={column: "gin_trgm_ops"},
+        )
+        for column in TRIGRAM_COLUMNS
+    )
+
+
+# the trigram operator classes come from the pg_trgm extension
+sa.event.listen(
+    db.Model.metadata,
+    "before_create",
+    sa.DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm"),
+)
+
+
 def _check_type(x):
     """check annotation key type"""
     if isinstance(x, (int, float)):
@@ -26,10 +60,61 @@ def _check_type(x):
         return None
 
 
+def validate_notes(note_keys, notes):
+    """check a batch of notes against ``note_keys``
+
+    Key sets are compared once per distinct set of keys and values are type
+    checked once per distinct python type of each column.
+    Raises ``ValueError`` describing the first inconsistency.
+    """
+    notes = [note or {} for note in notes]
+    expected = frozenset(note_keys)
+    for keys in {frozenset(note) for note in notes}:
+        if keys != expected:
+            msg = "ERROR: "
+            if expected - keys:
+                msg = msg + f"Annotations are missing these keys: {expected - keys}. "
+            if keys - expected:
+                msg = msg + f"Annotations have extra keys: {keys - expected}."
+            raise ValueError(msg)
+
+    for key, _type in note_keys.items():
+        # one representative value of every type found in the column
+        samples = {type(note[key]): note[key] for note in notes}
+        for value in samples.values():
+            value_type = _check_type(value)
+            if value_type is not None and value_type != _type:
+                raise ValueError(f"value for key {key} is not of type {_type}")
+
+
 def generate_id():
     return shortuuid.ShortUUID().random(length=12)
 
 
+# edge (in mm) of the cubic grid cells points are bucketed into
+VOXEL_SIZE = 10
+# cells per axis, coordinates beyond the grid fall into the edge cells
+VOXEL_GRID = 128
+
+
+def voxel_axis(coordinate):
+    """grid cell index of a coordinate along one axis"""
+    cell = math.floor(coordinate / VOXEL_SIZE) + VOXEL_GRID // 2
+    return max(0, min(VOXEL_GRID - 1, cell))
+
+
+def voxel_key(i, j, k):
+    """single integer key of the grid cell (i, j, k)"""
+    return (i * VOXEL_GRID + j) * VOXEL_GRID + k
+
+
+def _voxel_axis_sql(column):
+    return (
+        f"greatest(0, least({VOXEL_GRID - 1}, "
+        f"floor({column} / {VOXEL_SIZE})::integer + {VOXEL_GRID // 2}))"
+    )
+
+
 class BaseMixin(object):
     id = db.Column(db.Text, primary_key=True, index=True, default=generate_id)
     created_at = db.Column(db.DateTime(timezone=True), server_default=func.now())
@@ -132,10 +217,7 @@ class BaseStudy(BaseMixin, db.Model):
     user_id = db.Column(db.Text, db.ForeignKey("users.external_id"), index=True)
     __ts_vector__ = db.Column(
         TSVector(),
-        db.Computed(
-            "to_tsvector('english', coalesce(name, '') || ' ' || coalesce(description, ''))",
-            persisted=True,
-        ),
+        db.Computed(SEARCH_VECTOR, persisted=True),
     )
 
     user = relationship("User", backref=backref("base_studies"))
@@ -146,6 +228,7 @@ class BaseStudy(BaseMixin, db.Model):
         db.CheckConstraint(level.in_(["group", "meta"])),
         db.UniqueConstraint("doi", "pmid", name="doi_pmid"),
         sa.Index("ix_base_study___ts_vector__", __ts_vector__, postgresql_using="gin"),
+        *trigram_indexes("base_studies"),
     )
 
 
@@ -169,10 +252,7 @@ class Study(BaseMixin, db.Model):
     user_id = db.Column(db.Text, db.ForeignKey("users.external_id"), index=True)
     __ts_vector__ = db.Column(
         TSVector(),
-        db.Computed(
-            "to_tsvector('english', coalesce(name, '') || ' ' || coalesce(description, ''))",
-            persisted=True,
-        ),
+        db.Computed(SEARCH_VECTOR, persisted=True),
     )
     user = relationship("User", backref=backref("studies"))
     analyses = relationship(
@@ -184,6 +264,7 @@ class Study(BaseMixin, db.Model):
     __table_args__ = (
         db.CheckConstraint(level.in_(["group", "meta"])),
         sa.Index("ix_study___ts_vector__", __ts_vector__, postgresql_using="gin"),
+        *trigram_indexes("studies"),
     )
 
 
@@ -316,6 +397,15 @@ class Point(BaseMixin, db.Model):
     cluster_size = db.Column(db.Float)
     subpeak = db.Column(db.Boolean)
     order = db.Column(db.Integer)
+    # grid cell of the peak (see voxel_key) for indexed spatial searches
+    voxel = db.Column(
+        db.Integer,
+        db.Computed(
+            f"({_voxel_axis_sql('x')} * {VOXEL_GRID} + {_voxel_axis_sql('y')}) "
+            f"* {VOXEL_GRID} + {_voxel_axis_sql('z')}",
+            persisted=True,
+        ),
+    )
 
     entities = relationship(
         "Entity", secondary=PointEntityMap, backref=backref("points")
@@ -323,6 +413,9 @@ class Point(BaseMixin, db.Model):
     user_id = db.Column(db.Text, db.ForeignKey("users.external_id"))
     user = relationship("User", backref=backref("points"))
 
+    # spaces are matched case insensitively (see resources.spatial)
+    __table_args__ = (sa.Index("ix_points_voxel_space", voxel, sa.func.upper(space)),)
+
 
 class Image(BaseMixin, db.Model):
     __tablename__ = "images"
@@ -354,6 +447,42 @@ class PointValue(BaseMixin, db.Model):
     user = relationship("User", backref=backref("point_values"))
 
 
+# materialized, serialized snapshots of nested studysets.
+# a row with no data (or no row at all) needs to be rebuilt; writers
+# bump the version so in-flight rebuilds cannot store stale data.
+class StudySnapshotBlob(db.Model):
+    __tablename__ = "study_snapshot_blobs"
+
+    study_id = db.Column(
+        db.Text, db.ForeignKey("studies.id", ondelete="CASCADE"), primary_key=True
+    )
+    version = db.Column(db.Integer, nullable=False, default=0)
+    data = db.Column(db.LargeBinary)
+
+
+class StudysetSnapshotBlob(db.Model):
+    __tablename__ = "studyset_snapshot_blobs"
+
+    studyset_id = db.Column(
+        db.Text, db.ForeignKey("studysets.id", ondelete="CASCADE"), primary_key=True
+    )
+    version = db.Column(db.Integer, nullable=False, default=0)
+    data = db.Column(db.LargeBinary)
+
+
+# progress of the incremental sync of each external source: the latest
+# upstream modification seen and the version (hash) of the dataset ingested
+class SyncState(db.Model):
+    __tablename__ = "sync_states"
+
+    source = db.Column(db.String, primary_key=True)
+    watermark = db.Column(db.DateTime(timezone=True))
+    version = db.Column(db.String)
+    updated_at = db.Column(
+        db.DateTime(timezone=True), server_default=func.now(), onupdate=func.now()
+    )
+
+
 from . import event_listeners  # noqa E402
 
 del event_listeners
@@ -1,7 +1,26 @@
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy import event
-from .data import AnnotationAnalysis, Annotation, Studyset, Study, _check_type
-from ..database import db
+from sqlalchemy.orm import Session, object_session
+from .data import (
+    AnnotationAnalysis,
+    Annotation,
+    BaseStudy,
+    Studyset,
+    StudysetStudy,
+    Study,
+    Analysis,
+    AnalysisConditions,
+    Condition,
+    Entity,
+    Point,
+    PointValue,
+    Image,
+    StudySnapshotBlob,
+    StudysetSnapshotBlob,
+    validate_notes,
+)
 
 
 def check_note_columns(mapper, connection, annotation):
@@ -15,96 +34,335 @@ def check_note_columns(mapper, connection, annotation):
         return
     if not note_keys and any_notes:
         raise SQLAlchemyError("Cannot have empty note_keys with annotations")
-    for aa in aa_list:
-        if set(note_keys.keys()) != set(aa.note.keys()):
-            msg = "ERROR: "
-            nk_set = set(note_keys.keys())
-            aa_set = set(aa.note.keys())
-            if nk_set - aa_set:
-                msg = msg + f"Annotations are missing these keys: {nk_set - aa_set}. "
-            if aa_set - nk_set:
-                msg = msg + f"Annotations have extra keys: {aa_set - nk_set}."
-            raise SQLAlchemyError(msg)
-
-        for key, _type in note_keys.items():
-            aa_type = _check_type(aa.note[key])
-            if aa_type is not None and aa_type != _type:
-                raise SQLAlchemyError(f"value for key {key} is not of type {_type}")
+    try:
+        validate_notes(note_keys, [aa.note for aa in aa_list])
+    except ValueError as e:
+        raise SQLAlchemyError(str(e))
+
+
+def _queue_blank_notes(target):
+    """remember a record whose annotations may be missing notes"""
+    sa.inspect(target).info["blank_notes"] = True
 
 
 def create_blank_notes(studyset, annotation, initiator):
-    if not annotation.annotation_analyses:
-        annotation_analyses = []
-        for dset_study in studyset.studyset_studies:
-            for analysis in dset_study.study.analyses:
-                annotation_analyses.append(
-                    AnnotationAnalysis(
-                        study_id=dset_study.study.id,
-                        studyset_id=studyset.id,
-                        annotation_id=annotation.id,
-                        analysis_id=analysis.id,
-                        analysis=analysis,
-                        annotation=annotation,
-                        studyset_study=dset_study,
-                    )
-                )
-        # cache.delete(f"/api/annotations/{annotation.id}")
-        db.session.add_all(annotation_analyses)
+    """give a new annotation a blank note for every analysis of its studyset
+
+    The notes are created in memory (so they can be filled in before the
+    flush) from a single query, ``fill_blank_notes`` sets the notes left
+    empty once the note keys are known. Studysets that are not saved yet are
+    left to ``insert_blank_notes``.
+    """
+    _queue_blank_notes(annotation)
+    session = object_session(studyset)
+    if session is None or studyset.id is None or annotation.annotation_analyses:
+        return
+    with session.no_autoflush:
+        pairs = session.execute(
+            sa.select(Analysis.study_id, Analysis.id)
+            .join(StudysetStudy, StudysetStudy.study_id == Analysis.study_id)
+            .where(StudysetStudy.studyset_id == studyset.id)
+        ).all()
+    for study_id, analysis_id in pairs:
+        AnnotationAnalysis(
+            study_id=study_id,
+            studyset_id=studyset.id,
+            analysis_id=analysis_id,
+            annotation=annotation,
+        )
+
+
+def fill_blank_notes(session, flush_context, instances):
+    """map the note keys to null in the notes of new annotations left empty"""
+    for obj in session.new:
+        if not isinstance(obj, Annotation):
+            continue
+        keys = obj.note_keys or {}
+        for aa in obj.annotation_analyses:
+            if aa.note is None:
+                aa.note = {k: None for k in keys}
 
 
 def add_annotation_analyses_studyset(studyset, studies, collection_adapter):
-    all_analyses = [analysis for study in studies for analysis in study.analyses]
-    existing_analyses = [
-        analysis for study in studyset.studies for analysis in study.analyses
-    ]
-    new_analyses = set(all_analyses) - set(existing_analyses)
-    new_aas = []
-    for annot in studyset.annotations:
-        # cache.delete(f"/api/annotations/{annot.id}")
-        for analysis in new_analyses:
-            keys = annot.note_keys.keys()
-            new_aas.append(
-                AnnotationAnalysis(
-                    study_id=analysis.study_id,
-                    studyset_id=studyset.id,
-                    annotation_id=annot.id,
-                    analysis_id=analysis.id,
-                    note={} if not keys else {k: None for k in keys},
-                    analysis=analysis,
-                    annotation=annot,
-                )
-            )
-    # cache.delete("/api/annotations/")
-    if new_aas:
-        db.session.add_all(new_aas)
+    _queue_blank_notes(studyset)
 
 
 def add_annotation_analyses_study(study, analyses, collection_adapter):
-    new_analyses = set(analyses) - set([a for a in study.analyses])
+    _queue_blank_notes(study)
+
 
-    all_annotations = set(
-        [annot for sss in study.studyset_studies for annot in sss.studyset.annotations]
+# the keys of the annotation mapped to null ({} when there are no keys)
+BLANK_NOTE = sa.literal_column(
+    "COALESCE((SELECT jsonb_object_agg(key, 'null'::jsonb) "
+    "FROM jsonb_object_keys(annotations.note_keys) AS key), '{}'::jsonb)"
+)
+
+
+def insert_blank_notes(session, flush_context):
+    """add a blank note for every analysis of the queued records' annotations
+    that does not have one yet"""
+    queued = {Annotation: set(), Studyset: set(), Study: set()}
+    for obj in list(session.new) + list(session.dirty):
+        if sa.inspect(obj).info.pop("blank_notes", False):
+            queued[type(obj)].add(obj.id)
+    if not any(queued.values()):
+        return
+    annotation_ids = insert_blank_notes_of(
+        session,
+        annotation_ids=queued[Annotation],
+        studyset_ids=queued[Studyset],
+        study_ids=queued[Study],
     )
+    session.info.setdefault("touched_annotations", set()).update(annotation_ids)
 
-    new_aas = []
-    for analysis in new_analyses:
-        for annot in all_annotations:
-            # cache.delete(f"/api/annotations/{annot.id}")
-            keys = annot.note_keys.keys()
-            new_aas.append(
-                AnnotationAnalysis(
-                    study_id=study.id,
-                    studyset_id=annot.studyset_id,
-                    annotation_id=annot.id,
-                    analysis_id=analysis.id,
-                    note={} if not keys else {k: None for k in keys},
-                    analysis=analysis,
-                    annotation=annot,
-                )
+
+def insert_blank_notes_of(session, annotation_ids=(), studyset_ids=(), study_ids=()):
+    """add the missing blank notes of the annotations (of the studysets, or
+    containing the studies) in a single INSERT ... SELECT
+
+    Also used for analyses written without the ORM (e.g. COPY). Returns the
+    ids of the annotations that got notes.
+    """
+    annotations = Annotation.__table__
+    studyset_studies = StudysetStudy.__table__
+    analyses = Analysis.__table__
+    annotation_analyses = AnnotationAnalysis.__table__
+    missing = (
+        sa.select(
+            annotations.c.id,
+            analyses.c.id,
+            studyset_studies.c.study_id,
+            studyset_studies.c.studyset_id,
+            BLANK_NOTE,
+        )
+        .select_from(
+            annotations.join(
+                studyset_studies,
+                studyset_studies.c.studyset_id == annotations.c.studyset_id,
+            ).join(analyses, analyses.c.study_id == studyset_studies.c.study_id)
+        )
+        .where(
+            sa.or_(
+                annotations.c.id.in_(list(annotation_ids)),
+                annotations.c.studyset_id.in_(list(studyset_ids)),
+                studyset_studies.c.study_id.in_(list(study_ids)),
+            ),
+            ~sa.exists().where(
+                annotation_analyses.c.annotation_id == annotations.c.id,
+                annotation_analyses.c.analysis_id == analyses.c.id,
+            ),
+        )
+    )
+    stmt = (
+        insert(annotation_analyses)
+        .from_select(
+            ["annotation_id", "analysis_id", "study_id", "studyset_id", "note"],
+            missing,
+        )
+        .on_conflict_do_nothing()
+        .returning(annotation_analyses.c.annotation_id)
+    )
+    return set(session.execute(stmt).scalars())
+
+
+def _mark_stale(target, kind, record_id):
+    """remember a record whose nested studyset snapshots need rebuilding"""
+    session = object_session(target)
+    if session is None or record_id is None:
+        return
+    stale = session.info.setdefault("stale_snapshots", {})
+    stale.setdefault(kind, set()).add(record_id)
+
+
+def _stale_listener(kind, attr):
+    def listener(mapper, connection, target):
+        _mark_stale(target, kind, getattr(target, attr))
+
+    return listener
+
+
+def mark_deleted_studies_stale(session, flush_context, instances):
+    """studyset links of deleted studies are gone after the flush, look them up now"""
+    study_ids = [obj.id for obj in session.deleted if isinstance(obj, Study)]
+    if not study_ids:
+        return
+    studyset_ids = session.execute(
+        sa.select(StudysetStudy.studyset_id).where(
+            StudysetStudy.study_id.in_(study_ids)
+        )
+    ).scalars()
+    session.info.setdefault("stale_snapshots", {}).setdefault("studyset", set()).update(
+        studyset_ids
+    )
+
+
+def _bump_snapshot_versions(session, model, key, ids_select):
+    table = model.__table__
+    stmt = insert(table).from_select([key, "version"], ids_select)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[key],
+        set_={"version": table.c.version + 1, "data": None},
+    )
+    session.execute(stmt)
+
+
+def invalidate_snapshots(session, flush_context):
+    """bump the snapshot versions of every study/studyset touched by the flush"""
+    stale = session.info.pop("stale_snapshots", None)
+    if stale:
+        _invalidate_stale(session, stale)
+
+
+def invalidate_snapshots_of(session, study_ids=(), studyset_ids=()):
+    """mark the snapshots of records written without the ORM (e.g. COPY) stale"""
+    _invalidate_stale(session, {"study": set(study_ids), "studyset": set(studyset_ids)})
+
+
+def _invalidate_stale(session, stale):
+    # points and conditions are served within their analyses
+    analysis_queries = []
+    if stale.get("point"):
+        analysis_queries.append(
+            sa.select(Point.analysis_id).where(Point.id.in_(stale["point"]))
+        )
+    if stale.get("condition"):
+        analysis_queries.append(
+            sa.select(AnalysisConditions.analysis_id).where(
+                AnalysisConditions.condition_id.in_(stale["condition"])
             )
-    # cache.delete("/api/annotations/")
-    if new_aas:
-        db.session.add_all(new_aas)
+        )
+    analysis_ids = set(stale.get("analysis", ()))
+    if analysis_queries:
+        analysis_ids.update(session.execute(sa.union(*analysis_queries)).scalars())
+    analysis_ids.discard(None)
+    _add_changed_paths(session, "analyses", analysis_ids)
+
+    study_queries = []
+    if stale.get("study"):
+        study_queries.append(sa.select(Study.id).where(Study.id.in_(stale["study"])))
+    if analysis_ids:
+        study_queries.append(
+            sa.select(Analysis.study_id).where(Analysis.id.in_(analysis_ids))
+        )
+
+    study_ids = set()
+    if study_queries:
+        study_ids = set(session.execute(sa.union(*study_queries)).scalars()) - {None}
+
+    if study_ids:
+        _bump_snapshot_versions(
+            session,
+            StudySnapshotBlob,
+            "study_id",
+            sa.select(Study.id, sa.literal(1)).where(Study.id.in_(study_ids)),
+        )
+        _add_changed_paths(session, "studies", study_ids)
+        _add_changed_paths(
+            session,
+            "base-studies",
+            session.execute(
+                sa.select(Study.base_study_id).where(Study.id.in_(study_ids))
+            ).scalars(),
+        )
+
+    studyset_ids = set(stale.get("studyset", set()))
+    if study_ids:
+        studyset_ids.update(
+            session.execute(
+                sa.select(StudysetStudy.studyset_id).where(
+                    StudysetStudy.study_id.in_(study_ids)
+                )
+            ).scalars()
+        )
+
+    if studyset_ids:
+        _bump_snapshot_versions(
+            session,
+            StudysetSnapshotBlob,
+            "studyset_id",
+            sa.select(Studyset.id, sa.literal(1)).where(Studyset.id.in_(studyset_ids)),
+        )
+        # for the writer to queue (see resources.snapshots.queue_stale_snapshots)
+        session.info.setdefault("stale_studysets", set()).update(studyset_ids)
+        _add_changed_paths(session, "studysets", studyset_ids)
+        _add_changed_paths(
+            session,
+            "annotations",
+            session.execute(
+                sa.select(Annotation.id).where(Annotation.studyset_id.in_(studyset_ids))
+            ).scalars(),
+        )
+
+
+def touch_annotation(mapper, connection, target):
+    """remember an annotation whose notes changed in this flush"""
+    session = object_session(target)
+    if session is None or target.annotation_id is None:
+        return
+    session.info.setdefault("touched_annotations", set()).add(target.annotation_id)
+
+
+def bump_annotations(session, flush_context):
+    """mark annotations with changed notes as updated (versions their exports)"""
+    annotation_ids = session.info.pop("touched_annotations", None)
+    if not annotation_ids:
+        return
+    _add_changed_paths(session, "annotations", annotation_ids)
+    session.execute(
+        sa.update(Annotation.__table__).where(
+            Annotation.__table__.c.id.in_(annotation_ids)
+        )
+        # clock_timestamp, unlike now(), changes within a transaction
+        .values(updated_at=sa.func.clock_timestamp())
+    )
+
+
+# records served at a path of their own, changes to the records nested in
+# them are mapped to their paths when their snapshots are invalidated
+VERSIONED_MODELS = (Studyset, Annotation, BaseStudy, Study, Analysis)
+
+
+def _add_changed_paths(session, collection, ids):
+    paths = session.info.setdefault("changed_paths", set())
+    paths.update(f"/api/{collection}/{id_}" for id_ in ids if id_)
+
+
+def collect_changed_paths(session, flush_context):
+    """remember the API paths (and owners) of the records written by the flush"""
+    # dirty records assigned the values they already had did not change
+    dirty = [obj for obj in session.dirty if session.is_modified(obj)]
+    for obj in list(session.new) + dirty + list(session.deleted):
+        if isinstance(obj, VERSIONED_MODELS):
+            collection = obj.__tablename__.replace("_", "-")
+            _add_changed_paths(session, collection, [obj.id])
+        if hasattr(obj, "public") and obj.user_id:
+            owners = session.info.setdefault("changed_owners", set())
+            owners.add((obj.__tablename__, obj.user_id))
+
+
+def invalidate_changed_paths(session):
+    """drop the cached responses (and bump the versions) of committed records
+
+    This covers every write made through a session, whether or not it went
+    through a view.
+    """
+    paths = session.info.pop("changed_paths", None)
+    owners = session.info.pop("changed_owners", None)
+    if not (paths or owners):
+        return
+    # the cache lives on the app, which importing the models must not create
+    from ..resources.caching import forget_private_owners, invalidate_cache_tags
+
+    forget_private_owners(owners)
+    if paths:
+        invalidate_cache_tags(*paths)
+
+
+def discard_changed_paths(session, previous_transaction):
+    # a rolled back savepoint may leave writes to commit, keep their paths
+    if not previous_transaction.nested:
+        session.info.pop("changed_paths", None)
+        session.info.pop("changed_owners", None)
 
 
 # ensure all keys are the same across all notes
@@ -119,3 +377,44 @@ event.listen(Studyset.annotations, "append", create_blank_notes)
 event.listen(Studyset.studies, "bulk_replace", add_annotation_analyses_studyset)
 
 event.listen(Study.analyses, "bulk_replace", add_annotation_analyses_study)
+
+event.listen(Session, "before_flush", fill_blank_notes)
+
+# the queued notes are inserted once the records have ids
+event.listen(Session, "after_flush", insert_blank_notes)
+
+
+# mark nested studyset snapshots stale when any part of them changes
+ALL_WRITES = ("after_insert", "after_update", "after_delete")
+for model, kind, attr, events in [
+    (Study, "study", "id", ("after_update",)),
+    (Analysis, "study", "study_id", ALL_WRITES),
+    (Point, "analysis", "analysis_id", ALL_WRITES),
+    (Image, "analysis", "analysis_id", ALL_WRITES),
+    (Entity, "analysis", "analysis_id", ALL_WRITES),
+    (PointValue, "point", "point_id", ALL_WRITES),
+    (AnalysisConditions, "analysis", "analysis_id", ALL_WRITES),
+    (Condition, "condition", "id", ("after_update",)),
+    (Studyset, "studyset", "id", ("after_update",)),
+]:
+    for event_name in events:
+        event.listen(model, event_name, _stale_listener(kind, attr))
+
+event.listen(Session, "before_flush", mark_deleted_studies_stale)
+
+event.listen(Session, "after_flush", invalidate_snapshots)
+
+
+# annotation exports are versioned by the annotation's updated_at
+for event_name in ALL_WRITES:
+    event.listen(AnnotationAnalysis, event_name, touch_annotation)
+
+event.listen(Session, "after_flush", bump_annotations)
+
+
+# responses of committed records are invalidated, whoever wrote them
+event.listen(Session, "after_flush", collect_changed_paths)
+
+event.listen(Session, "after_commit", invalidate_changed_paths)
+
+event.listen(Session, "after_soft_rollback", discard_changed_paths)
@@ -4,7 +4,8 @@ Base Classes/functions for constructing views
 import re
 
 import connexion
-from flask import abort, request, current_app  # jsonify
+import orjson
+from flask import abort, request, current_app, g, Response, stream_with_context
 from flask.views import MethodView
 
 # from sqlalchemy.ext.associationproxy import ColumnAssociationProxyInstance
@@ -13,13 +14,23 @@ import sqlalchemy as sa
 import sqlalchemy.sql.expression as sae
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy import func
+from sqlalchemy.orm import selectinload
 from webargs.flaskparser import parser
-from webargs import fields
+from webargs import fields, validate
 
-from ..core import cache
 from ..database import db
 from .utils import get_current_user
-from .nested import nested_load
+from .nested import nested_load, notes_load
+from .caching import (
+    cached_view,
+    conditional_view,
+    get_private_owner,
+    invalidate_cache_tags,
+    set_private_owner,
+)
+from .snapshots import load_studyset_snapshot, queue_stale_snapshots
+from .coordinates import coordinates_response, studyset_analyses
+from .pagination import decode_cursor, encode_cursor, estimate_count, keyset_filter
 from ..models import (
     StudysetStudy,
     AnnotationAnalysis,
@@ -28,7 +39,6 @@ from ..models import (
     User,
     Annotation,
 )
-from ..schemas.data import StudysetSnapshot
 from . import data as viewdata
 
 
@@ -43,6 +53,58 @@ class BaseView(MethodView):
         """Custom processing of a record (defined in specific classes)"""
         return record
 
+    @classmethod
+    def _collect_ids(cls, data, ids, id=None):
+        """gather the ids referenced by a (nested) payload per view"""
+        if not isinstance(data, dict):
+            return
+
+        id = id or data.get("id")
+        if id is not None and hasattr(cls._model, "id"):
+            ids.setdefault(cls, set()).add(id)
+
+        for k, v in data.items():
+            if v is None or not isinstance(v, dict) or "id" not in v:
+                continue
+            if k in cls._parent:
+                ids.setdefault(getattr(viewdata, cls._parent[k]), set()).add(v["id"])
+            elif k in cls._linked:
+                LnCls = getattr(viewdata, cls._linked[k])
+                if not LnCls._composite_key:
+                    ids.setdefault(LnCls, set()).add(v["id"])
+
+        for field, res_name in cls._nested.items():
+            ResCls = getattr(viewdata, res_name)
+            nested = data.get(field)
+            for rec in nested if isinstance(nested, list) else [nested]:
+                ResCls._collect_ids(rec, ids)
+
+    @classmethod
+    def prefetch(cls, data, id=None):
+        """load every record referenced by a payload with one query per table
+
+        The records (and their nested collections) end up in the session's
+        identity map, so the per record lookups of ``update_or_create`` do
+        not go back to the database. Keep a reference to the returned list
+        while updating, the identity map only holds weak references.
+        """
+        ids = {}
+        cls._collect_ids(data, ids, id)
+
+        records = []
+        for ViewCls, view_ids in ids.items():
+            model = ViewCls._model
+            relationships = sa.inspect(model).relationships
+            options = [
+                selectinload(getattr(model, field))
+                for field in ViewCls._nested
+                if field in relationships
+            ]
+            records.extend(
+                model.query.filter(model.id.in_(view_ids)).options(*options).all()
+            )
+        return records
+
     @classmethod
     def update_or_create(cls, data, id=None, commit=True):
         """
@@ -70,6 +132,10 @@ class BaseView(MethodView):
             db.session.add(current_user)
             db.session.commit()
 
+        if commit:
+            # the top level call loads everything the payload refers to at once
+            prefetched = cls.prefetch(data, id)  # noqa F841
+
         id = id or data.get("id", None)  # want to handle case of {"id": "asdfasf"}
 
         only_ids = set(data.keys()) - set(["id"]) == set()
@@ -80,7 +146,7 @@ class BaseView(MethodView):
             record = cls._model()
             record.user = current_user
         else:
-            record = cls._model.query.filter_by(id=id).first()
+            record = db.session.get(cls._model, id)
             if record is None:
                 abort(422)
             elif (
@@ -108,7 +174,7 @@ class BaseView(MethodView):
                 PrtCls = getattr(viewdata, cls._parent[k])
                 # DO NOT WANT PEOPLE TO BE ABLE TO ADD ANALYSES
                 # TO STUDIES UNLESS THEY OWN THE STUDY
-                v = PrtCls._model.query.filter_by(id=v["id"]).first()
+                v = db.session.get(PrtCls._model, v["id"])
                 if PrtCls._model is BaseStudy:
                     pass
                 elif current_user != v.user and current_user.external_id != compose_bot:
@@ -123,7 +189,11 @@ class BaseView(MethodView):
                     }
                 else:
                     query_args = {"id": v["id"]}
-                v = LnCls._model.query.filter_by(**query_args).first()
+                v = (
+                    LnCls._model.query.filter_by(**query_args).first()
+                    if LnCls._composite_key
+                    else db.session.get(LnCls._model, v["id"])
+                )
                 if v is None:
                     abort(400)
 
@@ -169,18 +239,13 @@ CAMEL_CASE_MATCH = re.compile(r"(?<!^)(?=[A-Z])")
 
 
 def clear_cache(cls, record, path, previous_cls=None):
-    # redis cache get keys
+    # drop the entries for this record and the list pages of its collection
     if path.count("/") >= 3:
-        keys = cache.cache._write_client.keys(f"*{path}*")
-        keys = [k.decode("utf8") for k in keys]
-        cache.delete_many(*keys)
         base_path = "/".join(path.split("/")[:-1]) + "/"
     else:
         base_path = path
 
-    base_keys = cache.cache._write_client.keys(f"*{base_path}/_*")
-    base_keys = [k.decode("utf8") for k in base_keys]
-    cache.delete_many(*base_keys)
+    invalidate_cache_tags(path, base_path)
 
     # clear cache for all parent objects
     for parent, parent_view_name in cls._parent.items():
@@ -239,13 +304,17 @@ def clear_cache(cls, record, path, previous_cls=None):
             )
 
 
-def cache_key_creator(*args, **kwargs):
+def queue_snapshot_refresh():
+    """queue the nested snapshots the committed write made stale"""
+    queue_stale_snapshots(db.session.info.pop("stale_studysets", None))
+
+
+def _cache_key(user):
     # relevant pieces of information
     # 1. the query arguments
     # 2. the path
-    # 3. the user
+    # 3. the user, only when the response depends on who is asking
     path = request.path
-    user = get_current_user().id if get_current_user() else ""
     args_as_sorted_tuple = tuple(
         sorted(pair for pair in request.args.items(multi=True))
     )
@@ -256,28 +325,61 @@ def cache_key_creator(*args, **kwargs):
     return cache_key
 
 
+def cache_key_creator(*args, **kwargs):
+    # a record is served the same way to every user
+    return _cache_key("")
+
+
+def search_cache_key_creator(view, *args, **kwargs):
+    return _cache_key(view.search_cache_user())
+
+
+def cache_tag_creator(rv):
+    # tag the response with its own path and, for list responses,
+    # the path of every record on the page
+    path = request.path
+    tags = [path]
+    body = rv[0] if isinstance(rv, tuple) else rv
+    if isinstance(body, dict) and isinstance(body.get("results"), list):
+        tags.extend(
+            path + r["id"]
+            for r in body["results"]
+            if isinstance(r, dict) and r.get("id")
+        )
+    # pages of serialized records only list the ids of their records aside
+    tags.extend(path + id_ for id_ in g.pop("spliced_ids", ()))
+
+    return tags
+
+
 class ObjectView(BaseView):
-    @cache.cached(
-        60 * 60, query_string=True, make_cache_key=cache_key_creator, key_prefix=None
+    @conditional_view(make_cache_key=cache_key_creator)
+    @cached_view(
+        60 * 60, make_cache_key=cache_key_creator, make_cache_tags=cache_tag_creator
     )
     def get(self, id):
         nested = request.args.get("nested") == "true"
-        export = request.args.get("export", False)
         q = self._model.query
+        if self._model is Studyset and request.args.get("format") == "npz":
+            record = q.filter_by(id=id).first_or_404()
+            return coordinates_response(studyset_analyses(record.id))
+
+        if self._model is Studyset and nested:
+            # served from the materialized snapshot, no need to load the tree
+            record = q.filter_by(id=id).first_or_404()
+            return Response(load_studyset_snapshot(record), mimetype="application/json")
+
         if nested or self._model is Annotation:
             q = q.options(nested_load(self))
+        if self._model is Annotation:
+            q = q.options(notes_load())
 
         record = q.filter_by(id=id).first_or_404()
-        if self._model is Studyset and nested:
-            snapshot = StudysetSnapshot()
-            return snapshot.dump(record)
-        else:
-            return self.__class__._schema(
-                context={
-                    "nested": nested,
-                    "export": export,
-                }
-            ).dump(record)
+        return self.__class__._schema(
+            context={
+                "nested": nested,
+            }
+        ).dump(record)
 
     def put(self, id):
         request_data = self.insert_data(id, request.json)
@@ -288,6 +390,7 @@ class ObjectView(BaseView):
 
         # clear relevant caches
         clear_cache(self.__class__, record, request.path)
+        queue_snapshot_refresh()
 
         return self.__class__._schema().dump(record)
 
@@ -304,6 +407,7 @@ class ObjectView(BaseView):
 
         # clear relevant caches
         clear_cache(self.__class__, record, request.path)
+        queue_snapshot_refresh()
 
         return 204
 
@@ -318,8 +422,22 @@ LIST_USER_ARGS = {
     "desc": fields.Boolean(missing=True),
     "page_size": fields.Int(missing=20, validate=lambda val: val < 30000),
     "user_id": fields.String(missing=None),
+    "format": fields.String(
+        missing="json", validate=validate.OneOf(["json", "ndjson", "npz"])
+    ),
+    # an empty cursor requests the first page of a keyset paginated search
+    "cursor": fields.String(missing=None),
+    # add the fragments matching the full text search to every result
+    "highlight": fields.Boolean(missing=False),
+    "count": fields.String(
+        missing="exact", validate=validate.OneOf(["exact", "estimate", "none"])
+    ),
 }
 
+# number of rows fetched per round trip when streaming results
+STREAM_BATCH_SIZE = 1000
+HEADLINE_OPTIONS = "MaxFragments=2, MaxWords=20, MinWords=5, StartSel=<b>, StopSel=</b>"
+
 
 class ListView(BaseView):
     _search_fields = []
@@ -342,6 +460,29 @@ class ListView(BaseView):
     def view_search(self, q, args):
         return q
 
+    def search_cache_user(self):
+        """the user a search result is specific to ("" when it is shared)
+
+        searches only differ between users when private records of the
+        current user are added to the public ones. Whether a user owns any is
+        remembered in redis until they write a record of the model.
+        """
+        m = self._model
+        current_user = get_current_user()
+        if current_user is None or not hasattr(m, "public"):
+            return ""
+        memo = g.setdefault("private_owner", {})
+        if m not in memo:
+            table, user_id = m.__tablename__, current_user.external_id
+            owns_private = get_private_owner(table, user_id)
+            if owns_private is None:
+                owns_private = db.session.query(
+                    sa.exists().where(m.user_id == user_id, m.public.isnot(True))
+                ).scalar()
+                set_private_owner(table, user_id, owns_private)
+            memo[m] = owns_private
+        return current_user.id if memo[m] else ""
+
     def join_tables(self, q):
         return q
 
@@ -357,11 +498,34 @@ class ListView(BaseView):
     def create_metadata(self, q, total):
         return {"total_count": total}
 
-    @cache.cached(60 * 60, query_string=True, make_cache_key=cache_key_creator)
-    def search(self):
-        # Parse arguments using webargs
-        args = parser.parse(self._user_args, request, location="query")
+    def fulltext_query(self, args):
+        """the tsquery of a full text search (None when there is none)"""
+        s = args["search"]
+        if s is None or s.isdigit() or not self._fulltext_fields:
+            return None
+        if not hasattr(self._model, "__ts_vector__"):
+            return None
+        return sa.func.websearch_to_tsquery(s, postgresql_regconfig="english")
+
+    def sort_column(self, args):
+        """return the expression to sort on and whether to sort descending"""
+        sort_col = args["sort"]
+        if sort_col == "relevance":
+            tsquery = self.fulltext_query(args)
+            return sa.func.ts_rank(self._model.__ts_vector__, tsquery), True
+
+        desc = False if sort_col != "created_at" else args["desc"]
+
+        attr = getattr(self._model, sort_col)
+
+        # Case-insensitive sorting
+        if sort_col != "created_at":
+            attr = func.lower(attr)
 
+        return attr, desc
+
+    def search_query(self, args):
+        """build the filtered and sorted query for a search"""
         m = self._model  # for brevity
         q = m.query
 
@@ -369,10 +533,13 @@ class ListView(BaseView):
         if args.get("user_id"):
             q = q.filter(m.user_id == args.get("user_id"))
 
-        # query items that are public and/or you own them
-        if hasattr(m, "public"):
+        # query items that are public and/or you own them, the private ones
+        # only when the response is cached for the current user alone
+        if hasattr(m, "public") and self.search_cache_user():
             current_user = get_current_user()
             q = q.filter(sae.or_(m.public == True, m.user == current_user))  # noqa E712
+        elif hasattr(m, "public"):
+            q = q.filter(m.public == True)  # noqa E712
 
         # Search
         s = args["search"]
@@ -381,9 +548,13 @@ class ListView(BaseView):
         # temporary fix for pmid search
         if s is not None and s.isdigit():
             q = q.filter_by(pmid=s)
+        elif self.fulltext_query(args) is not None:
+            q = q.filter(m.__ts_vector__.op("@@")(self.fulltext_query(args)))
         elif s is not None and self._fulltext_fields:
-            tsquery = sa.func.websearch_to_tsquery(s, postgresql_regconfig="english")
-            q = q.filter(m.__ts_vector__.op("@@")(tsquery))
+            # models without a search vector match the fields one by one
+            q = q.filter(
+                sae.or_(*[getattr(m, f).ilike(f"%{s}%") for f in self._fulltext_fields])
+            )
 
         # Alternatively (or in addition), search on individual fields.
         for field in self._search_fields:
@@ -393,35 +564,156 @@ class ListView(BaseView):
 
         q = self.view_search(q, args)
         # Sort
-        sort_col = args["sort"]
-        desc = False if sort_col != "created_at" else args["desc"]
+        attr, desc = self.sort_column(args)
         desc = {False: "asc", True: "desc"}[desc]
 
-        attr = getattr(m, sort_col)
-
-        # Case-insensitive sorting
-        if sort_col != "created_at":
-            attr = func.lower(attr)
-
         # TODO: if the sort field is proxied, bad stuff happens. In theory
         # the next two lines should address this by joining the proxied model,
         # but weird things are happening. look into this as time allows.
         # if isinstance(attr, ColumnAssociationProxyInstance):
         #     q = q.join(*attr.attr)
-        q = q.order_by(getattr(attr, desc)())
+        # the id breaks ties so the order (and keyset pagination) is stable
+        q = q.order_by(getattr(attr, desc)(), getattr(m.id, desc)())
 
         # join the relevant tables for output
         if not args.get("flat"):
             q = self.join_tables(q)
 
-        pagination_query = q.paginate(
-            page=args["page"],
-            per_page=args["page_size"],
-            error_out=False,
+        return q
+
+    def stream_records(self, q, args):
+        """serialize and send records in batches as newline delimited json
+
+        every batch is loaded (with the eager loads of the query) and
+        serialized at once, so memory use does not grow with the page size.
+        """
+        offset = (args["page"] - 1) * args["page_size"]
+        end = offset + args["page_size"]
+
+        def generate():
+            for start in range(offset, end, STREAM_BATCH_SIZE):
+                size = min(STREAM_BATCH_SIZE, end - start)
+                records = q.limit(size).offset(start).all()
+                content = self.serialize_records(records, args)
+                yield b"".join(
+                    (c if isinstance(c, bytes) else orjson.dumps(c)) + b"\n"
+                    for c in content
+                )
+                if len(records) < size:
+                    break
+
+        return Response(
+            stream_with_context(generate()), mimetype="application/x-ndjson"
+        )
+
+    def coordinates(self, q, args):
+        """columnar coordinates of the records (only analyses have any)"""
+        abort(400, "the npz format is only available for analyses and studysets")
+
+    def keyset_page(self, q, args):
+        """fetch the page following ``args["cursor"]``
+
+        returns the records and the cursor of the next page (None on the
+        last page)
+        """
+        attr, desc = self.sort_column(args)
+        if args["cursor"]:
+            value, record_id = decode_cursor(args["cursor"])
+            q = q.filter(keyset_filter(attr, self._model.id, value, record_id, desc))
+
+        # fetch one extra record to know whether there is a next page
+        records = q.limit(args["page_size"] + 1).all()
+        if len(records) <= args["page_size"]:
+            return records, None
+
+        records = records[: args["page_size"]]
+        if args["sort"] == "relevance":
+            value = (
+                db.session.query(attr).filter(self._model.id == records[-1].id).scalar()
+            )
+        else:
+            value = getattr(records[-1], args["sort"])
+        if args["sort"] != "created_at" and isinstance(value, str):
+            value = value.lower()
+        return records, encode_cursor(value, records[-1].id)
+
+    def highlight_records(self, records, content, args):
+        """add the fragments of each record matching the full text search"""
+        tsquery = self.fulltext_query(args)
+        if not args["highlight"] or tsquery is None or not records:
+            return content
+
+        m = self._model
+        text = sa.func.concat_ws(" ", *(getattr(m, f) for f in self._fulltext_fields))
+        headline = sa.func.ts_headline("english", text, tsquery, HEADLINE_OPTIONS)
+        headlines = dict(
+            db.session.query(m.id, headline).filter(m.id.in_([r.id for r in records]))
         )
-        records = pagination_query.items
+        for record, result in zip(records, content):
+            result["highlight"] = headlines.get(record.id)
+        return content
+
+    def count_records(self, q, args):
+        """total number of results following the requested count strategy"""
+        if args["count"] == "none":
+            return None
+        if args["count"] == "estimate":
+            return estimate_count(q)
+        return q.order_by(None).count()
+
+    @cached_view(
+        60 * 60,
+        make_cache_key=search_cache_key_creator,
+        make_cache_tags=cache_tag_creator,
+    )
+    def search(self):
+        # Parse arguments using webargs
+        args = parser.parse(self._user_args, request, location="query")
+        if args["sort"] == "relevance" and self.fulltext_query(args) is None:
+            # nothing to rank without a full text search
+            args["sort"] = "created_at"
+
+        q = self.search_query(args)
+        if args["format"] == "ndjson":
+            return self.stream_records(q, args)
+        if args["format"] == "npz":
+            return self.coordinates(q, args)
+
+        next_cursor = None
+        if args["cursor"] is not None:
+            records, next_cursor = self.keyset_page(q, args)
+            total = self.count_records(q, args)
+        else:
+            pagination_query = q.paginate(
+                page=args["page"],
+                per_page=args["page_size"],
+                error_out=False,
+                count=args["count"] == "exact",
+            )
+            records = pagination_query.items
+            total = (
+                pagination_query.total
+                if args["count"] == "exact"
+                else self.count_records(q, args)
+            )
         content = self.serialize_records(records, args)
-        metadata = self.create_metadata(q, pagination_query.total)
+        content = self.highlight_records(records, content, args)
+        metadata = self.create_metadata(q, total)
+        if args["cursor"] is not None:
+            metadata["next"] = next_cursor
+        if any(isinstance(result, bytes) for result in content):
+            # records serialized ahead of time are spliced in as they are
+            g.spliced_ids = [r.id for r in records]
+            body = b"".join(
+                [
+                    b'{"metadata":',
+                    orjson.dumps(metadata),
+                    b',"results":[',
+                    b",".join(content),
+                    b"]}",
+                ]
+            )
+            return Response(body, mimetype="application/json")
         response = {
             "metadata": metadata,
             "results": content,
@@ -446,7 +738,8 @@ class ListView(BaseView):
         with db.session.no_autoflush:
             record = self.__class__.update_or_create(data)
 
-        # clear the cache for this endpoint
-        cache.delete(request.path)
+        # clear the list pages for this endpoint
+        invalidate_cache_tags(request.path)
+        queue_snapshot_refresh()
 
         return self.__class__._schema(context={"nested": nested}).dump(record)
@@ -0,0 +1,477 @@
+"""
+Response caching with a tag (dependency) index
+
+Every cached response registers the API paths of the records it contains
+(e.g. ``/api/studies/<id>``) and of the collection it was listed from
+(e.g. ``/api/studies/``) as tags. Each tag is a redis set holding the cache
+keys that depend on it, so invalidation is a set lookup plus a targeted
+delete instead of a ``KEYS`` scan over the whole keyspace.
+
+Invalidating a tag also bumps the version of that path, a timestamp used to
+answer conditional requests (``If-None-Match``/``If-Modified-Since``) with a
+304 before the response is looked up or serialized. Committing a session
+invalidates the paths of the records it wrote (see
+``models.event_listeners``), so writes made outside the views are versioned
+too.
+
+Responses are cached as their final bytes (body, status and headers packed
+together) so a hit neither unpickles nor re-encodes anything. In front of
+redis every worker keeps a small LRU of the same serialized responses.
+The versions of the requested paths are kept there as well, so a hot
+conditional request never reaches redis. Invalidated keys and paths are
+dropped locally and published on a redis channel so the other workers drop
+them too; local entries also expire after a short time in case a message
+is missed.
+
+Workers count the requests served for every cache key shared by all the
+users. ``warm_cache`` recomputes the most requested responses ahead of the
+users, at startup or whenever they are invalidated (``flask warm-cache``).
+It replays the requests anonymously, so it cannot fill the keys computed
+for one user, these are not counted.
+"""
+import hashlib
+import os
+import threading
+import time
+from collections import Counter, OrderedDict
+from datetime import datetime, timezone
+from functools import wraps
+
+import orjson
+from flask import Response, request
+
+from ..core import cache
+from .compression import compress_variants, encoded_response, variant_etags
+
+TAG_PREFIX = "tag:"
+VERSION_PREFIX = "version:"
+# whether a user owns private records of a table (decides who a search is for)
+PRIVATE_OWNER_PREFIX = "private-owner:"
+PRIVATE_OWNER_TIMEOUT = 24 * 60 * 60
+# versions outlive the cached entries by far
+VERSION_TIMEOUT = 7 * 24 * 60 * 60
+# responses kept in the memory of each worker
+LOCAL_CACHE_SIZE = 1024
+# and the memory (in bytes of bodies and their compressed variants) they may use
+LOCAL_CACHE_BYTES = 256 * 1024 * 1024
+# upper bound (in seconds) on how stale a local entry can get
+LOCAL_CACHE_TTL = 60
+INVALIDATION_CHANNEL = "cache-invalidation"
+# sorted set of request counts per cache key and the URL requesting each key
+HITS_KEY = "cache-hits"
+HIT_URLS_KEY = "cache-hit-urls"
+HITS_TIMEOUT = 7 * 24 * 60 * 60
+# seconds between two writes of the counts of a worker to redis
+HITS_FLUSH_INTERVAL = 10
+# requests replaying popular URLs are not counted themselves
+WARMING_HEADER = "X-Cache-Warming"
+
+_local_cache = OrderedDict()
+_local_lock = threading.Lock()
+_local_usage = {"bytes": 0}
+_local_versions = OrderedDict()
+_subscriber = {"pid": None}
+_hits = {"counts": Counter(), "urls": {}, "flushed_at": time.monotonic()}
+_hits_lock = threading.Lock()
+
+
+def _now():
+    return f"{time.time():.6f}"
+
+
+def _client():
+    return cache.cache._write_client
+
+
+def register_cache_tags(key, tags, timeout):
+    """record that the cache entry ``key`` depends on each of ``tags``"""
+    if not tags:
+        return
+    pipe = _client().pipeline(transaction=False)
+    for tag in set(tags):
+        tag_key = TAG_PREFIX + tag
+        pipe.sadd(tag_key, key)
+        # a tag never needs to outlive the entries it points to
+        pipe.expire(tag_key, timeout)
+    pipe.execute()
+
+
+def invalidate_cache_tags(*tags):
+    """delete every cache entry registered under any of ``tags``"""
+    if not tags:
+        return
+    tag_keys = [TAG_PREFIX + tag for tag in set(tags)]
+    client = _client()
+    keys = [k.decode("utf8") for k in client.sunion(tag_keys)]
+    if keys:
+        client.delete(*keys)
+    client.delete(*tag_keys)
+
+    now = _now()
+    pipe = client.pipeline(transaction=False)
+    for tag in set(tags):
+        pipe.set(VERSION_PREFIX + tag, now, ex=VERSION_TIMEOUT)
+    pipe.execute()
+
+    # the tags are the paths whose versions changed
+    paths = list(set(tags))
+    discard_local(keys, paths)
+    client.publish(INVALIDATION_CHANNEL, orjson.dumps({"keys": keys, "paths": paths}))
+
+
+def resource_version(path):
+    """timestamp of the last change of the resource at ``path``"""
+    version = _local_version(path)
+    if version is not None:
+        return version
+
+    version = _client().get(VERSION_PREFIX + path)
+    # empty for resources that did not change since their versions expired,
+    # they are versioned by the next invalidation (reads never write one)
+    version = version.decode("utf8") if version is not None else ""
+    _local_set_version(path, version)
+    return version
+
+
+def _private_owner_key(table, user_id):
+    return f"{PRIVATE_OWNER_PREFIX}{table}:{user_id}"
+
+
+def get_private_owner(table, user_id):
+    """whether the user owns private records of ``table`` (None when unknown)"""
+    value = _client().get(_private_owner_key(table, user_id))
+    return value == b"1" if value is not None else None
+
+
+def set_private_owner(table, user_id, owns_private):
+    _client().set(
+        _private_owner_key(table, user_id),
+        b"1" if owns_private else b"0",
+        ex=PRIVATE_OWNER_TIMEOUT,
+    )
+
+
+def forget_private_owners(owners):
+    """forget what is known of the (table, user id) ``owners``"""
+    if owners:
+        _client().delete(*[_private_owner_key(t, u) for t, u in owners])
+
+
+def _entry_size(entry):
+    body, _, _, variants = entry
+    return len(body) + sum(len(data) for data in variants.values())
+
+
+def _local_pop(key):
+    item = _local_cache.pop(key, None)
+    if item is not None:
+        _local_usage["bytes"] -= _entry_size(item[1])
+
+
+def _local_get(key):
+    with _local_lock:
+        item = _local_cache.get(key)
+        if item is None:
+            return None
+        expires, entry = item
+        if expires < time.monotonic():
+            _local_pop(key)
+            return None
+        _local_cache.move_to_end(key)
+        return entry
+
+
+def _local_set(key, entry, timeout):
+    size = _entry_size(entry)
+    if size > LOCAL_CACHE_BYTES:
+        return
+    _ensure_subscriber()
+    expires = time.monotonic() + min(timeout, LOCAL_CACHE_TTL)
+    with _local_lock:
+        _local_pop(key)
+        _local_cache[key] = (expires, entry)
+        _local_usage["bytes"] += size
+        while (
+            len(_local_cache) > LOCAL_CACHE_SIZE
+            or _local_usage["bytes"] > LOCAL_CACHE_BYTES
+        ):
+            _local_pop(next(iter(_local_cache)))
+
+
+def _local_version(path):
+    with _local_lock:
+        item = _local_versions.get(path)
+        if item is None:
+            return None
+        expires, version = item
+        if expires < time.monotonic():
+            del _local_versions[path]
+            return None
+        _local_versions.move_to_end(path)
+        return version
+
+
+def _local_set_version(path, version):
+    _ensure_subscriber()
+    expires = time.monotonic() + LOCAL_CACHE_TTL
+    with _local_lock:
+        _local_versions.pop(path, None)
+        _local_versions[path] = (expires, version)
+        while len(_local_versions) > LOCAL_CACHE_SIZE:
+            _local_versions.popitem(last=False)
+
+
+def discard_local(keys, paths=()):
+    """drop ``keys`` and the versions of ``paths`` from the local tier of
+    this worker"""
+    with _local_lock:
+        for key in keys:
+            _local_pop(key)
+        for path in paths:
+            _local_versions.pop(path, None)
+
+
+def clear_local_cache():
+    with _local_lock:
+        _local_cache.clear()
+        _local_versions.clear()
+        _local_usage["bytes"] = 0
+
+
+def _on_invalidation(message):
+    data = orjson.loads(message["data"])
+    discard_local(data["keys"], data["paths"])
+
+
+def _ensure_subscriber():
+    """listen for invalidations from other workers (once per process)"""
+    pid = os.getpid()
+    if _subscriber["pid"] == pid:
+        return
+    with _local_lock:
+        if _subscriber["pid"] == pid:
+            return
+        pubsub = _client().pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{INVALIDATION_CHANNEL: _on_invalidation})
+        pubsub.run_in_thread(sleep_time=1, daemon=True)
+        _subscriber["pid"] = pid
+
+
+def serialize_response(rv):
+    """the (body, status, headers, compressed variants) of the value
+    returned by a view"""
+    if isinstance(rv, Response):
+        headers = [(k, v) for k, v in rv.headers.items() if k != "Content-Length"]
+        body, status = rv.get_data(), rv.status_code
+    else:
+        body, status = rv if isinstance(rv, tuple) else (rv, 200)
+        body, headers = orjson.dumps(body), [("Content-Type", "application/json")]
+    return body, status, headers, compress_variants(body)
+
+
+def build_response(entry):
+    body, status, headers, variants = entry
+    return encoded_response(body, variants, status=status, headers=headers)
+
+
+def pack_entry(entry):
+    """bytes holding a serialized response: meta length, meta, body and the
+    compressed variants"""
+    body, status, headers, variants = entry
+    meta = orjson.dumps(
+        [status, headers, [[enc, len(data)] for enc, data in variants.items()]]
+    )
+    return b"".join([len(meta).to_bytes(4, "big"), meta, body, *variants.values()])
+
+
+def unpack_entry(data):
+    size = int.from_bytes(data[:4], "big")
+    status, headers, sizes = orjson.loads(data[4 : 4 + size])  # noqa E203
+    end = len(data) - sum(length for _, length in sizes)
+    body = data[4 + size : end]  # noqa E203
+    variants = {}
+    for encoding, length in sizes:
+        variants[encoding] = data[end : end + length]  # noqa E203
+        end += length
+    return body, status, [tuple(h) for h in headers], variants
+
+
+def get_entry(key):
+    """the serialized response cached in redis under ``key``"""
+    data = _client().get(key)
+    return unpack_entry(data) if data is not None else None
+
+
+def set_entry(key, entry, timeout):
+    _client().set(key, pack_entry(entry), ex=timeout)
+
+
+def is_shared_key(key):
+    """whether the cache key is served to every user
+
+    Cache keys end with the user they were computed for, which is empty
+    when the response is shared (see ``base._cache_key``).
+    """
+    return key.endswith("_")
+
+
+def count_hit(key, url):
+    """count a request for a shared ``key``, the counts are sent to redis in
+    batches"""
+    if not is_shared_key(key):
+        return
+    with _hits_lock:
+        _hits["counts"][key] += 1
+        _hits["urls"][key] = url
+        due = time.monotonic() - _hits["flushed_at"] >= HITS_FLUSH_INTERVAL
+    if due:
+        flush_hits()
+
+
+def flush_hits():
+    with _hits_lock:
+        counts, urls = _hits["counts"], _hits["urls"]
+        _hits.update(counts=Counter(), urls={}, flushed_at=time.monotonic())
+    if not counts:
+        return
+    pipe = _client().pipeline(transaction=False)
+    for key, count in counts.items():
+        pipe.zincrby(HITS_KEY, count, key)
+    pipe.hset(HIT_URLS_KEY, mapping=urls)
+    pipe.expire(HITS_KEY, HITS_TIMEOUT)
+    pipe.expire(HIT_URLS_KEY, HITS_TIMEOUT)
+    pipe.execute()
+
+
+def popular_keys(top):
+    """the ``top`` most requested cache keys with the URL requesting them"""
+    client = _client()
+    keys = client.zrevrange(HITS_KEY, 0, top - 1)
+    if not keys:
+        return []
+    urls = client.hmget(HIT_URLS_KEY, keys)
+    return [
+        (key.decode("utf8"), url.decode("utf8"))
+        for key, url in zip(keys, urls)
+        if url is not None
+    ]
+
+
+def warm_cache(app, top=100, keys=None):
+    """recompute the popular responses missing from the cache
+
+    ``keys`` restricts the warming to some (e.g. just invalidated) keys.
+    Returns the URLs that were requested.
+    """
+    flush_hits()
+    client = _client()
+    warmed = []
+    with app.test_client() as http:
+        for key, url in popular_keys(top):
+            if not is_shared_key(key) or keys is not None and key not in keys:
+                continue
+            if url in warmed or client.exists(key):
+                continue
+            http.get(url, headers={WARMING_HEADER: "1"})
+            warmed.append(url)
+    return warmed
+
+
+def watch_invalidations(app, top=100):
+    """warm the popular responses again every time they are invalidated"""
+    pubsub = _client().pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(INVALIDATION_CHANNEL)
+    for message in pubsub.listen():
+        keys = orjson.loads(message["data"])["keys"]
+        if keys:
+            warm_cache(app, top, keys=set(keys))
+
+
+def conditional_view(make_cache_key):
+    """answer conditional GET requests from the version of the requested path
+
+    The version is read from the local tier first, like the responses, so
+    a hot ``If-None-Match`` is answered without a round trip to redis.
+    The ETag combines the cache key (path, arguments and user) with the
+    version (and the content encoding), so it is strong for the exact
+    response being served.
+    """
+
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            version = resource_version(request.path)
+            key = make_cache_key(*args, **kwargs)
+            etag = hashlib.sha1(f"{key}@{version}".encode("utf8")).hexdigest()
+            headers = {"ETag": f'"{etag}"'}
+            last_modified = None
+            if version:
+                last_modified = datetime.fromtimestamp(float(version), tz=timezone.utc)
+                headers["Last-Modified"] = last_modified.strftime(
+                    "%a, %d %b %Y %H:%M:%S GMT"
+                )
+
+            if request.if_none_match:
+                not_modified = any(
+                    tag in request.if_none_match for tag in variant_etags(etag)
+                )
+            elif request.if_modified_since and last_modified is not None:
+                not_modified = (
+                    int(last_modified.timestamp())
+                    <= request.if_modified_since.timestamp()
+                )
+            else:
+                not_modified = False
+
+            if not_modified:
+                return Response(status=304, headers=headers)
+
+            rv = f(*args, **kwargs)
+            if isinstance(rv, Response):
+                rv.headers.update(headers)
+                if rv.content_encoding:
+                    # every encoding of the body is a different entity
+                    rv.set_etag(f"{etag}-{rv.content_encoding}")
+                return rv
+            return rv, 200, headers
+
+        return wrapper
+
+    return decorator
+
+
+def cached_view(timeout, make_cache_key, make_cache_tags):
+    """cache the result of a view method and index it by its tags
+
+    ``make_cache_key`` and ``make_cache_tags`` are called within the
+    request context; the latter receives the freshly computed response.
+    The result is served as a response holding the serialized body.
+    """
+
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            key = make_cache_key(*args, **kwargs)
+            if WARMING_HEADER not in request.headers:
+                count_hit(key, request.full_path)
+            entry = _local_get(key)
+            if entry is not None:
+                return build_response(entry)
+
+            entry = get_entry(key)
+            if entry is None:
+                rv = f(*args, **kwargs)
+                if isinstance(rv, Response) and rv.is_streamed:
+                    # streamed responses are generated lazily, never cache them
+                    return rv
+
+                entry = serialize_response(rv)
+                set_entry(key, entry, timeout)
+                register_cache_tags(key, make_cache_tags(rv), timeout)
+
+            _local_set(key, entry, timeout)
+            return build_response(entry)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,63 @@
+"""
+Pre-compressed response bodies
+
+Cached bodies are compressed once, when they are stored, with every codec
+(gzip, brotli and zstd), and the variant matching the ``Accept-Encoding`` of a request is served
+as is.
+"""
+import gzip
+
+import brotli
+import zstandard
+from flask import Response, request
+
+# smaller bodies are not worth the extra bytes and cpu
+MIN_COMPRESS_SIZE = 1024
+
+COMPRESSORS = {
+    "gzip": lambda body: gzip.compress(body, compresslevel=6),
+    "br": lambda body: brotli.compress(body, quality=5),
+    "zstd": lambda body: zstandard.ZstdCompressor(level=6).compress(body),
+}
+
+
+def compress_variants(body):
+    """{encoding: compressed body} of every codec that makes ``body`` smaller"""
+    if len(body) < MIN_COMPRESS_SIZE:
+        return {}
+    variants = {}
+    for encoding, compress in COMPRESSORS.items():
+        data = compress(body)
+        if len(data) < len(body):
+            variants[encoding] = data
+    return variants
+
+
+def negotiate_encoding(variants):
+    """the encoding of the variant the client prefers (None for identity)"""
+    if not variants:
+        return None
+    return request.accept_encodings.best_match(list(variants))
+
+
+def variant_etags(etag):
+    """the entity tags a client may hold for any variant of a response"""
+    return [etag, *(f"{etag}-{encoding}" for encoding in COMPRESSORS)]
+
+
+def encoded_response(body, variants, status=200, headers=(), mimetype=None, etag=None):
+    """response with the variant of ``body`` the client accepts"""
+    encoding = negotiate_encoding(variants)
+    response = Response(
+        variants[encoding] if encoding else body,
+        status=status,
+        headers=list(headers),
+        mimetype=mimetype,
+    )
+    if variants:
+        response.vary.add("Accept-Encoding")
+    if encoding:
+        response.content_encoding = encoding
+    if etag is not None:
+        response.set_etag(f"{etag}-{encoding}" if encoding else etag)
+    return response
@@ -0,0 +1,75 @@
+"""
+Columnar coordinate payloads
+
+The peaks of a set of analyses are aggregated by postgres in a single query
+and returned as a NumPy ``.npz`` archive holding:
+
+- ``coordinates``: float32 array of shape (N, 3)
+- ``offsets``: int64 array of shape (M + 1,), the peaks of the i-th analysis
+  are ``coordinates[offsets[i]:offsets[i + 1]]``
+- ``analysis_ids``: the ids of the M analyses (analyses without peaks are
+  left out)
+"""
+import io
+
+import numpy as np
+import sqlalchemy as sa
+from flask import Response
+from sqlalchemy.dialects.postgresql import aggregate_order_by, array
+
+from ..database import db
+from ..models import Analysis, Point, StudysetStudy
+
+NPZ_MIMETYPE = "application/x-npz"
+
+
+def studyset_analyses(studyset_id):
+    """select the ids of every analysis in a studyset"""
+    return (
+        sa.select(Analysis.id)
+        .join(StudysetStudy, StudysetStudy.study_id == Analysis.study_id)
+        .where(StudysetStudy.studyset_id == studyset_id)
+    )
+
+
+def coordinates_query(analysis_ids):
+    """aggregate the peaks of each of the selected analyses into one array"""
+    xyz = array([Point.x, Point.y, Point.z])
+    return (
+        sa.select(
+            Point.analysis_id,
+            sa.func.array_agg(aggregate_order_by(xyz, Point.order, Point.id)),
+        )
+        .where(
+            Point.analysis_id.in_(analysis_ids),
+            Point.x.isnot(None),
+            Point.y.isnot(None),
+            Point.z.isnot(None),
+        )
+        .group_by(Point.analysis_id)
+        .order_by(Point.analysis_id)
+    )
+
+
+def coordinates_npz(analysis_ids):
+    """serialize the coordinates of the selected analyses as ``.npz`` bytes"""
+    rows = db.session.execute(coordinates_query(analysis_ids)).all()
+
+    counts = [len(peaks) for _, peaks in rows]
+    coordinates = np.array(
+        [xyz for _, peaks in rows for xyz in peaks], dtype=np.float32
+    ).reshape(-1, 3)
+    offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+
+    buf = io.BytesIO()
+    np.savez(
+        buf,
+        coordinates=coordinates,
+        offsets=offsets,
+        analysis_ids=np.array([analysis_id for analysis_id, _ in rows], dtype=str),
+    )
+    return buf.getvalue()
+
+
+def coordinates_response(analysis_ids):
+    return Response(coordinates_npz(analysis_ids), mimetype=NPZ_MIMETYPE)
@@ -1,11 +1,25 @@
+import orjson
+from flask import abort, current_app, request
 from marshmallow import EXCLUDE
 from webargs import fields
+import sqlalchemy as sa
 import sqlalchemy.sql.expression as sae
 from sqlalchemy.orm import joinedload
 
-from .utils import view_maker
-from .base import BaseView, ObjectView, ListView
-from .nested import nested_load
+from .utils import view_maker, get_current_user
+from .base import BaseView, ObjectView, ListView, clear_cache
+from .nested import nested_load, notes_load
+from .notes import (
+    NDJSON_MIMETYPE,
+    export_notes_csv,
+    export_notes_json,
+    parse_notes,
+    stream_notes,
+    update_notes,
+)
+from .snapshots import load_studyset_snapshots
+from .coordinates import coordinates_response
+from .spatial import SPATIAL_ARGS, spatial_filter
 from ..database import db
 from ..models import (
     Studyset,
@@ -14,6 +28,7 @@ from ..models import (
     AnalysisConditions,
     AnnotationAnalysis,
     Entity,
+    Point,
 )
 from ..models.data import StudysetStudy, BaseStudy
 
@@ -24,7 +39,6 @@ from ..schemas import (
     StudysetStudySchema,
     EntitySchema,
 )
-from ..schemas.data import StudysetSnapshot
 
 __all__ = [
     "StudysetsView",
@@ -67,20 +81,15 @@ class StudysetsView(ObjectView, ListView):
     _multi_search = ("name", "description")
     _search_fields = ("name", "description", "publication", "doi", "pmid")
 
-    def view_search(self, q, args):
-        # check if results should be nested
-        nested = True if args.get("nested") else False
-        if nested:
-            q = q.options(nested_load(self))
-
-        return q
-
     def serialize_records(self, records, args):
-        if args.get("nested"):
-            snapshot = StudysetSnapshot()
-            content = [snapshot.dump(r) for r in records]
-            return content
-        return super().serialize_records(records, args)
+        if not args.get("nested"):
+            return super().serialize_records(records, args)
+        # nested studysets are served from their materialized snapshots
+        snapshots = load_studyset_snapshots(records)
+        if args.get("highlight"):
+            # the highlights are added to the decoded records
+            return [orjson.loads(data) for data in snapshots]
+        return snapshots
 
 
 @view_maker
@@ -95,7 +104,7 @@ class AnnotationsView(ObjectView, ListView):
     _search_fields = ("name", "description")
 
     def view_search(self, q, args):
-        q = q.options(nested_load(self))
+        q = q.options(nested_load(self), notes_load())
 
         # query annotations for a specific studyset
         if args.get("studyset_id"):
@@ -103,6 +112,38 @@ class AnnotationsView(ObjectView, ListView):
 
         return q
 
+    def get(self, id):
+        export = {"ndjson": stream_notes, "csv": export_notes_csv}.get(
+            request.args.get("format")
+        )
+        if export is None and request.args.get("export"):
+            export = export_notes_json
+        if export is not None:
+            record = self._model.query.filter_by(id=id).first_or_404()
+            return export(record)
+        return super().get(id)
+
+    def put(self, id):
+        if request.mimetype != NDJSON_MIMETYPE:
+            return super().put(id)
+
+        # bulk update of the notes in the columnar format
+        record = self._model.query.filter_by(id=id).first_or_404()
+        current_user = get_current_user()
+        compose_bot = current_app.config["COMPOSE_AUTH0_CLIENT_ID"] + "@clients"
+        if current_user is None or (
+            record.user_id != current_user.external_id
+            and current_user.external_id != compose_bot
+        ):
+            abort(403)
+
+        header, notes = parse_notes(request.get_data().splitlines())
+        update_notes(record, header, notes)
+        clear_cache(self.__class__, record, request.path)
+
+        # the notes are read back in the same format (?format=ndjson)
+        return {"id": record.id, "updated_at": record.updated_at.isoformat()}
+
     def insert_data(self, id, data):
         """Automatically insert Studyset if Annotation is being updated."""
         if not data.get("studyset"):
@@ -215,9 +256,11 @@ class StudiesView(ObjectView, ListView):
             "level": fields.String(default="group", missing="group"),
             "flat": fields.Boolean(default=False),
             "info": fields.Boolean(default=False),
+            "space": fields.String(missing=None),
         },
         **LIST_NESTED_ARGS,
         **LIST_CLONE_ARGS,
+        **SPATIAL_ARGS,
     }
 
     _multi_search = ("name", "description")
@@ -257,6 +300,16 @@ class StudiesView(ObjectView, ListView):
                         self._model.analyses.any(Analysis.points.any()),
                     )
                 )
+        # studies reporting a peak in the searched region
+        points_filter = spatial_filter(args, space=args.get("space"))
+        if points_filter is not None:
+            q = q.filter(
+                self._model.id.in_(
+                    sa.select(Analysis.study_id)
+                    .join(Point, Point.analysis_id == Analysis.id)
+                    .where(points_filter)
+                )
+            )
         # filter by level of analysis (group or meta)
         q = q.filter(self._model.level == args.get("level"))
         # only return unique studies
@@ -385,6 +438,13 @@ class AnalysesView(ObjectView, ListView):
     }
     _search_fields = ("name", "description")
 
+    def coordinates(self, q, args):
+        offset = (args["page"] - 1) * args["page_size"]
+        analysis_ids = (
+            q.with_entities(self._model.id).limit(args["page_size"]).offset(offset)
+        )
+        return coordinates_response(analysis_ids.statement)
+
 
 @view_maker
 class ConditionsView(ObjectView, ListView):
@@ -401,6 +461,7 @@ class ImagesView(ObjectView, ListView):
 
 @view_maker
 class PointsView(ObjectView, ListView):
+    _view_fields = {**SPATIAL_ARGS}
     _nested = {
         "values": "PointValuesView",
         "entities": "EntitiesResource",
@@ -410,6 +471,13 @@ class PointsView(ObjectView, ListView):
     }
     _search_fields = ("space", "analysis_name")
 
+    def view_search(self, q, args):
+        # the space is already filtered on as a search field
+        points_filter = spatial_filter(args)
+        if points_filter is not None:
+            q = q.filter(points_filter)
+        return q
+
 
 @view_maker
 class PointValuesView(ObjectView, ListView):
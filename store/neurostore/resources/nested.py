@@ -1,9 +1,10 @@
 """
 Utilities for changing the loading structure for queries
 """
-from sqlalchemy.orm import subqueryload
+from sqlalchemy.orm import selectinload, subqueryload
 from sqlalchemy.orm.strategy_options import _UnboundLoad
 from . import data
+from ..models import Annotation, AnnotationAnalysis, StudysetStudy
 
 
 def nested_load(view, options=None):
@@ -39,3 +40,16 @@ def nested_load(view, options=None):
 
             options = _UnboundLoad().options(*nested_loads)
     return options
+
+
+def notes_load():
+    """
+    SQL: eager load the analysis and study every note of an annotation is
+    serialized with.
+    """
+    return selectinload(Annotation.annotation_analyses).options(
+        selectinload(AnnotationAnalysis.analysis),
+        selectinload(AnnotationAnalysis.studyset_study).selectinload(
+            StudysetStudy.study
+        ),
+    )
@@ -0,0 +1,272 @@
+"""
+Columnar (NDJSON) representation of annotation notes
+
+The first line is a header object describing the annotation and naming the
+columns, every following line is a JSON array with the values of one
+analysis in column order::
+
+    {"id": ..., "studyset": ..., "note_keys": {...},
+     "columns": ["analysis", "study", "analysis_name", ..., "key1", "key2"]}
+    ["analysis id", "study id", "analysis name", ..., value1, value2]
+
+The same format updates notes in bulk, the descriptive columns are ignored
+on the way in. Columns are told apart by position, so note keys may share
+the name of a descriptive column.
+
+Notes are also exported as CSV, streamed from a server side cursor. The
+exported file is kept in the response cache and tagged with an ETag derived
+from ``Annotation.updated_at``, which the listeners in
+``models.event_listeners`` bump whenever a note changes. The legacy
+``?export=true`` JSON payload embeds the same export.
+"""
+import csv
+import io
+
+import orjson
+import sqlalchemy as sa
+from flask import Response, abort, request, stream_with_context
+
+from .caching import get_entry, set_entry
+from .compression import compress_variants, encoded_response, variant_etags
+from ..database import db
+from ..models import Analysis, AnnotationAnalysis, Study
+from ..models.data import validate_notes
+
+NDJSON_MIMETYPE = "application/x-ndjson"
+# notes fetched per round trip when streaming
+NOTE_BATCH_SIZE = 1000
+# exported CSV files are kept for a day (a new version gets a new key)
+CSV_CACHE_TIMEOUT = 24 * 60 * 60
+# larger exports are streamed every time instead of being cached
+CSV_CACHE_MAX_SIZE = 64 * 1024 * 1024
+CSV_CACHE_PREFIX = "annotation-csv:"
+INFO_COLUMNS = (
+    "analysis",
+    "study",
+    "analysis_name",
+    "study_name",
+    "study_year",
+    "authors",
+    "publication",
+)
+
+
+def notes_query(annotation_id):
+    """the descriptive columns and the note of every analysis"""
+    return (
+        sa.select(
+            AnnotationAnalysis.analysis_id,
+            AnnotationAnalysis.study_id,
+            Analysis.name,
+            Study.name,
+            Study.year,
+            Study.authors,
+            Study.publication,
+            AnnotationAnalysis.note,
+        )
+        .join(Analysis, Analysis.id == AnnotationAnalysis.analysis_id)
+        .join(Study, Study.id == AnnotationAnalysis.study_id)
+        .where(AnnotationAnalysis.annotation_id == annotation_id)
+        .order_by(AnnotationAnalysis.study_id, AnnotationAnalysis.analysis_id)
+    )
+
+
+def stream_notes(annotation):
+    """send the notes of an annotation as columnar NDJSON"""
+    note_keys = annotation.note_keys or {}
+    keys = list(note_keys)
+    header = {
+        "id": annotation.id,
+        "studyset": annotation.studyset_id,
+        "note_keys": note_keys,
+        "columns": [*INFO_COLUMNS, *keys],
+    }
+    stmt = notes_query(annotation.id)
+
+    def generate():
+        yield orjson.dumps(header) + b"\n"
+        result = db.session.execute(stmt, execution_options={"stream_results": True})
+        for rows in result.partitions(NOTE_BATCH_SIZE):
+            yield b"".join(
+                orjson.dumps([*row[:-1], *[(row[-1] or {}).get(k) for k in keys]])
+                + b"\n"
+                for row in rows
+            )
+
+    return Response(stream_with_context(generate()), mimetype=NDJSON_MIMETYPE)
+
+
+def notes_etag(annotation):
+    """entity tag of the current version of an annotation's notes"""
+    version = annotation.updated_at or annotation.created_at
+    return f"{annotation.id}-{version.timestamp()}"
+
+
+def _notes_csv_chunks(annotation):
+    """the notes of an annotation as CSV, one chunk per batch of rows"""
+    keys = list(annotation.note_keys or {})
+    stmt = (
+        sa.select(
+            AnnotationAnalysis.study_id,
+            AnnotationAnalysis.analysis_id,
+            AnnotationAnalysis.note,
+        )
+        .where(AnnotationAnalysis.annotation_id == annotation.id)
+        .order_by(AnnotationAnalysis.study_id, AnnotationAnalysis.analysis_id)
+    )
+    buf = io.StringIO()
+    writer = csv.writer(buf, lineterminator="\n")
+    writer.writerow(["study_id", "analysis_id", *keys])
+
+    def flush():
+        chunk = buf.getvalue().encode("utf-8")
+        buf.seek(0)
+        buf.truncate()
+        return chunk
+
+    result = db.session.execute(stmt, execution_options={"stream_results": True})
+    for rows in result.partitions(NOTE_BATCH_SIZE):
+        writer.writerows(
+            [study_id, analysis_id, *[(note or {}).get(k) for k in keys]]
+            for study_id, analysis_id, note in rows
+        )
+        yield flush()
+    if buf.tell():
+        yield flush()
+
+
+def _csv_headers(annotation):
+    return [("Content-Disposition", f'attachment; filename="{annotation.id}.csv"')]
+
+
+def _cache_notes_csv(annotation, data):
+    """keep an export (and its compressed variants) in the response cache"""
+    entry = (data, 200, _csv_headers(annotation), compress_variants(data))
+    set_entry(
+        CSV_CACHE_PREFIX + notes_etag(annotation), entry, timeout=CSV_CACHE_TIMEOUT
+    )
+
+
+def export_notes_csv(annotation):
+    """send the notes of an annotation as CSV, reusing the cached export"""
+    etag = notes_etag(annotation)
+    if any(tag in request.if_none_match for tag in variant_etags(etag)):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    cached = get_entry(CSV_CACHE_PREFIX + etag)
+    if cached is not None:
+        # compressed once, when the export was cached
+        data, _, headers, variants = cached
+        return encoded_response(
+            data, variants, headers=headers, mimetype="text/csv", etag=etag
+        )
+
+    def generate():
+        chunks, size = [], 0
+        for chunk in _notes_csv_chunks(annotation):
+            size += len(chunk)
+            if chunks is not None and size <= CSV_CACHE_MAX_SIZE:
+                chunks.append(chunk)
+            else:
+                chunks = None
+            yield chunk
+        if chunks is not None:
+            _cache_notes_csv(annotation, b"".join(chunks))
+
+    response = Response(
+        stream_with_context(generate()),
+        mimetype="text/csv",
+        headers=_csv_headers(annotation),
+    )
+    response.set_etag(etag)
+    return response
+
+
+def notes_csv(annotation):
+    """the whole CSV export of the notes of an annotation"""
+    cached = get_entry(CSV_CACHE_PREFIX + notes_etag(annotation))
+    if cached is not None:
+        return cached[0]
+    data = b"".join(_notes_csv_chunks(annotation))
+    if len(data) <= CSV_CACHE_MAX_SIZE:
+        _cache_notes_csv(annotation, data)
+    return data
+
+
+def export_notes_json(annotation):
+    """the legacy ``?export=true`` payload: metadata and the CSV export"""
+    metadata = {
+        "studyset_id": annotation.studyset_id,
+        "annotation_id": annotation.id,
+        "created_at": annotation.created_at,
+        **(annotation.metadata_ or {}),
+    }
+    return {
+        "metadata_": metadata,
+        "annotation_csv": notes_csv(annotation).decode("utf-8"),
+    }
+
+
+def parse_notes(lines):
+    """return the header and the {analysis id: note} of a columnar payload"""
+    lines = [line for line in lines if line.strip()]
+    if not lines:
+        abort(400, "the payload has no header")
+    try:
+        header = orjson.loads(lines[0])
+        rows = [orjson.loads(line) for line in lines[1:]]
+    except orjson.JSONDecodeError:
+        abort(400, "every line must be a JSON document")
+
+    # the descriptive columns come first, every following column is a note key
+    # (even one named like a descriptive column)
+    columns = header.get("columns") or []
+    if columns[: len(INFO_COLUMNS)] != list(INFO_COLUMNS):
+        abort(400, f"the columns must start with {list(INFO_COLUMNS)}")
+    analysis_col = INFO_COLUMNS.index("analysis")
+    key_cols = list(enumerate(columns))[len(INFO_COLUMNS) :]  # noqa E203
+
+    notes = {}
+    for row in rows:
+        if not isinstance(row, list) or len(row) != len(columns):
+            abort(400, f"every row must have {len(columns)} values")
+        if row[analysis_col] in notes:
+            abort(400, f"analysis {row[analysis_col]} has more than one row")
+        notes[row[analysis_col]] = {col: row[i] for i, col in key_cols}
+    return header, notes
+
+
+def update_notes(annotation, header, notes):
+    """write the parsed notes of an annotation with one bulk UPDATE"""
+    note_keys = header.get("note_keys") or annotation.note_keys or {}
+    analysis_ids = set(
+        db.session.execute(
+            sa.select(AnnotationAnalysis.analysis_id).where(
+                AnnotationAnalysis.annotation_id == annotation.id
+            )
+        ).scalars()
+    )
+    unknown = set(notes) - analysis_ids
+    if unknown:
+        abort(400, f"analyses are not part of the annotation: {sorted(unknown)}")
+    if note_keys != (annotation.note_keys or {}) and set(notes) != analysis_ids:
+        abort(400, "changing note_keys requires a note for every analysis")
+
+    try:
+        validate_notes(note_keys, notes.values())
+    except ValueError as e:
+        abort(400, str(e))
+
+    db.session.bulk_update_mappings(
+        AnnotationAnalysis,
+        [
+            {"annotation_id": annotation.id, "analysis_id": analysis_id, "note": note}
+            for analysis_id, note in notes.items()
+        ],
+    )
+    annotation.note_keys = note_keys
+    # bump updated_at, the notes themselves bypass the unit of work
+    annotation.updated_at = sa.func.clock_timestamp()
+    db.session.commit()
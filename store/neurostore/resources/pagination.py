@@ -0,0 +1,61 @@
+"""
+Keyset (cursor) pagination and approximate counts for list endpoints
+
+A cursor encodes the sort value and id of the last record of a page, the
+next page seeks past it using the ``(sort column, id)`` ordering instead of
+an ``OFFSET`` scan, so deep pages cost the same as the first one.
+"""
+import base64
+import binascii
+
+import orjson
+import sqlalchemy as sa
+from flask import abort
+
+from ..database import db
+
+
+def encode_cursor(value, record_id):
+    """opaque cursor pointing just after a record"""
+    return base64.urlsafe_b64encode(orjson.dumps([value, record_id])).decode("ascii")
+
+
+def decode_cursor(cursor):
+    """return the (sort value, id) a cursor points after"""
+    try:
+        value, record_id = orjson.loads(base64.urlsafe_b64decode(cursor))
+    except (ValueError, TypeError, binascii.Error, orjson.JSONDecodeError):
+        abort(400, "invalid cursor")
+    return value, record_id
+
+
+def keyset_filter(attr, id_attr, value, record_id, desc):
+    """rows ordered after (value, record_id)
+
+    postgres sorts NULLs last in ascending and first in descending order,
+    the filter follows the same convention.
+    """
+    if value is None:
+        after_null = (id_attr < record_id) if desc else (id_attr > record_id)
+        in_nulls = sa.and_(attr.is_(None), after_null)
+        return sa.or_(in_nulls, attr.isnot(None)) if desc else in_nulls
+
+    key = sa.tuple_(attr, id_attr)
+    if desc:
+        return key < (value, record_id)
+    return sa.or_(key > (value, record_id), attr.is_(None))
+
+
+def estimate_count(q):
+    """planner estimate of the number of rows returned by a query"""
+    connection = db.session.connection()
+    stmt = q.enable_eagerloads(False).order_by(None).statement
+    compiled = stmt.compile(
+        dialect=connection.dialect, compile_kwargs={"render_postcompile": True}
+    )
+    plan = connection.exec_driver_sql(
+        "EXPLAIN (FORMAT JSON) " + str(compiled), compiled.params
+    ).scalar()
+    if isinstance(plan, (str, bytes)):
+        plan = orjson.loads(plan)
+    return int(plan[0]["Plan"]["Plan Rows"])
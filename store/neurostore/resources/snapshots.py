@@ -0,0 +1,208 @@
+"""
+Materialized nested studyset snapshots
+
+The serialized snapshot of every study and every studyset is stored in the
+database. Writes mark the touched studies (and the studysets containing
+them) stale through the listeners in ``models.event_listeners`` and the
+write handlers queue those studysets in redis. ``flask refresh-snapshots
+--watch`` rebuilds the queued studysets with :func:`refresh_snapshots`,
+re-serializing only the studies that changed, so no request waits for it.
+Reads never write, a snapshot that is stale or missing is serialized in
+memory until it is stored again.
+
+Writes that bypass the ORM must invalidate the snapshots themselves with
+``models.event_listeners.invalidate_snapshots_of``, as the bulk (COPY)
+ingestion does; ``flask refresh-snapshots`` then stores them again.
+Annotation notes are not part of the snapshots, so their bulk updates need
+not.
+"""
+import time
+
+import orjson
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import selectinload
+
+from .caching import _client
+from ..database import db
+from ..models import (
+    Study,
+    Analysis,
+    AnalysisConditions,
+    Point,
+    Studyset,
+    StudysetStudy,
+    StudySnapshotBlob,
+    StudysetSnapshotBlob,
+)
+from ..schemas.data import StudysetSnapshot
+
+# number of stale studies to load and serialize at once
+REBUILD_CHUNK_SIZE = 500
+# redis set of the studysets whose snapshots writes made stale
+STALE_SNAPSHOTS_KEY = "stale-snapshots"
+# studysets rebuilt per transaction when refreshing the queue
+REFRESH_BATCH_SIZE = 50
+
+STUDY_SNAPSHOT_OPTIONS = (
+    selectinload(Study.analyses).options(
+        selectinload(Analysis.points).selectinload(Point.values),
+        selectinload(Analysis.images),
+        selectinload(Analysis.analysis_conditions).selectinload(
+            AnalysisConditions.condition
+        ),
+    ),
+)
+
+
+def _store_blob(model, key, record_id, version, data):
+    """store a rebuilt blob unless a writer invalidated it in the meantime"""
+    table = model.__table__
+    if version is None:
+        stmt = (
+            insert(table)
+            .values({key: record_id, "version": 0, "data": data})
+            .on_conflict_do_nothing()
+        )
+    else:
+        stmt = (
+            table.update()
+            .where(table.c[key] == record_id, table.c.version == version)
+            .values(data=data)
+        )
+    db.session.execute(stmt)
+
+
+def load_study_snapshots(study_ids, store=False):
+    """return {study_id: serialized study}, serializing the stale studies
+
+    The rebuilt fragments are only written back when ``store`` is set.
+    """
+    rows = db.session.execute(
+        sa.select(
+            StudySnapshotBlob.study_id,
+            StudySnapshotBlob.version,
+            StudySnapshotBlob.data,
+        ).where(StudySnapshotBlob.study_id.in_(study_ids))
+    )
+    versions = {}
+    fragments = {}
+    for study_id, version, data in rows:
+        versions[study_id] = version
+        if data is not None:
+            fragments[study_id] = data
+
+    stale = [study_id for study_id in study_ids if study_id not in fragments]
+    snapshot = StudysetSnapshot()
+    for start in range(0, len(stale), REBUILD_CHUNK_SIZE):
+        chunk = stale[start : start + REBUILD_CHUNK_SIZE]  # noqa E203
+        studies = Study.query.filter(Study.id.in_(chunk)).options(
+            *STUDY_SNAPSHOT_OPTIONS
+        )
+        for study in studies:
+            data = orjson.dumps(snapshot.dump_study(study))
+            if store:
+                _store_blob(
+                    StudySnapshotBlob,
+                    "study_id",
+                    study.id,
+                    versions.get(study.id),
+                    data,
+                )
+            fragments[study.id] = data
+
+    return fragments
+
+
+def build_studyset_snapshot(studyset, version=None, store=False):
+    """serialize the nested snapshot of a studyset from its study fragments"""
+    header = orjson.dumps(StudysetSnapshot().dump_header(studyset))
+    study_ids = (
+        db.session.execute(
+            sa.select(StudysetStudy.study_id).where(
+                StudysetStudy.studyset_id == studyset.id
+            )
+        )
+        .scalars()
+        .all()
+    )
+    fragments = load_study_snapshots(study_ids, store=store)
+    studies = b",".join(fragments[s_id] for s_id in study_ids if s_id in fragments)
+    data = header[:-1] + b',"studies":[' + studies + b"]}"
+    if store:
+        _store_blob(StudysetSnapshotBlob, "studyset_id", studyset.id, version, data)
+    return data
+
+
+def load_studyset_snapshots(studysets):
+    """return the serialized nested snapshots (bytes) of the studysets
+
+    The stored snapshots are fetched with one query. Reads never write: a
+    stale snapshot is serialized in memory until :func:`refresh_snapshots`
+    stores it again.
+    """
+    blobs = dict(
+        db.session.execute(
+            sa.select(
+                StudysetSnapshotBlob.studyset_id, StudysetSnapshotBlob.data
+            ).where(
+                StudysetSnapshotBlob.studyset_id.in_([s.id for s in studysets]),
+                StudysetSnapshotBlob.data.isnot(None),
+            )
+        ).all()
+    )
+    return [blobs.get(s.id) or build_studyset_snapshot(s) for s in studysets]
+
+
+def load_studyset_snapshot(studyset):
+    """return the serialized nested snapshot (bytes) of a studyset"""
+    return load_studyset_snapshots([studyset])[0]
+
+
+def refresh_snapshots(studyset_ids=None):
+    """rebuild and store the stale or missing snapshots, the caller commits
+
+    Only the listed studysets are considered (every studyset by default).
+    Returns the number of studysets rebuilt.
+    """
+    blobs = StudysetSnapshotBlob.__table__
+    q = (
+        sa.select(Studyset, blobs.c.version)
+        .outerjoin(blobs, blobs.c.studyset_id == Studyset.id)
+        .where(blobs.c.data.is_(None))
+    )
+    if studyset_ids is not None:
+        q = q.where(Studyset.id.in_(list(studyset_ids)))
+    count = 0
+    for studyset, version in db.session.execute(q).all():
+        build_studyset_snapshot(studyset, version=version, store=True)
+        count += 1
+    return count
+
+
+def queue_stale_snapshots(studyset_ids):
+    """queue the studysets whose snapshots a committed write made stale"""
+    if studyset_ids:
+        _client().sadd(STALE_SNAPSHOTS_KEY, *studyset_ids)
+
+
+def refresh_queued_snapshots(batch=REFRESH_BATCH_SIZE):
+    """rebuild (and commit) the snapshots of up to ``batch`` queued studysets
+
+    Returns the number of studysets taken from the queue. Those that fail
+    stay stale and are rebuilt by the next full refresh.
+    """
+    studyset_ids = [
+        s_id.decode("utf8") for s_id in _client().spop(STALE_SNAPSHOTS_KEY, batch) or []
+    ]
+    if studyset_ids:
+        refresh_snapshots(studyset_ids)
+        db.session.commit()
+    return len(studyset_ids)
+
+
+def watch_stale_snapshots(interval=1):
+    """keep rebuilding the snapshots queued by the writes"""
+    while True:
+        if not refresh_queued_snapshots():
+            time.sleep(interval)
@@ -0,0 +1,75 @@
+"""
+Spatial (sphere and box) searches over coordinates
+
+Every point is bucketed into a cell of a coarse grid (``Point.voxel``, an
+indexed computed column). A search first restricts the points to the cells
+overlapping the query region through the index, then applies the exact
+bounds to the few remaining candidates.
+"""
+import itertools
+
+import sqlalchemy as sa
+from webargs import fields, validate
+
+from ..models import Point
+from ..models.data import voxel_axis, voxel_key
+
+# beyond this many cells the grid no longer narrows the search usefully
+MAX_VOXELS = 4096
+
+SPATIAL_ARGS = {
+    "near": fields.DelimitedList(
+        fields.Float(), validate=validate.Length(equal=3), missing=None
+    ),
+    "radius": fields.Float(missing=10.0, validate=validate.Range(min=0)),
+    "box": fields.DelimitedList(
+        fields.Float(), validate=validate.Length(equal=6), missing=None
+    ),
+}
+
+
+def box_filter(lower, upper):
+    """points within the axis aligned box spanning ``lower`` to ``upper``"""
+    lower, upper = (
+        [min(lo, hi) for lo, hi in zip(lower, upper)],
+        [max(lo, hi) for lo, hi in zip(lower, upper)],
+    )
+    clauses = [
+        col.between(lo, hi)
+        for col, lo, hi in zip((Point.x, Point.y, Point.z), lower, upper)
+    ]
+
+    cells = [range(voxel_axis(lo), voxel_axis(hi) + 1) for lo, hi in zip(lower, upper)]
+    if len(cells[0]) * len(cells[1]) * len(cells[2]) <= MAX_VOXELS:
+        keys = [voxel_key(i, j, k) for i, j, k in itertools.product(*cells)]
+        clauses.insert(0, Point.voxel.in_(keys))
+
+    return sa.and_(*clauses)
+
+
+def sphere_filter(center, radius):
+    """points within ``radius`` (mm) of ``center``"""
+    distance = sum(
+        (col - c) * (col - c) for col, c in zip((Point.x, Point.y, Point.z), center)
+    )
+    return sa.and_(
+        box_filter([c - radius for c in center], [c + radius for c in center]),
+        distance <= radius * radius,
+    )
+
+
+def spatial_filter(args, space=None):
+    """filter on the points selected by the ``near``/``radius`` and ``box``
+    arguments (None when no spatial search was requested)"""
+    clauses = []
+    if args.get("near"):
+        clauses.append(sphere_filter(args["near"], args["radius"]))
+    if args.get("box"):
+        clauses.append(box_filter(args["box"][:3], args["box"][3:]))
+    if not clauses:
+        return None
+
+    if space:
+        # an equality on the indexed expression keeps the prefilter on the index
+        clauses.append(sa.func.upper(Point.space) == space.upper())
+    return sa.and_(*clauses)
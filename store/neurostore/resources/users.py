@@ -1,8 +1,8 @@
-import connexion
 from flask import request, abort
 from webargs.flaskparser import parser
 
 from .data import ListView, ObjectView
+from .utils import get_current_user
 from ..models.auth import User
 from ..schemas import UserSchema  # noqa E401
 from ..database import db
@@ -30,9 +30,7 @@ class UsersView(ObjectView, ListView):
         return self.__class__._schema().dump(record)
 
     def put(self, id):
-        current_user = User.query.filter_by(
-            external_id=connexion.context["user"]
-        ).first()
+        current_user = get_current_user()
         data = parser.parse(self.__class__._schema, request)
         if id != data["id"] or id != current_user.id:
             return abort(422)
@@ -4,8 +4,11 @@ Utilities for View construction and function
 import re
 
 import connexion
+from flask import g
+from sqlalchemy.orm import object_session
 
 from .. import models
+from ..database import db
 from .. import schemas
 from .singular import singularize
 
@@ -16,12 +19,24 @@ def camel_case_split(str):
 
 
 def get_current_user():
-    user = connexion.context.get("user")
-    if user:
-        return models.User.query.filter_by(
-            external_id=connexion.context["user"]
-        ).first()
-    return None
+    """return the user making the request, looked up at most once per request"""
+    external_id = connexion.context.get("user")
+    if not external_id:
+        return None
+
+    memo = g.get("current_user")
+    if (
+        memo is not None
+        and memo[0] == external_id
+        and object_session(memo[1]) is db.session()
+    ):
+        return memo[1]
+
+    user = models.User.query.filter_by(external_id=external_id).first()
+    if user is not None:
+        # users that do not exist yet are created later in the request
+        g.current_user = (external_id, user)
+    return user
 
 
 def view_maker(cls):
@@ -12,7 +12,6 @@ from flask import request
 import orjson
 from marshmallow.decorators import post_load
 from pyld import jsonld
-import pandas as pd
 
 
 class BooleanOrString(fields.Field):
@@ -418,27 +417,6 @@ class AnnotationSchema(BaseDataSchema):
 
         return data
 
-    @pre_dump
-    def export_annotations(self, data, **kwargs):
-        if getattr(data, "annotation_analyses") and self.context.get("export"):
-            annotations = pd.DataFrame.from_records(
-                [
-                    {"study_id": aa.study_id, "analysis_id": aa.analysis_id, **aa.note}
-                    for aa in data.annotation_analyses
-                ]
-            ).to_csv(index=False)
-            metadata = {
-                "studyset_id": data.studyset_id,
-                "annotation_id": data.id,
-                "created_at": data.created_at,
-            }
-            metadata = {**metadata, **data.metadata_} if data.metadata_ else metadata
-            export_data = {"metadata_": metadata, "annotation_csv": annotations}
-
-            return export_data
-
-        return data
-
     @post_load
     def add_id(self, data, **kwargs):
         if isinstance(data.get("studyset_id"), str):
@@ -499,6 +477,12 @@ class StudysetSnapshot(object):
         return dt.isoformat() if dt else dt
 
     def dump(self, studyset):
+        return {
+            **self.dump_header(studyset),
+            "studies": [self.dump_study(s) for s in studyset.studies],
+        }
+
+    def dump_header(self, studyset):
         return {
             "id": studyset.id,
             "name": studyset.name,
@@ -509,91 +493,86 @@ class StudysetSnapshot(object):
             "pmid": studyset.pmid,
             "created_at": self._serialize_dt(studyset.created_at),
             "updated_at": self._serialize_dt(studyset.updated_at),
-            "studies": [
+        }
+
+    def dump_study(self, s):
+        return {
+            "id": s.id,
+            "created_at": self._serialize_dt(s.created_at),
+            "updated_at": self._serialize_dt(s.updated_at),
+            "user": s.user_id,
+            "name": s.name,
+            "description": s.description,
+            "publication": s.publication,
+            "doi": s.doi,
+            "pmid": s.pmid,
+            "authors": s.authors,
+            "year": s.year,
+            "metadata": s.metadata_,
+            "source": s.source,
+            "source_id": s.source_id,
+            "source_updated_at": self._serialize_dt(s.source_updated_at),
+            "analyses": [
                 {
-                    "id": s.id,
-                    "created_at": self._serialize_dt(s.created_at),
-                    "updated_at": self._serialize_dt(s.updated_at),
-                    "user": s.user_id,
-                    "name": s.name,
-                    "description": s.description,
-                    "publication": s.publication,
-                    "doi": s.doi,
-                    "pmid": s.pmid,
-                    "authors": s.authors,
-                    "year": s.year,
-                    "metadata": s.metadata_,
-                    "source": s.source,
-                    "source_id": s.source_id,
-                    "source_updated_at": self._serialize_dt(s.source_updated_at),
-                    "analyses": [
+                    "id": a.id,
+                    "created_at": self._serialize_dt(a.created_at),
+                    "updated_at": self._serialize_dt(a.updated_at),
+                    "user": a.user_id,
+                    "study": s.id,
+                    "name": a.name,
+                    "description": a.description,
+                    "conditions": [
                         {
-                            "id": a.id,
-                            "created_at": self._serialize_dt(a.created_at),
-                            "updated_at": self._serialize_dt(a.updated_at),
-                            "user": a.user_id,
-                            "study": s.id,
-                            "name": a.name,
-                            "description": a.description,
-                            "conditions": [
-                                {
-                                    "id": ac.condition_id,
-                                    "user": ac.condition.user_id,
-                                    "name": ac.condition.name,
-                                    "description": ac.condition.description,
-                                    "created_at": self._serialize_dt(
-                                        ac.condition.created_at
-                                    ),
-                                    "updated_at": self._serialize_dt(
-                                        ac.condition.updated_at
-                                    ),
-                                }
-                                for ac in a.analysis_conditions
-                            ],
-                            "weights": list(a.weights),
-                            "points": [
-                                {
-                                    "id": p.id,
-                                    "created_at": self._serialize_dt(p.created_at),
-                                    "updated_at": self._serialize_dt(p.updated_at),
-                                    "user": p.user_id,
-                                    "coordinates": p.coordinates,
-                                    "analysis": a.id,
-                                    "kind": p.kind,
-                                    "space": p.space,
-                                    "image": p.image,
-                                    "label_id": p.label_id,
-                                    "values": [
-                                        {
-                                            "kind": v.kind,
-                                            "value": v.value,
-                                        }
-                                        for v in p.values
-                                    ],
-                                }
-                                for p in a.points
-                            ],
-                            "images": [
+                            "id": ac.condition_id,
+                            "user": ac.condition.user_id,
+                            "name": ac.condition.name,
+                            "description": ac.condition.description,
+                            "created_at": self._serialize_dt(ac.condition.created_at),
+                            "updated_at": self._serialize_dt(ac.condition.updated_at),
+                        }
+                        for ac in a.analysis_conditions
+                    ],
+                    "weights": list(a.weights),
+                    "points": [
+                        {
+                            "id": p.id,
+                            "created_at": self._serialize_dt(p.created_at),
+                            "updated_at": self._serialize_dt(p.updated_at),
+                            "user": p.user_id,
+                            "coordinates": p.coordinates,
+                            "analysis": a.id,
+                            "kind": p.kind,
+                            "space": p.space,
+                            "image": p.image,
+                            "label_id": p.label_id,
+                            "values": [
                                 {
-                                    "id": i.id,
-                                    "created_at": self._serialize_dt(i.created_at),
-                                    "updated_at": self._serialize_dt(i.updated_at),
-                                    "user": i.user_id,
-                                    "analysis": a.id,
-                                    "analysis_name": a.name,
-                                    "url": i.url,
-                                    "space": i.space,
-                                    "value_type": i.value_type,
-                                    "filename": i.filename,
-                                    "add_date": i.add_date,
+                                    "kind": v.kind,
+                                    "value": v.value,
                                 }
-                                for i in a.images
+                                for v in p.values
                             ],
                         }
-                        for a in s.analyses
+                        for p in a.points
+                    ],
+                    "images": [
+                        {
+                            "id": i.id,
+                            "created_at": self._serialize_dt(i.created_at),
+                            "updated_at": self._serialize_dt(i.updated_at),
+                            "user": i.user_id,
+                            "analysis": a.id,
+                            "analysis_name": a.name,
+                            "url": i.url,
+                            "space": i.space,
+                            "value_type": i.value_type,
+                            "filename": i.filename,
+                            "add_date": i.add_date,
+                        }
+                        for i in a.images
                     ],
                 }
-                for s in studyset.studies
+                for a in s.analyses
             ],
         }
 
@@ -1,3 +1,7 @@
+import io
+
+import numpy as np
+
 from ..request_utils import decode_json
 from ...models import Analysis, User, Point, Image
 from ...schemas import AnalysisSchema
@@ -124,3 +128,15 @@ def test_update_points_analyses(auth_client, ingest_neurovault, session):
         == set(p for p in get.json["points"])
         == set(p for p in payload["points"])
     )
+
+
+def test_analyses_coordinates(auth_client, ingest_neurosynth):
+    resp = auth_client.get("/api/analyses/?format=npz&page_size=5")
+    assert resp.status_code == 200
+
+    payload = np.load(io.BytesIO(resp.data))
+    assert len(payload["analysis_ids"]) <= 5
+    n_points = Point.query.filter(
+        Point.analysis_id.in_(payload["analysis_ids"].tolist())
+    ).count()
+    assert payload["coordinates"].shape == (n_points, 3)
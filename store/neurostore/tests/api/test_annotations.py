@@ -1,6 +1,9 @@
+import json
+
 import pytest
 
-from ...models import Studyset, User
+from ...database import db
+from ...models import Analysis, Annotation, Study, Studyset, User
 
 
 def test_post_blank_annotation(auth_client, ingest_neurosynth):
@@ -314,3 +317,170 @@ def test_correct_note_overwrite(auth_client, ingest_neurosynth):
         == put_resp.json["notes"][0]["note"]["doo"]
         == new_value
     )
+
+
+def test_columnar_notes(auth_client, ingest_neurosynth):
+    dset = Studyset.query.first()
+    notes = [
+        {"study": s.id, "analysis": a.id, "note": {"foo": a.id, "bar": 1}}
+        for s in dset.studies
+        for a in s.analyses
+    ]
+    payload = {
+        "studyset": dset.id,
+        "notes": notes,
+        "note_keys": {"foo": "string", "bar": "number"},
+        "name": "mah notes",
+    }
+    annot_id = auth_client.post("/api/annotations/", data=payload).json["id"]
+
+    resp = auth_client.get(f"/api/annotations/{annot_id}?format=ndjson")
+    assert resp.status_code == 200
+    header, *rows = [json.loads(line) for line in resp.data.splitlines() if line]
+    columns = header["columns"]
+    assert set(columns) >= {"analysis", "study", "foo", "bar"}
+    assert len(rows) == len(notes)
+    for row in rows:
+        assert row[columns.index("foo")] == row[columns.index("analysis")]
+
+    # bulk update through the same format
+    for row in rows:
+        row[columns.index("bar")] = 2
+    body = b"\n".join(json.dumps(line).encode() for line in [header, *rows])
+    put_resp = auth_client.put(
+        f"/api/annotations/{annot_id}",
+        data=body,
+        content_type="application/x-ndjson",
+        json_dump=False,
+    )
+    assert put_resp.status_code == 200
+    # only what identifies the new version is sent back
+    assert set(put_resp.json) == {"id", "updated_at"}
+    resp = auth_client.get(f"/api/annotations/{annot_id}")
+    assert {n["note"]["bar"] for n in resp.json["notes"]} == {2}
+
+    # an analysis cannot be updated twice
+    body = b"\n".join(json.dumps(line).encode() for line in [header, *rows, rows[0]])
+    dup_resp = auth_client.put(
+        f"/api/annotations/{annot_id}",
+        data=body,
+        content_type="application/x-ndjson",
+        json_dump=False,
+    )
+    assert dup_resp.status_code == 400
+
+    # values must match the declared types
+    rows[0][columns.index("bar")] = "two"
+    body = b"\n".join(json.dumps(line).encode() for line in [header, *rows])
+    bad_resp = auth_client.put(
+        f"/api/annotations/{annot_id}",
+        data=body,
+        content_type="application/x-ndjson",
+        json_dump=False,
+    )
+    assert bad_resp.status_code == 400
+
+
+def test_columnar_notes_info_named_keys(auth_client, ingest_neurosynth):
+    dset = Studyset.query.first()
+    notes = [
+        {"study": s.id, "analysis": a.id, "note": {"study": "x", "authors": 1}}
+        for s in dset.studies
+        for a in s.analyses
+    ]
+    payload = {
+        "studyset": dset.id,
+        "notes": notes,
+        "note_keys": {"study": "string", "authors": "number"},
+        "name": "clashing keys",
+    }
+    annot_id = auth_client.post("/api/annotations/", data=payload).json["id"]
+
+    resp = auth_client.get(f"/api/annotations/{annot_id}?format=ndjson")
+    header, *rows = [json.loads(line) for line in resp.data.splitlines() if line]
+    # the note keys follow the descriptive columns of the same names
+    study_key, authors_key = len(header["columns"]) - 2, len(header["columns"]) - 1
+    for row in rows:
+        row[study_key], row[authors_key] = "y", 2
+    body = b"\n".join(json.dumps(line).encode() for line in [header, *rows])
+    put_resp = auth_client.put(
+        f"/api/annotations/{annot_id}",
+        data=body,
+        content_type="application/x-ndjson",
+        json_dump=False,
+    )
+    assert put_resp.status_code == 200
+    resp = auth_client.get(f"/api/annotations/{annot_id}")
+    assert all(n["note"] == {"study": "y", "authors": 2} for n in resp.json["notes"])
+
+
+def test_csv_export(auth_client, ingest_neurosynth):
+    dset = Studyset.query.first()
+    notes = [
+        {"study": s.id, "analysis": a.id, "note": {"foo": a.id, "bar": 1}}
+        for s in dset.studies
+        for a in s.analyses
+    ]
+    payload = {
+        "studyset": dset.id,
+        "notes": notes,
+        "note_keys": {"foo": "string", "bar": "number"},
+        "name": "mah notes",
+    }
+    annot_id = auth_client.post("/api/annotations/", data=payload).json["id"]
+
+    resp = auth_client.get(f"/api/annotations/{annot_id}?format=csv")
+    assert resp.status_code == 200
+    etag = resp.headers["ETag"]
+    header, *rows = resp.data.decode().splitlines()
+    assert header == "study_id,analysis_id,foo,bar"
+    assert len(rows) == len(notes)
+
+    # unchanged notes are not sent again
+    headers = {**auth_client._get_headers(), "If-None-Match": etag}
+    cached = auth_client.get(f"/api/annotations/{annot_id}?format=csv", headers=headers)
+    assert cached.status_code == 304
+
+    # editing a note produces a new version
+    annot = Annotation.query.filter_by(id=annot_id).one()
+    annot.annotation_analyses[0].note = {"foo": "changed", "bar": 2}
+    db.session.commit()
+    changed = auth_client.get(
+        f"/api/annotations/{annot_id}?format=csv", headers=headers
+    )
+    assert changed.status_code == 200
+    assert changed.headers["ETag"] != etag
+    assert "changed" in changed.data.decode()
+
+    # the legacy export embeds the same CSV
+    legacy = auth_client.get(f"/api/annotations/{annot_id}?export=true")
+    assert legacy.json["metadata_"]["annotation_id"] == annot_id
+    assert legacy.json["annotation_csv"] == changed.data.decode()
+
+
+def test_blank_notes_have_note_keys(auth_client, ingest_neurosynth):
+    dset = Studyset.query.first()
+    payload = {
+        "studyset": dset.id,
+        "note_keys": {"include": "boolean"},
+        "name": "mah notes",
+    }
+    resp = auth_client.post("/api/annotations/", data=payload)
+    assert resp.status_code == 200
+    assert len(resp.json["notes"]) == sum(len(s.analyses) for s in dset.studies)
+    assert all(n["note"] == {"include": None} for n in resp.json["notes"])
+
+
+def test_blank_notes_without_note_keys(session, ingest_neurosynth):
+    dset = Studyset.query.first()
+    annotation = Annotation(name="no keys", studyset=dset)
+    db.session.add(annotation)
+    db.session.commit()
+    assert all(aa.note == {} for aa in annotation.annotation_analyses)
+
+    # notes of studies added later are inserted in bulk, also as {}
+    study = Study(name="new study", analyses=[Analysis(name="new analysis")])
+    dset.studies = [*dset.studies, study]
+    db.session.commit()
+    notes = [aa for aa in annotation.annotation_analyses if aa.study_id == study.id]
+    assert [aa.note for aa in notes] == [{}]
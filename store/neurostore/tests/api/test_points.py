@@ -103,3 +103,25 @@ def test_delete_points(auth_client, session):
     auth_client.delete(f"/api/points/{point_id}")
 
     assert Point.query.filter_by(id=point_id).first() is None
+
+
+def test_spatial_search(auth_client, ingest_neurosynth):
+    point = Point.query.filter(Point.x.isnot(None)).first()
+    x, y, z = point.coordinates
+
+    near = auth_client.get(f"/api/points/?near={x},{y},{z}&radius=1&page_size=100")
+    assert near.status_code == 200
+    assert point.id in [p["id"] for p in near.json["results"]]
+    for p in near.json["results"]:
+        distance = sum((a - b) ** 2 for a, b in zip(p["coordinates"], (x, y, z)))
+        assert distance <= 1
+
+    box = f"{x - 1},{y - 1},{z - 1},{x + 1},{y + 1},{z + 1}"
+    in_box = auth_client.get(f"/api/points/?box={box}&page_size=100")
+    assert point.id in [p["id"] for p in in_box.json["results"]]
+
+    studies = auth_client.get(f"/api/studies/?near={x},{y},{z}&radius=1")
+    assert point.analysis.study.id in [s["id"] for s in studies.json["results"]]
+
+    far = auth_client.get("/api/studies/?near=1000,1000,1000&radius=1")
+    assert far.json["results"] == []
@@ -1,3 +1,5 @@
+import json
+
 import pytest
 from ...models import Study
 from ...schemas.data import StudysetSchema, StudySchema, AnalysisSchema, StringOrNested
@@ -95,3 +97,42 @@ def test_multiword_queries(auth_client, ingest_neurosynth):
 
     multi_word_search = auth_client.get(f"/api/studies/?search={multiple_words}")
     assert multi_word_search.status_code == 200
+
+
+def test_ndjson_format(auth_client, ingest_neurosynth):
+    reg_resp = auth_client.get("/api/studies/?page_size=5")
+    stream_resp = auth_client.get("/api/studies/?page_size=5&format=ndjson")
+
+    assert stream_resp.status_code == 200
+    assert stream_resp.mimetype == "application/x-ndjson"
+    records = [json.loads(line) for line in stream_resp.data.splitlines() if line]
+    assert [r["id"] for r in records] == [r["id"] for r in reg_resp.json["results"]]
+
+    # unknown formats are rejected rather than answered with JSON
+    assert auth_client.get("/api/studies/?format=xml").status_code == 422
+
+
+@pytest.mark.parametrize("sort", ["created_at", "name"])
+def test_cursor_pagination(auth_client, ingest_neurosynth, sort):
+    reg_resp = auth_client.get(f"/api/studies/?sort={sort}&page_size=30")
+    expected = [r["id"] for r in reg_resp.json["results"]]
+
+    ids = []
+    cursor = ""
+    while cursor is not None:
+        resp = auth_client.get(
+            f"/api/studies/?sort={sort}&page_size=2&cursor={cursor}&count=none"
+        )
+        assert resp.status_code == 200
+        assert resp.json["metadata"]["total_count"] is None
+        ids.extend(r["id"] for r in resp.json["results"])
+        cursor = resp.json["metadata"]["next"]
+
+    assert ids == expected
+
+
+def test_estimated_count(auth_client, ingest_neurosynth):
+    resp = auth_client.get("/api/studies/?count=estimate")
+
+    assert resp.status_code == 200
+    assert isinstance(resp.json["metadata"]["total_count"], int)
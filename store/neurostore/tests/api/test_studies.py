@@ -252,3 +252,185 @@ def test_studies_flat(auth_client, ingest_neurosynth):
 
     assert "analyses" not in flat_resp.json["results"][0]
     assert "analyses" in reg_resp.json["results"][0]
+
+
+def test_cache_list_invalidation(auth_client, user_data):
+    study_entry = Study.query.filter_by(user_id=auth_client.username).first()
+    # cache the list page containing the study
+    auth_client.get(f"/api/studies/?user_id={auth_client.username}")
+    auth_client.put(f"/api/studies/{study_entry.id}", data={"name": "new name"})
+    resp = auth_client.get(f"/api/studies/?user_id={auth_client.username}")
+
+    names = {s["id"]: s["name"] for s in resp.json["results"]}
+    assert names[study_entry.id] == "new name"
+
+
+def test_put_nested_study_batches_lookups(auth_client, user_data, statements):
+    study_entry = Study.query.filter_by(user_id=auth_client.username).first()
+    study = auth_client.get(f"/api/studies/{study_entry.id}?nested=true").json
+    payload = {
+        "analyses": [
+            {
+                "id": analysis["id"],
+                "name": "renamed",
+                "points": [{"id": p["id"]} for p in analysis["points"]],
+            }
+            for analysis in study["analyses"]
+        ]
+    }
+
+    del statements[:]
+    put_resp = auth_client.put(f"/api/studies/{study_entry.id}", data=payload)
+    lookups = [
+        s
+        for s in statements
+        if "WHERE points.id = " in s or "WHERE analyses.id = " in s
+    ]
+
+    assert put_resp.status_code == 200
+    assert lookups == []
+    assert {a["name"] for a in put_resp.json["analyses"]} == {"renamed"}
+
+
+def test_conditional_get(auth_client, user_data):
+    study_entry = Study.query.filter_by(user_id=auth_client.username).first()
+    path = f"/api/studies/{study_entry.id}"
+    resp = auth_client.get(path)
+    etag = resp.headers["ETag"]
+    assert resp.headers["Last-Modified"]
+
+    headers = {**auth_client._get_headers(), "If-None-Match": etag}
+    assert auth_client.get(path, headers=headers).status_code == 304
+
+    # changing a nested analysis changes the version of the study
+    analysis_id = study_entry.analyses[0].id
+    auth_client.put(f"/api/analyses/{analysis_id}", data={"name": "changed"})
+    resp = auth_client.get(path, headers=headers)
+    assert resp.status_code == 200
+    assert resp.headers["ETag"] != etag
+
+
+def test_conditional_get_after_direct_write(auth_client, user_data, session):
+    study_entry = Study.query.filter_by(user_id=auth_client.username).first()
+    path = f"/api/studies/{study_entry.id}"
+    etag = auth_client.get(path).headers["ETag"]
+
+    # writes that do not go through the views change the version as well
+    study_entry.name = "changed outside the api"
+    session.commit()
+    headers = {**auth_client._get_headers(), "If-None-Match": etag}
+    resp = auth_client.get(path, headers=headers)
+    assert resp.status_code == 200
+    assert resp.json["name"] == "changed outside the api"
+
+
+def test_nested_writes_version_their_parents(auth_client, user_data, session, caching):
+    study_entry = Study.query.filter_by(user_id=auth_client.username).first()
+    analysis = next(a for a in study_entry.analyses if a.points)
+    point = analysis.points[0]
+    study_path = f"/api/studies/{study_entry.id}"
+    etag = auth_client.get(study_path).headers["ETag"]
+
+    # reading a resource never creates its version
+    assert caching.resource_version(f"/api/points/{point.id}") == ""
+    client = caching._client()
+    assert client.get(f"{caching.VERSION_PREFIX}/api/points/{point.id}") is None
+
+    point.x = (point.x or 0) + 1
+    session.commit()
+    assert client.get(f"{caching.VERSION_PREFIX}/api/analyses/{analysis.id}")
+    assert client.get(f"{caching.VERSION_PREFIX}/api/points/{point.id}") is None
+    headers = {**auth_client._get_headers(), "If-None-Match": etag}
+    assert auth_client.get(study_path, headers=headers).status_code == 200
+
+
+def test_shared_cache_entries(auth_clients, user_data, caching):
+    study_entry = Study.query.filter_by(public=True).first()
+    path = f"/api/studies/{study_entry.id}"
+    responses = [client.get(path) for client in auth_clients[:2]]
+
+    # records are cached once for every user
+    assert responses[0].headers["ETag"] == responses[1].headers["ETag"]
+    assert caching.get_entry(f"{path}_()_") is not None
+
+
+def test_private_record_searched_after_write(auth_client, user_data):
+    auth_client.get("/api/studies/")
+
+    # what is remembered of the owner is forgotten once they write a record
+    resp = auth_client.post("/api/studies/", data={"name": "mine", "public": False})
+    study_id = resp.json["id"]
+    results = auth_client.get("/api/studies/").json["results"]
+    assert study_id in [r["id"] for r in results]
+
+
+def test_local_cache_tier(auth_client, user_data, monkeypatch, caching):
+    study_entry = Study.query.filter_by(user_id=auth_client.username).first()
+    path = f"/api/studies/{study_entry.id}"
+    first = auth_client.get(path)
+
+    # hot entries and their versions are served from the memory of the worker
+    with monkeypatch.context() as m:
+        m.setattr(caching, "_client", lambda: pytest.fail("redis was queried"))
+        m.setattr(caching, "flush_hits", lambda: None)
+        assert auth_client.get(path).json == first.json
+        headers = {**auth_client._get_headers(), "If-None-Match": first.headers["ETag"]}
+        assert auth_client.get(path, headers=headers).status_code == 304
+
+    # and dropped when the record changes
+    auth_client.put(path, data={"name": "new name"})
+    assert auth_client.get(path).json["name"] == "new name"
+
+
+def test_cached_bytes(auth_client, user_data, caching):
+    study_entry = Study.query.filter_by(user_id=auth_client.username).first()
+    path = f"/api/studies/{study_entry.id}"
+    resp = auth_client.get(path)
+
+    # redis holds the final body, served as is on a hit
+    body, status, headers, _ = caching.get_entry(f"{path}_()_")
+    assert status == 200
+    assert ("Content-Type", "application/json") in headers
+    assert body == auth_client.get(path).data == resp.data
+
+
+def test_warm_cache(app, auth_client, user_data, caching):
+    study_entry = Study.query.filter_by(user_id=auth_client.username).first()
+    path = f"/api/studies/{study_entry.id}"
+    auth_client.get(path)
+    caching.invalidate_cache_tags(path)
+    assert caching.get_entry(f"{path}_()_") is None
+
+    # the popular response is computed again before anyone asks for it
+    assert caching.warm_cache(app, top=10) == [f"{path}?"]
+    assert caching.get_entry(f"{path}_()_") is not None
+
+
+def test_warm_cache_skips_user_keys(app, auth_client, user_data, caching):
+    # warming replays anonymously, it cannot fill the keys of one user
+    caching.count_hit("/api/studies/_()_user1-id", "/api/studies/?")
+    caching.count_hit("/api/studies/_()_", "/api/studies/?")
+    caching.flush_hits()
+    keys = [key for key, _ in caching.popular_keys(100)]
+    assert "/api/studies/_()_" in keys
+    assert "/api/studies/_()_user1-id" not in keys
+
+
+def test_relevance_search(auth_client, ingest_neurosynth):
+    study_entry = Study.query.filter(Study.name.isnot(None)).first()
+    word = max(study_entry.name.split(), key=len).strip(".,:;()")
+    resp = auth_client.get(
+        f"/api/studies/?search={word}&sort=relevance&highlight=true&page_size=5"
+    )
+    assert resp.status_code == 200
+    results = resp.json["results"]
+    assert study_entry.id in [r["id"] for r in results] or len(results) == 5
+    assert all("highlight" in r for r in results)
+    assert any("<b>" in (r["highlight"] or "") for r in results)
+
+    # keyset pages follow the relevance order as well
+    first = auth_client.get(
+        f"/api/studies/?search={word}&sort=relevance&cursor=&page_size=2"
+    )
+    assert first.status_code == 200
+    assert [r["id"] for r in first.json["results"]] == [r["id"] for r in results[:2]]
@@ -1,4 +1,19 @@
-from neurostore.models import Studyset, Study
+import gzip
+import io
+import json
+
+import brotli
+import numpy as np
+import pytest
+import zstandard
+
+from neurostore.database import db
+from neurostore.models import (
+    Studyset,
+    Study,
+    StudysetSnapshotBlob,
+    StudySnapshotBlob,
+)
 
 
 def test_post_and_get_studysets(auth_client, ingest_neurosynth):
@@ -103,3 +118,94 @@ def test_hot_swap_study_in_studyset(auth_client, ingest_neurosynth):
         == set(s for s in clone_ss_non_nested.json["studies"])
         == set(s["id"] for s in clone_ss_nested.json["studies"])
     )
+
+
+def test_nested_snapshot_rebuilt_after_write(auth_client, user_data, snapshots):
+    studyset = Studyset.query.filter_by(user_id=auth_client.username).first()
+    study = studyset.studies[0]
+
+    def blob():
+        return StudysetSnapshotBlob.query.filter_by(studyset_id=studyset.id).first()
+
+    # reads serialize a missing snapshot without storing it
+    first = auth_client.get(f"/api/studysets/{studyset.id}?nested=true")
+    assert first.status_code == 200
+    assert blob() is None or blob().data is None
+
+    # the write marks the study and the studysets containing it stale, and
+    # queues them instead of rebuilding them in the request
+    auth_client.put(f"/api/studies/{study.id}", data={"name": "renamed"})
+    db.session.expire_all()
+    assert blob() is None or blob().data is None
+    second = auth_client.get(f"/api/studysets/{studyset.id}?nested=true")
+    names = {s["id"]: s["name"] for s in second.json["studies"]}
+    assert names[study.id] == "renamed"
+
+    assert snapshots.refresh_queued_snapshots() >= 1
+    db.session.expire_all()
+    assert blob().data is not None
+    assert StudySnapshotBlob.query.filter_by(study_id=study.id).one().data
+    # another cache key, served from the stored blob
+    third = auth_client.get(f"/api/studysets/{studyset.id}?nested=true&format=json")
+    assert third.json == second.json
+
+
+def test_nested_studysets_list(auth_client, user_data):
+    resp = auth_client.get("/api/studysets/?nested=true")
+    assert resp.status_code == 200
+    for result in resp.json["results"]:
+        assert result["studies"] is not None
+        one = auth_client.get(f"/api/studysets/{result['id']}?nested=true")
+        assert one.json == result
+
+
+def test_studyset_coordinates(auth_client, ingest_neurosynth):
+    studyset = Studyset.query.filter_by(name="neurosynth").first()
+    resp = auth_client.get(f"/api/studysets/{studyset.id}?format=npz")
+    assert resp.status_code == 200
+
+    payload = np.load(io.BytesIO(resp.data))
+    coordinates = payload["coordinates"]
+    offsets = payload["offsets"]
+    analyses = {a.id: a for s in studyset.studies for a in s.analyses}
+
+    assert coordinates.dtype == np.float32
+    assert len(offsets) == len(payload["analysis_ids"]) + 1
+    assert offsets[-1] == coordinates.shape[0]
+    for i, analysis_id in enumerate(payload["analysis_ids"]):
+        points = sorted(analyses[analysis_id].points, key=lambda p: p.order)
+        expected = np.array([p.coordinates for p in points], dtype=np.float32)
+        np.testing.assert_array_equal(
+            coordinates[offsets[i] : offsets[i + 1]], expected  # noqa E203
+        )
+
+
+@pytest.mark.parametrize(
+    "encoding,decompress",
+    [
+        ("gzip", gzip.decompress),
+        ("br", brotli.decompress),
+        ("zstd", lambda data: zstandard.ZstdDecompressor().decompress(data)),
+    ],
+)
+def test_compressed_studyset(auth_client, ingest_neurosynth, encoding, decompress):
+    studyset_id = Studyset.query.first().id
+    path = f"/api/studysets/{studyset_id}?nested=true"
+    plain = auth_client.get(path)
+    headers = {**auth_client._get_headers(), "Accept-Encoding": encoding}
+
+    # the cached variant is compressed once and served as is
+    for _ in range(2):
+        resp = auth_client.get(path, headers=headers)
+        assert resp.status_code == 200
+        assert resp.headers["Content-Encoding"] == encoding
+        assert "Accept-Encoding" in resp.headers["Vary"]
+        assert json.loads(decompress(resp.data)) == plain.json
+    assert resp.headers["ETag"] != plain.headers["ETag"]
+
+
+def test_relevance_search_without_search_vector(auth_client, user_data):
+    # studysets have no search vector, they are not ranked
+    resp = auth_client.get("/api/studysets/?search=public%20studyset&sort=relevance")
+    assert resp.status_code == 200
+    assert "public studyset" in [r["name"] for r in resp.json["results"]]
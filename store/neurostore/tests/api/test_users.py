@@ -1,3 +1,5 @@
+import re
+
 from ...models import User
 
 
@@ -21,3 +23,16 @@ def test_list_user(auth_client):
     user = User.query.filter_by(name="user1").first()
     resp = auth_client.get(f"/api/users/{user.id}")
     assert resp.status_code == 200
+
+
+def test_current_user_looked_up_once(auth_client, statements):
+    def user_statements():
+        return [s for s in statements if re.search(r"\busers\b", s)]
+
+    # the user is resolved with a single query per request
+    assert auth_client.get("/api/studies/").status_code == 200
+    assert len(user_statements()) <= 1
+
+    del statements[:]
+    assert auth_client.get("/api/studies/?page_size=5").status_code == 200
+    assert len(user_statements()) <= 1
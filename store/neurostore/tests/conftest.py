@@ -1,3 +1,7 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
 import pytest
 from os import environ
 from neurostore.models.data import Analysis, Condition
@@ -103,8 +107,30 @@ def db(app):
     _db.drop_all()
 
 
+# the resources import the app, which is only configured by the app fixture
+@pytest.fixture(scope="function")
+def caching(app):
+    from ..resources import caching
+
+    return caching
+
+
+@pytest.fixture(scope="function")
+def snapshots(app):
+    from ..resources import snapshots
+
+    return snapshots
+
+
+@pytest.fixture(scope="function")
+def auth(app):
+    from ..resources import auth
+
+    return auth
+
+
 @pytest.fixture(scope="function", autouse=True)
-def session(db):
+def session(db, caching):
     """Creates a new db session for a test.
     Changes in session are rolled back"""
     from ..core import cache
@@ -131,15 +157,30 @@ def session(db):
 
     db.session = session
     cache.clear()
+    caching.clear_local_cache()
 
     yield session
 
     cache.clear()
+    caching.clear_local_cache()
     session.remove()
     transaction.rollback()
     connection.close()
 
 
+@pytest.fixture(scope="function")
+def statements(db):
+    """the SQL statements executed while the test runs"""
+    executed = []
+
+    def record_statement(conn, cursor, statement, *args):
+        executed.append(statement)
+
+    sa.event.listen(db.engine, "before_cursor_execute", record_statement)
+    yield executed
+    sa.event.remove(db.engine, "before_cursor_execute", record_statement)
+
+
 """
 Data population fixtures
 """
@@ -272,6 +313,77 @@ def ingest_neurovault(session):
     return ingest.ingest_neurovault(limit=5)
 
 
+@pytest.fixture(scope="function")
+def neurovault_server():
+    """local stand in for the NeuroVault API, yields its base url and pages"""
+    collections = [
+        {"id": 1, "DOI": "10.1234/nv.1", "name": "one", "number_of_images": 3},
+        {"id": 2, "DOI": None, "name": "no doi", "number_of_images": 1},
+        {"id": 3, "DOI": "10.1234/nv.3", "name": "three", "number_of_images": 1},
+    ]
+
+    def image(collection_id, i, name, condition):
+        return {
+            "name": name,
+            "description": f"{name} map",
+            "file": f"http://example.com/{collection_id}/{i}.nii.gz",
+            "map_type": "T map",
+            "add_date": "2020-01-01T00:00:00Z",
+            "cognitive_paradigm_cogatlas": condition,
+        }
+
+    pages = {}
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            path = self.path.split("?")[0]
+            if path not in pages:
+                self.send_error(404)
+                return
+            body = json.dumps(pages[path]).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    url = f"http://127.0.0.1:{server.server_port}/api"
+    pages.update(
+        {
+            "/api/collections.json": {
+                "next": f"{url}/collections2.json",
+                "results": collections[:2],
+            },
+            "/api/collections2.json": {"next": None, "results": collections[2:]},
+            "/api/collections/1/images/": {
+                "next": f"{url}/collections/1/images2/?format=json",
+                "results": [
+                    image(1, 0, "faces", "face task"),
+                    image(1, 1, "faces", "face task"),
+                ],
+            },
+            "/api/collections/1/images2/": {
+                "next": None,
+                "results": [image(1, 2, "houses", "house task")],
+            },
+            "/api/collections/3/images/": {
+                "next": None,
+                "results": [image(3, 0, "faces", "face task")],
+            },
+        }
+    )
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    # the pages can be edited to simulate upstream changes
+    yield url, pages
+    server.shutdown()
+    server.server_close()
+
+
 @pytest.fixture(scope="function")
 def ingest_neuroquery(session):
     return ingest.ingest_neuroquery(5)
@@ -1,4 +1,7 @@
+import time
+
 import pytest
+from jose import jwt
 
 
 def test_decode_token(add_users):
@@ -9,3 +12,83 @@ def test_decode_token(add_users):
 
     for user in add_users.values():
         decode_token(user["token"])
+
+
+def test_jwks_cache(auth, monkeypatch):
+    fetches = []
+
+    def fetch_jwks():
+        fetches.append(1)
+        return {"keys": [{"kid": "key1", "kty": "RSA", "use": "sig"}]}
+
+    monkeypatch.setattr(auth, "fetch_jwks", fetch_jwks)
+    monkeypatch.setattr(
+        auth,
+        "_jwks",
+        {"keys": {}, "fetched_at": float("-inf"), "attempted_at": float("-inf")},
+    )
+
+    assert auth.get_signing_key("key1")["kid"] == "key1"
+    assert auth.get_signing_key("key1")["kid"] == "key1"
+    assert len(fetches) == 1
+
+    # an unknown key id only refreshes the keys after the minimum interval
+    assert auth.get_signing_key("key2") is None
+    assert len(fetches) == 1
+    monkeypatch.setattr(auth, "JWKS_MIN_REFRESH", -1)
+    assert auth.get_signing_key("key2") is None
+    assert len(fetches) == 2
+
+    # known keys are served while another thread fetches the key set
+    monkeypatch.setattr(auth, "JWKS_TTL", -1)
+    with auth._jwks_lock:
+        assert auth.get_signing_key("key1")["kid"] == "key1"
+    assert len(fetches) == 2
+
+
+def test_jwks_fetch_failure(auth, monkeypatch):
+    def fetch_jwks():
+        raise OSError("auth0 is down")
+
+    monkeypatch.setattr(auth, "fetch_jwks", fetch_jwks)
+    monkeypatch.setattr(
+        auth,
+        "_jwks",
+        {"keys": {}, "fetched_at": float("-inf"), "attempted_at": float("-inf")},
+    )
+
+    # without any cached key the error is raised
+    with pytest.raises(OSError):
+        auth.get_signing_key("key1")
+
+    # an outdated key set keeps being served
+    key = {"kid": "key1", "kty": "RSA", "use": "sig"}
+    monkeypatch.setattr(
+        auth,
+        "_jwks",
+        {
+            "keys": {"key1": key},
+            "fetched_at": float("-inf"),
+            "attempted_at": float("-inf"),
+        },
+    )
+    assert auth.get_signing_key("key1") == key
+    assert auth.get_signing_key("key1") == key
+
+
+def test_verified_token_cache(auth, monkeypatch):
+    decoded = []
+
+    def decode(token, *args, **kwargs):
+        decoded.append(token)
+        return {"sub": "user1-id", "exp": time.time() + 60}
+
+    key = {"kid": "key1", "kty": "RSA", "use": "sig", "n": "n", "e": "e"}
+    monkeypatch.setattr(auth, "get_signing_key", lambda kid: key)
+    monkeypatch.setattr(auth.jwt, "decode", decode)
+    monkeypatch.setattr(auth, "_verified_tokens", auth.OrderedDict())
+
+    token = jwt.encode({"sub": "user1-id"}, "abc", headers={"kid": "key1"})
+    assert auth.decode_token(token)["sub"] == "user1-id"
+    assert auth.decode_token(token)["sub"] == "user1-id"
+    assert len(decoded) == 1
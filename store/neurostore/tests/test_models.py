@@ -1,3 +1,8 @@
+import pytest
+from dateutil.parser import parse as parse_date
+
+from ..ingest import ingest_neuroquery as sync_neuroquery
+from ..ingest import ingest_neurosynth as sync_neurosynth
 from ..models import (
     Study,
     Analysis,
@@ -7,13 +12,153 @@ from ..models import (
     PointValue,
     Image,
     Studyset,
+    SyncState,
 )
+from ..ingest import ingest_neurosynth, ingest_neurovault
+from ..models.data import validate_notes
 
 
 def test_ns_ingestion(session, ingest_neurosynth):
     assert 1
 
 
+def test_ns_ingestion_notes(session, ingest_neurosynth):
+    studyset = Studyset.query.filter_by(name="neurosynth").one()
+    annotation = studyset.annotations[0]
+    n_analyses = sum(len(s.analyses) for s in studyset.studies)
+
+    assert len(annotation.annotation_analyses) == n_analyses
+    for note in annotation.annotation_analyses:
+        assert set(note.note) == set(annotation.note_keys)
+
+
+def test_nq_ingestion(session, ingest_neuroquery):
+    studyset = Studyset.query.filter_by(name="neuroquery").one()
+
+    assert len(studyset.studies) == 5
+    for study in studyset.studies:
+        assert study.base_study is not None
+        for analysis in study.analyses:
+            orders = sorted(p.order for p in analysis.points)
+            assert orders == list(range(len(orders)))
+            assert all(len(p.entities) == 1 for p in analysis.points)
+
+
+def test_sharded_ingestion(session):
+    ingest_neurosynth(20, workers=2)
+    studyset = Studyset.query.filter_by(name="neurosynth").one()
+    annotation = studyset.annotations[0]
+
+    assert len(studyset.studies) == 20
+    analyses = [a for s in studyset.studies for a in s.analyses]
+    assert analyses
+    assert len(annotation.annotation_analyses) == len(analyses)
+    for analysis in analyses:
+        orders = sorted(p.order for p in analysis.points)
+        assert orders == list(range(len(orders)))
+        assert all(len(p.entities) == 1 for p in analysis.points)
+
+
+def test_ns_incremental_sync(session, ingest_neurosynth):
+    studyset = Studyset.query.filter_by(name="neurosynth").one()
+    study = studyset.studies[0]
+    name = study.name
+    analysis = study.analyses[0]
+    analysis_id, n_points = analysis.id, len(analysis.points)
+    note = dict(analysis.annotation_analyses[0].note)
+
+    # drift from the dataset: a renamed study, a lost peak and a changed note
+    study.name = "renamed"
+    session.delete(analysis.points[0])
+    analysis.annotation_analyses[0].note = {k: None for k in note}
+    session.commit()
+
+    # a sync of more rows appends to the same studyset and annotation
+    sync_neurosynth(7)
+    session.expire_all()
+    assert Studyset.query.filter_by(name="neurosynth").count() == 1
+    assert len(studyset.studies) == 7
+    assert len(studyset.annotations) == 1
+    n_analyses = sum(len(s.analyses) for s in studyset.studies)
+    assert len(studyset.annotations[0].annotation_analyses) == n_analyses
+
+    # and brings the changed study back in line, keeping its analyses
+    study = session.get(Study, study.id)
+    assert study.name == name
+    analysis = session.get(Analysis, analysis_id)
+    assert len(analysis.points) == n_points
+    assert analysis.annotation_analyses[0].note == note
+
+
+def test_nq_incremental_sync(session, ingest_neuroquery):
+    study = Study.query.filter_by(source="neuroquery").first()
+    study_id, name = study.id, study.name
+    study.name = "renamed"
+    session.commit()
+
+    sync_neuroquery(7)
+    session.expire_all()
+    assert Studyset.query.filter_by(name="neuroquery").count() == 1
+    studyset = Studyset.query.filter_by(name="neuroquery").one()
+    assert len(studyset.studies) == 7
+    assert Study.query.filter_by(source="neuroquery").count() == 7
+    assert session.get(Study, study_id).name == name
+
+
+def test_nv_ingestion(session, neurovault_server, tmp_path):
+    neurovault_server, _ = neurovault_server
+    checkpoint = str(tmp_path / "neurovault.json")
+    # stops after the first page, leaving a checkpoint behind
+    assert (
+        ingest_neurovault(limit=1, base_url=neurovault_server, checkpoint=checkpoint)
+        == 1
+    )
+    assert tmp_path.joinpath("neurovault.json").exists()
+
+    # resumes from the second page, the first collection is not ingested again
+    assert (
+        ingest_neurovault(limit=None, base_url=neurovault_server, checkpoint=checkpoint)
+        == 1
+    )
+    assert not tmp_path.joinpath("neurovault.json").exists()
+    assert ingest_neurovault(limit=None, base_url=neurovault_server) == 0
+
+    studies = Study.query.filter_by(source="neurovault").order_by(Study.source_id).all()
+    assert [s.source_id for s in studies] == ["1", "3"]
+    assert sorted(a.name for a in studies[0].analyses) == ["faces", "houses"]
+    assert len(studies[0].analyses[0].images) + len(studies[0].analyses[1].images) == 3
+    # the conditions are shared between collections
+    assert Condition.query.filter_by(name="face task").count() == 1
+
+
+def test_nv_incremental_sync(session, neurovault_server, auth_client):
+    url, pages = neurovault_server
+    collections = pages["/api/collections.json"]["results"]
+    collections[0]["modify_date"] = "2021-01-01T00:00:00Z"
+    pages["/api/collections2.json"]["results"][0][
+        "modify_date"
+    ] = "2021-02-01T00:00:00Z"
+    assert ingest_neurovault(limit=None, base_url=url) == 2
+    assert SyncState.query.get("neurovault").watermark == parse_date(
+        "2021-02-01T00:00:00Z"
+    )
+
+    study = Study.query.filter_by(source="neurovault", source_id="1").one()
+    assert auth_client.get(f"/api/studies/{study.id}").json["name"] == "one"
+
+    # only the modified collection is fetched again and updated in place
+    collections[0].update(name="one, revised", modify_date="2021-03-01T00:00:00Z")
+    pages["/api/collections/1/images/"]["next"] = None
+    assert ingest_neurovault(limit=None, base_url=url) == 1
+    assert Study.query.filter_by(source="neurovault").count() == 2
+
+    # the cached response of the study was invalidated
+    resp = auth_client.get(f"/api/studies/{study.id}")
+    assert resp.json["name"] == "one, revised"
+    assert len(resp.json["analyses"]) == 1
+    assert ingest_neurovault(limit=None, base_url=url) == 0
+
+
 def test_Study(app):
     Study()
 
@@ -44,3 +189,18 @@ def test_Image():
 
 def test_Studyset():
     Studyset()
+
+
+def test_validate_notes():
+    note_keys = {"count": "number", "label": "string", "weight": "number"}
+    notes = [{"count": 3, "label": "a", "weight": 0.5}] * 100 + [
+        {"count": None, "label": None, "weight": None}
+    ]
+    validate_notes(note_keys, notes)
+
+    with pytest.raises(ValueError, match="missing these keys"):
+        validate_notes(note_keys, notes + [{"count": 3}])
+    with pytest.raises(ValueError, match="extra keys"):
+        validate_notes(note_keys, notes + [{**notes[0], "other": 1}])
+    with pytest.raises(ValueError, match="label"):
+        validate_notes(note_keys, notes + [{**notes[0], "label": 1}])
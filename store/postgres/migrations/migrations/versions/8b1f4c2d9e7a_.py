@@ -0,0 +1,59 @@
+"""weighted search vectors and trigram indexes
+
+Revision ID: 8b1f4c2d9e7a
+Revises: 276fe2a389a4
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "8b1f4c2d9e7a"
+down_revision = "276fe2a389a4"
+branch_labels = None
+depends_on = None
+
+SEARCH_VECTOR = (
+    "setweight(to_tsvector('english', coalesce(name, '')), 'A') || "
+    "setweight(to_tsvector('english', coalesce(description, '')), 'B') || "
+    "setweight(to_tsvector('english', "
+    "coalesce(authors, '') || ' ' || coalesce(publication, '')), 'C')"
+)
+OLD_SEARCH_VECTOR = (
+    "to_tsvector('english', coalesce(name, '') || ' ' || coalesce(description, ''))"
+)
+TS_VECTOR_INDEXES = {
+    "base_studies": "ix_base_study___ts_vector__",
+    "studies": "ix_study___ts_vector__",
+}
+TRIGRAM_COLUMNS = ("name", "authors", "publication")
+
+
+def _replace_search_vector(expression):
+    # a generated column cannot be altered, it is dropped (with its index)
+    for table, index in TS_VECTOR_INDEXES.items():
+        op.execute(f"DROP INDEX IF EXISTS {index}")
+        op.execute(f"ALTER TABLE {table} DROP COLUMN IF EXISTS __ts_vector__")
+        op.execute(
+            f"ALTER TABLE {table} ADD COLUMN __ts_vector__ tsvector "
+            f"GENERATED ALWAYS AS ({expression}) STORED"
+        )
+        op.execute(f"CREATE INDEX {index} ON {table} USING gin (__ts_vector__)")
+
+
+def upgrade():
+    op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    _replace_search_vector(SEARCH_VECTOR)
+    for table in TS_VECTOR_INDEXES:
+        for column in TRIGRAM_COLUMNS:
+            op.execute(
+                f"CREATE INDEX IF NOT EXISTS ix_{table}_{column}_trgm "
+                f"ON {table} USING gin ({column} gin_trgm_ops)"
+            )
+
+
+def downgrade():
+    for table in TS_VECTOR_INDEXES:
+        for column in TRIGRAM_COLUMNS:
+            op.execute(f"DROP INDEX IF EXISTS ix_{table}_{column}_trgm")
+    _replace_search_vector(OLD_SEARCH_VECTOR)